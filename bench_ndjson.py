@@ -0,0 +1,103 @@
+"""
+流式响应解析的微基准。
+
+对比原来的 aiter_lines() + json.loads 与按字节切分 + 各个解码器在每个 token 上的 CPU 耗时：
+
+    python bench_ndjson.py --tokens 20000 --chunk-size 512
+"""
+import argparse
+import asyncio
+import json
+import time
+
+import httpx
+
+from ndjson import available_decoders, iter_ndjson_lines, make_decoder
+
+
+def build_body(tokens: int) -> bytes:
+    """构造与 Ollama /api/generate 流式输出相同形状的响应体"""
+    lines = [
+        json.dumps(
+            {"model": "llama3:latest", "created_at": "2024-01-01T00:00:00.000000Z", "response": "词", "done": False},
+            ensure_ascii=False,
+        )
+        for _ in range(tokens)
+    ]
+    lines.append(json.dumps({
+        "model": "llama3:latest",
+        "created_at": "2024-01-01T00:00:00.000000Z",
+        "response": "",
+        "done": True,
+        "context": list(range(4096)),
+        "total_duration": 1, "load_duration": 1, "prompt_eval_count": 1,
+        "prompt_eval_duration": 1, "eval_count": tokens, "eval_duration": 1,
+    }))
+    return ("\n".join(lines) + "\n").encode("utf-8")
+
+
+def make_response(body: bytes, chunk_size: int) -> httpx.Response:
+    async def stream():
+        for i in range(0, len(body), chunk_size):
+            yield body[i:i + chunk_size]
+
+    return httpx.Response(200, content=stream())
+
+
+async def parse_lines_json(body: bytes, chunk_size: int) -> int:
+    """原实现：解码为 str 后按行拆分，每行完整 json.loads"""
+    text = []
+    async for line in make_response(body, chunk_size).aiter_lines():
+        if line.strip():
+            data = json.loads(line)
+            if data.get("response", ""):
+                text.append(data["response"])
+            if data.get("done", False):
+                break
+    return len(text)
+
+
+def make_byte_parser(name: str):
+    decoder = make_decoder(name)
+
+    async def parse(body: bytes, chunk_size: int) -> int:
+        text = []
+        async for line in iter_ndjson_lines(make_response(body, chunk_size).aiter_bytes()):
+            chunk_text, done, _ = decoder.decode(line)
+            if chunk_text:
+                text.append(chunk_text)
+            if done:
+                break
+        return len(text)
+
+    return parse
+
+
+async def measure(parse, body: bytes, tokens: int, chunk_size: int, repeat: int) -> float:
+    """返回最好一轮的每 token CPU 耗时（微秒）"""
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.process_time()
+        produced = await parse(body, chunk_size)
+        best = min(best, time.process_time() - start)
+        assert produced == tokens
+    return best / tokens * 1e6
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--tokens", type=int, default=20000)
+    parser.add_argument("--chunk-size", type=int, default=512, help="上游每次读取的字节数")
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    body = build_body(args.tokens)
+    baseline = await measure(parse_lines_json, body, args.tokens, args.chunk_size, args.repeat)
+    print(f"{'aiter_lines + json':<24}{baseline:8.2f} us/token")
+    for name in available_decoders():
+        cost = await measure(make_byte_parser(name), body, args.tokens, args.chunk_size, args.repeat)
+        print(f"{'bytes + ' + name:<24}{cost:8.2f} us/token  ({baseline / cost:.2f}x)")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
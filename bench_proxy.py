@@ -0,0 +1,326 @@
+"""
+代理开销基准测试。
+
+在进程内运行 main.app，上游接到不限速的模拟 Ollama（mock_ollama），对同样的请求分别测量
+经过代理和直接访问模拟服务的 CPU 时间，两者之差即代理为每个请求 / 每个 token 增加的开销：
+
+- generate_non_stream_us / generate_stream_us：每个 /api/generate 请求的 CPU 开销（微秒）；
+- models_us：/api/models（对比上游 /api/tags），health_us：/health（没有上游对应接口，即完整耗时）；
+- stream_per_token_us：流式生成每多一个 token 增加的 CPU 开销；
+- stream_memory_kb：每个进行中的流式请求占用的内存（tracemalloc）。
+
+两次 HTTP 调用都经过 httpx.ASGITransport，不包含真实网络和序列化到套接字的开销。
+
+--save-baseline 保存当前结果作为基线；之后运行时与基线对比，任何指标比基线差超过
+--threshold（相对值，可以用 --budget 名称=比例 单独指定）时以非零状态退出：
+
+    python bench_proxy.py --save-baseline
+    python bench_proxy.py --threshold 0.2 --budget stream_memory_kb=0.1
+"""
+import argparse
+import asyncio
+import contextlib
+import gc
+import json
+import logging
+import os
+import platform
+import sys
+import time
+import tracemalloc
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional, Tuple
+
+import httpx
+
+import config
+import main
+from mock_ollama import MockSettings, create_app
+from scheduler import AdmissionController
+from upstream import UpstreamPool
+
+DEFAULT_BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_baseline.json")
+
+# 指标名 -> (单位, 说明)，所有指标都是越小越好
+METRICS = {
+    "generate_non_stream_us": ("us", "/api/generate 非流式，每请求 CPU 开销"),
+    "generate_stream_us": ("us", "/api/generate 流式，每请求 CPU 开销"),
+    "models_us": ("us", "/api/models，每请求 CPU 开销"),
+    "health_us": ("us", "/health，每请求 CPU 耗时"),
+    "stream_per_token_us": ("us", "流式生成每 token CPU 开销"),
+    "stream_memory_kb": ("KB", "每个进行中的流式请求占用内存"),
+}
+
+
+class SwitchableUpstream:
+    """转发到当前模拟服务的 ASGI 应用，便于在不同阶段更换模拟服务的配置"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        await self.app(scope, receive, send)
+
+
+Call = Callable[[int], Awaitable[httpx.Response]]
+
+
+async def cpu_per_call(call: Call, iterations: int, repeat: int) -> Tuple[float, float]:
+    """返回最好一轮的每次调用 (CPU 时间, 墙钟时间)，单位微秒"""
+    best_cpu = best_wall = float("inf")
+    counter = 0
+    for _ in range(repeat):
+        cpu_start, wall_start = time.process_time(), time.perf_counter()
+        for _ in range(iterations):
+            response = await call(counter)
+            counter += 1
+            if response.status_code != 200:
+                raise RuntimeError(f"基准请求失败: {response.status_code} {response.text[:200]}")
+        best_cpu = min(best_cpu, time.process_time() - cpu_start)
+        best_wall = min(best_wall, time.perf_counter() - wall_start)
+    return best_cpu / iterations * 1e6, best_wall / iterations * 1e6
+
+
+def generate_payload(i: int, stream: bool, tokens: int, proxied: bool) -> Dict[str, Any]:
+    # 每次使用不同的 prompt，避免命中响应缓存和请求合并
+    payload: Dict[str, Any] = {
+        "model": "llama3",
+        "prompt": f"benchmark prompt {i}",
+        "stream": stream,
+        "options": {"num_predict": tokens},
+    }
+    if proxied and stream:
+        # 不合并写入，否则合并的时间预算会计入墙钟时间
+        payload["coalesce_ms"] = 0
+    return payload
+
+
+async def measure_memory(proxy: httpx.AsyncClient, direct: httpx.AsyncClient, upstream: SwitchableUpstream, streams: int) -> float:
+    """同时保持 streams 个流式请求进行中，返回代理为每个流额外占用的内存（KB）"""
+    mock = create_app(MockSettings(tokens_per_second=20, output_tokens=1000))
+    upstream.app = mock
+    stats = mock.state.mock.stats
+
+    async def held_memory(client: httpx.AsyncClient, proxied: bool) -> float:
+        gc.collect()
+        before = tracemalloc.get_traced_memory()[0]
+        tasks = [
+            asyncio.ensure_future(client.post("/api/generate", json=generate_payload(i, True, 1000, proxied)))
+            for i in range(streams)
+        ]
+        # 等所有流都已开始生成
+        deadline = time.monotonic() + 10
+        while stats.active < streams and time.monotonic() < deadline:
+            await asyncio.sleep(0.01)
+        if stats.active < streams:
+            raise RuntimeError(f"只有 {stats.active}/{streams} 个流式请求到达上游")
+        await asyncio.sleep(0.2)
+        gc.collect()
+        held = tracemalloc.get_traced_memory()[0] - before
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        while stats.active and time.monotonic() < deadline:
+            await asyncio.sleep(0.01)
+        return held
+
+    # 不让准入控制的并发上限把流挡在队列里
+    admission_controller = main.admission_controller
+    main.admission_controller = make_admission_controller(max_per_backend=0)
+    tracemalloc.start()
+    try:
+        direct_bytes = await held_memory(direct, proxied=False)
+        proxy_bytes = await held_memory(proxy, proxied=True)
+    finally:
+        tracemalloc.stop()
+        main.admission_controller = admission_controller
+    return (proxy_bytes - direct_bytes) / streams / 1024
+
+
+def make_admission_controller(**overrides: Any) -> AdmissionController:
+    """按 main 的配置新建准入控制器，基准不改动应用共享的实例"""
+    settings: Dict[str, Any] = dict(
+        max_per_backend=config.ADMISSION_MAX_PER_BACKEND,
+        max_per_model=config.ADMISSION_MAX_PER_MODEL,
+        max_queue=config.ADMISSION_MAX_QUEUE,
+        queue_timeout=config.ADMISSION_QUEUE_TIMEOUT,
+        aging_interval=config.ADMISSION_AGING_INTERVAL,
+        tenant_weights=config.TENANT_WEIGHTS,
+        default_tenant_weight=config.DEFAULT_TENANT_WEIGHT,
+        max_queue_per_tenant=config.ADMISSION_MAX_QUEUE_PER_TENANT,
+        tenant_idle_ttl=config.TENANT_IDLE_TTL,
+        breakers=main.admission_controller.breakers,
+    )
+    settings.update(overrides)
+    return AdmissionController(main.router, **settings)
+
+
+@contextlib.asynccontextmanager
+async def isolated_proxy(upstream: Any) -> AsyncIterator[None]:
+    """
+    让 main.app 在基准期间使用新建的连接池（连到 upstream）和准入控制器，结束后关闭连接池
+    并换回原来的实例。
+    """
+    pool = UpstreamPool(
+        max_connections=config.UPSTREAM_MAX_CONNECTIONS,
+        max_keepalive_connections=config.UPSTREAM_MAX_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry=config.UPSTREAM_KEEPALIVE_EXPIRY,
+        connect_timeout=config.UPSTREAM_CONNECT_TIMEOUT,
+        timeouts=config.UPSTREAM_TIMEOUTS,
+        transport_factory=lambda url: httpx.ASGITransport(app=upstream),
+    )
+    saved = (main.upstream_pool, main.health_prober.pool, main.model_state_poller.pool, main.admission_controller)
+    main.upstream_pool = main.health_prober.pool = main.model_state_poller.pool = pool
+    main.admission_controller = make_admission_controller()
+    try:
+        yield
+    finally:
+        main.upstream_pool, main.health_prober.pool, main.model_state_poller.pool, main.admission_controller = saved
+        await pool.aclose()
+
+
+async def run_suite(iterations: int = 200, repeat: int = 3, tokens: int = 256, streams: int = 50) -> Dict[str, Any]:
+    """运行全部基准，返回 {"metrics": {...}, "details": {...}}"""
+    upstream = SwitchableUpstream(create_app(MockSettings(tokens_per_second=0, output_tokens=1)))
+    proxy = httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://proxy")
+    direct = httpx.AsyncClient(transport=httpx.ASGITransport(app=upstream), base_url="http://ollama")
+
+    cases: List[Tuple[str, Call, Optional[Call]]] = [
+        (
+            "generate_non_stream_us",
+            lambda i: proxy.post("/api/generate", json=generate_payload(i, False, 1, True)),
+            lambda i: direct.post("/api/generate", json=generate_payload(i, False, 1, False)),
+        ),
+        (
+            "generate_stream_us",
+            lambda i: proxy.post("/api/generate", json=generate_payload(i, True, 1, True)),
+            lambda i: direct.post("/api/generate", json=generate_payload(i, True, 1, False)),
+        ),
+        ("models_us", lambda i: proxy.get("/api/models"), lambda i: direct.get("/api/tags")),
+        ("health_us", lambda i: proxy.get("/health"), None),
+    ]
+
+    metrics: Dict[str, float] = {}
+    details: Dict[str, Any] = {}
+    try:
+        async with isolated_proxy(upstream):
+            for name, proxied, upstream_only in cases:
+                await proxied(-1)  # 预热：建立连接、填充模型列表缓存
+                cpu, wall = await cpu_per_call(proxied, iterations, repeat)
+                base_cpu = base_wall = 0.0
+                if upstream_only is not None:
+                    await upstream_only(-1)
+                    base_cpu, base_wall = await cpu_per_call(upstream_only, iterations, repeat)
+                metrics[name] = cpu - base_cpu
+                details[name] = {"proxy_cpu_us": cpu, "upstream_cpu_us": base_cpu, "proxy_wall_us": wall, "upstream_wall_us": base_wall}
+
+            # 每 token 开销：长输出与单 token 输出之差，再减去上游本身的差值
+            token_iterations = max(iterations // 10, 5)
+            long_proxy, _ = await cpu_per_call(
+                lambda i: proxy.post("/api/generate", json=generate_payload(i, True, tokens, True)), token_iterations, repeat)
+            long_direct, _ = await cpu_per_call(
+                lambda i: direct.post("/api/generate", json=generate_payload(i, True, tokens, False)), token_iterations, repeat)
+            short = details["generate_stream_us"]
+            metrics["stream_per_token_us"] = (
+                (long_proxy - short["proxy_cpu_us"]) - (long_direct - short["upstream_cpu_us"])
+            ) / (tokens - 1)
+            details["stream_per_token_us"] = {"tokens": tokens, "proxy_cpu_us": long_proxy, "upstream_cpu_us": long_direct}
+
+            metrics["stream_memory_kb"] = await measure_memory(proxy, direct, upstream, streams)
+            details["stream_memory_kb"] = {"streams": streams}
+    finally:
+        await proxy.aclose()
+        await direct.aclose()
+
+    return {
+        "metrics": {name: round(value, 3) for name, value in metrics.items()},
+        "details": details,
+        "environment": {"python": sys.version.split()[0], "platform": platform.platform(), "machine": platform.machine()},
+    }
+
+
+def compare(
+    metrics: Dict[str, float],
+    baseline: Dict[str, float],
+    threshold: float,
+    budgets: Optional[Dict[str, float]] = None,
+) -> List[str]:
+    """返回超出预算的指标说明；某指标的预算为相对基线允许变差的比例"""
+    budgets = budgets or {}
+    regressions = []
+    for name, value in metrics.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        limit = base + abs(base) * budgets.get(name, threshold)
+        if value > limit:
+            unit = METRICS.get(name, ("", ""))[0]
+            regressions.append(f"{name}: {value:.2f}{unit} > 基线 {base:.2f}{unit} 的预算上限 {limit:.2f}{unit}")
+    return regressions
+
+
+def format_results(metrics: Dict[str, float], baseline: Optional[Dict[str, float]]) -> str:
+    lines = [f"{'metric':<26}{'value':>12}{'baseline':>12}{'change':>10}"]
+    for name, value in metrics.items():
+        unit = METRICS.get(name, ("", ""))[0]
+        base = (baseline or {}).get(name)
+        change = f"{(value - base) / abs(base):+.1%}" if base else ""
+        base_text = f"{base:.2f}" if base is not None else "-"
+        lines.append(f"{name:<26}{value:>10.2f}{unit:<2}{base_text:>12}{change:>10}")
+    return "\n".join(lines)
+
+
+def parse_budgets(items: List[str]) -> Dict[str, float]:
+    budgets = {}
+    for item in items:
+        name, _, ratio = item.partition("=")
+        if name not in METRICS or not ratio:
+            raise SystemExit(f"无效的预算: {item}（可用指标: {', '.join(METRICS)}）")
+        budgets[name] = float(ratio)
+    return budgets
+
+
+async def run(args: argparse.Namespace) -> int:
+    results = await run_suite(args.iterations, args.repeat, args.tokens, args.streams)
+    baseline = None
+    if not args.save_baseline and os.path.exists(args.baseline):
+        with open(args.baseline, encoding="utf-8") as f:
+            baseline = json.load(f)["metrics"]
+
+    print(format_results(results["metrics"], baseline))
+    if args.json_out:
+        with open(args.json_out, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+    if args.save_baseline:
+        with open(args.baseline, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+        print(f"基线已保存到 {args.baseline}")
+        return 0
+    if baseline is None:
+        print(f"没有找到基线文件 {args.baseline}，跳过回归检查（使用 --save-baseline 创建）")
+        return 0
+
+    regressions = compare(results["metrics"], baseline, args.threshold, parse_budgets(args.budget))
+    for line in regressions:
+        print(f"回归: {line}")
+    return 1 if regressions else 0
+
+
+def cli() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=200, help="每轮的请求数")
+    parser.add_argument("--repeat", type=int, default=3, help="轮数，取最好的一轮")
+    parser.add_argument("--tokens", type=int, default=256, help="测量每 token 开销时的输出 token 数")
+    parser.add_argument("--streams", type=int, default=50, help="测量内存时同时进行的流式请求数")
+    parser.add_argument("--baseline", default=DEFAULT_BASELINE, help="基线文件路径")
+    parser.add_argument("--save-baseline", action="store_true", help="把本次结果保存为基线")
+    parser.add_argument("--threshold", type=float, default=0.2, help="默认允许比基线变差的比例")
+    parser.add_argument("--budget", action="append", default=[], metavar="NAME=RATIO", help="单个指标的预算")
+    parser.add_argument("--json-out", help="把本次结果写入 JSON 文件")
+    args = parser.parse_args()
+
+    logging.disable(logging.WARNING)
+    sys.exit(asyncio.run(run(args)))
+
+
+if __name__ == "__main__":
+    cli()
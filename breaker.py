@@ -0,0 +1,144 @@
+"""
+每个后端的熔断器。
+
+连续出现 failure_threshold 次连接错误、5xx、超时或流中断后熔断（open），在 open_seconds 内
+不再把请求路由到该后端；之后进入半开（half_open），放行一个试探请求：成功则恢复
+（closed），失败则再次熔断，熔断时间翻倍，最长 max_open_seconds。
+所有后端都熔断时，准入控制直接拒绝请求，不必等到连接超时。
+"""
+import time
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional
+
+import httpx
+
+from upstream import StreamTimeout, StreamTruncated
+
+CLOSED = "closed"
+OPEN = "open"
+HALF_OPEN = "half_open"
+# 导出为指标时的数值
+CIRCUIT_STATE_VALUES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+def is_backend_failure(error: BaseException) -> bool:
+    """连接错误、超时、流在完成前中断和 5xx 视为后端故障；4xx 说明后端正常响应"""
+    if isinstance(error, httpx.HTTPStatusError):
+        return error.response.status_code >= 500
+    return isinstance(error, (httpx.RequestError, StreamTimeout, StreamTruncated))
+
+
+class CircuitBreaker:
+    def __init__(self, url: str, failure_threshold: int, open_seconds: float, max_open_seconds: float):
+        self.url = url
+        self.failure_threshold = failure_threshold
+        self.open_seconds = open_seconds
+        self.max_open_seconds = max_open_seconds
+        self.state = CLOSED
+        self.consecutive_failures = 0
+        self.open_until = 0.0
+        self.trips = 0
+        self.last_error: Optional[str] = None
+        self._cooldown = open_seconds
+        self._trial_in_flight = False
+
+    def available(self, now: Optional[float] = None) -> bool:
+        """是否可以把请求路由到该后端（半开状态只放行一个试探请求）"""
+        if self.state == CLOSED:
+            return True
+        if self.state == OPEN:
+            return (now or time.monotonic()) >= self.open_until
+        return not self._trial_in_flight
+
+    def on_dispatch(self) -> None:
+        """请求已路由到该后端"""
+        if self.state == OPEN and time.monotonic() >= self.open_until:
+            self.state = HALF_OPEN
+        if self.state == HALF_OPEN:
+            self._trial_in_flight = True
+
+    def record_success(self) -> None:
+        self.state = CLOSED
+        self.consecutive_failures = 0
+        self._cooldown = self.open_seconds
+        self._trial_in_flight = False
+
+    def record_failure(self, error: BaseException) -> None:
+        self.consecutive_failures += 1
+        self.last_error = f"{type(error).__name__}: {error}"
+        self._trial_in_flight = False
+        if self.state == HALF_OPEN:
+            # 试探失败，延长熔断时间
+            self._cooldown = min(self._cooldown * 2, self.max_open_seconds)
+            self._trip()
+        elif self.state == CLOSED and self.consecutive_failures >= self.failure_threshold:
+            self._trip()
+
+    def record_neutral(self) -> None:
+        """请求被取消或因与后端无关的原因失败，不影响熔断状态"""
+        self._trial_in_flight = False
+
+    def _trip(self) -> None:
+        self.state = OPEN
+        self.open_until = time.monotonic() + self._cooldown
+        self.trips += 1
+
+    def to_dict(self) -> Dict[str, Any]:
+        state = self.state
+        if state == OPEN and time.monotonic() >= self.open_until:
+            state = HALF_OPEN
+        return {
+            "url": self.url,
+            "state": state,
+            "consecutive_failures": self.consecutive_failures,
+            "trips": self.trips,
+            "open_for": round(max(self.open_until - time.monotonic(), 0.0), 3) if self.state == OPEN else 0.0,
+            "last_error": self.last_error,
+        }
+
+
+class BreakerRegistry:
+    def __init__(self, urls: List[str], failure_threshold: int, open_seconds: float, max_open_seconds: float):
+        self._breakers = {
+            url: CircuitBreaker(url, failure_threshold, open_seconds, max_open_seconds) for url in urls
+        }
+
+    def get(self, url: str) -> CircuitBreaker:
+        return self._breakers[url]
+
+    def available(self, url: str) -> bool:
+        breaker = self._breakers.get(url)
+        return breaker is None or breaker.available()
+
+    def on_dispatch(self, url: str) -> None:
+        breaker = self._breakers.get(url)
+        if breaker is not None:
+            breaker.on_dispatch()
+
+    def reopens_in(self) -> float:
+        """距离最早一个熔断的后端进入半开还有多少秒，没有正在冷却的后端时为 0"""
+        now = time.monotonic()
+        return min((b.open_until - now for b in self._breakers.values() if b.open_until > now), default=0.0)
+
+    @contextmanager
+    def guard(self, url: str) -> Iterator[None]:
+        """按上下文中的异常记录一次调用的结果"""
+        breaker = self._breakers.get(url)
+        if breaker is None:
+            yield
+            return
+        try:
+            yield
+        except BaseException as e:
+            if is_backend_failure(e):
+                breaker.record_failure(e)
+            elif isinstance(e, httpx.HTTPStatusError):
+                breaker.record_success()
+            else:
+                breaker.record_neutral()
+            raise
+        else:
+            breaker.record_success()
+
+    def stats(self) -> List[Dict[str, Any]]:
+        return [breaker.to_dict() for breaker in self._breakers.values()]
@@ -0,0 +1,493 @@
+"""
+响应缓存。
+
+- ResponseCache：非流式生成结果的精确匹配缓存。以 (模型, 提示词, 生成参数) 的规范化
+  哈希作为键，内存中按 LRU + TTL 淘汰，同时限制条目数和缓存的响应文本总字节数；
+- DiskResponseCache：ResponseCache 之后的 SQLite 持久化层，重启后仍然有效，启动时用
+  最近访问的条目预热内存层；
+- RefreshingCache：单个预序列化响应体的缓存（如模型列表），过期后先返回旧值并在后台刷新。
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Set, Tuple
+
+from routing import normalize_model_name
+
+logger = logging.getLogger(__name__)
+
+
+def make_cache_key(model: str, prompt: str, options: Optional[Dict[str, Any]]) -> str:
+    """生成规范化的缓存键：模型名补全标签，参数按键排序"""
+    raw = json.dumps(
+        [normalize_model_name(model), prompt, options or {}],
+        sort_keys=True,
+        ensure_ascii=False,
+        separators=(",", ":"),
+    )
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+
+def is_deterministic(options: Optional[Dict[str, Any]]) -> bool:
+    """temperature 为 0 或固定了 seed 的生成结果是可复现的"""
+    if not options:
+        return False
+    return options.get("temperature") == 0 or options.get("seed") is not None
+
+
+@dataclass
+class CacheEntry:
+    model: str
+    value: Dict[str, Any]
+    size: int
+    expires_at: float
+
+
+class ResponseCache:
+    """
+    LRU + TTL 的响应缓存。
+
+    max_entries 和 max_bytes 任一超出时，从最久未使用的条目开始淘汰；
+    过期条目在读取时惰性删除。
+    """
+
+    def __init__(self, max_entries: int, max_bytes: int, ttl: float):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, CacheEntry]" = OrderedDict()
+        self._keys_by_model: Dict[str, Set[str]] = {}
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        if entry.expires_at <= time.monotonic():
+            self._remove(key)
+            self.expirations += 1
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return entry.value
+
+    def set(self, key: str, model: str, value: Dict[str, Any], ttl: Optional[float] = None) -> None:
+        """ttl 为空时使用缓存默认的 ttl"""
+        size = len(value.get("response", "").encode("utf-8"))
+        if size > self.max_bytes:
+            return
+        if key in self._entries:
+            self._remove(key)
+        model = normalize_model_name(model)
+        self._entries[key] = CacheEntry(model, value, size, time.monotonic() + (self.ttl if ttl is None else ttl))
+        self._keys_by_model.setdefault(model, set()).add(key)
+        self.total_bytes += size
+        while len(self._entries) > self.max_entries or self.total_bytes > self.max_bytes:
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            self.evictions += 1
+
+    def _remove(self, key: str) -> None:
+        entry = self._entries.pop(key)
+        self.total_bytes -= entry.size
+        keys = self._keys_by_model.get(entry.model)
+        if keys is not None:
+            keys.discard(key)
+            if not keys:
+                del self._keys_by_model[entry.model]
+
+    def invalidate_model(self, model: str) -> int:
+        """删除某个模型的全部缓存条目，返回删除数量"""
+        keys = self._keys_by_model.pop(normalize_model_name(model), set())
+        for key in keys:
+            entry = self._entries.pop(key, None)
+            if entry is not None:
+                self.total_bytes -= entry.size
+        return len(keys)
+
+    def clear(self) -> None:
+        self._entries.clear()
+        self._keys_by_model.clear()
+        self.total_bytes = 0
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "bytes": self.total_bytes,
+            "max_entries": self.max_entries,
+            "max_bytes": self.max_bytes,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else None,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+        }
+
+
+@dataclass
+class DiskEntry:
+    """从磁盘层读出的条目，expires_at 为 Unix 时间"""
+    key: str
+    model: str
+    value: Dict[str, Any]
+    expires_at: float
+
+
+class DiskResponseCache:
+    """
+    基于 SQLite 的持久化响应缓存，path 为空时不启用。
+
+    值为 zlib 压缩的 JSON。条目数或压缩后的总字节数超出上限时按最近访问时间淘汰，
+    过期条目在读取和淘汰时删除。数据库操作都在线程中执行，不阻塞事件循环；
+    写入在后台进行，请求不等待落盘。数据库出错或条目无法解码时按未命中处理，不影响请求。
+
+    每个模型有一个失效代数，invalidate_model() 时递增；写入时代数已变化的结果被丢弃，
+    避免删除模型之前发起的后台写入在失效之后落盘。
+    """
+
+    def __init__(self, path: str, max_entries: int, max_bytes: int, ttl: float, compress_level: int = 6):
+        self.path = path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.compress_level = compress_level
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+        self._writes: Set[asyncio.Task] = set()
+        self._generations: Dict[str, int] = {}
+        self.entries = 0
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.errors = 0
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.path)
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, model TEXT NOT NULL, value BLOB NOT NULL, size INTEGER NOT NULL, "
+                "expires_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at)")
+            conn.execute("CREATE INDEX IF NOT EXISTS responses_model ON responses (model)")
+            conn.commit()
+            self._conn = conn
+            self._count(conn)
+        return self._conn
+
+    def _run(self, operation: Callable[..., Any], *args: Any) -> Any:
+        with self._lock:
+            conn = self._connect()
+            try:
+                return operation(conn, *args)
+            except sqlite3.Error:
+                # 回滚未提交的修改，并按数据库的实际内容重新统计
+                conn.rollback()
+                self._count(conn)
+                raise
+
+    def _count(self, conn: sqlite3.Connection) -> None:
+        self.entries, self.total_bytes = conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM responses"
+        ).fetchone()
+
+    async def _call(self, operation: Callable[..., Any], *args: Any, default: Any = None) -> Any:
+        try:
+            return await asyncio.to_thread(self._run, operation, *args)
+        except sqlite3.Error as e:
+            self.errors += 1
+            logger.warning("磁盘响应缓存 %s 出错: %s", self.path, e)
+            return default
+
+    def _decode(self, key: str, blob: bytes) -> Optional[Dict[str, Any]]:
+        """解压并解析条目，数据损坏时返回 None"""
+        try:
+            return json.loads(zlib.decompress(blob))
+        except (zlib.error, ValueError) as e:
+            self.errors += 1
+            logger.warning("磁盘响应缓存 %s 中的条目 %s 已损坏: %s", self.path, key, e)
+            return None
+
+    def _get(self, conn: sqlite3.Connection, key: str) -> Optional[DiskEntry]:
+        row = conn.execute("SELECT model, value, size, expires_at FROM responses WHERE key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        model, blob, size, expires_at = row
+        now = time.time()
+        if expires_at <= now:
+            self._delete(conn, [(key, size)])
+            self.expirations += 1
+            conn.commit()
+            return None
+        value = self._decode(key, blob)
+        if value is None:
+            self._delete(conn, [(key, size)])
+            conn.commit()
+            return None
+        conn.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (now, key))
+        conn.commit()
+        return DiskEntry(key, model, value, expires_at)
+
+    async def get(self, key: str) -> Optional[DiskEntry]:
+        if not self.enabled:
+            return None
+        entry = await self._call(self._get, key)
+        if entry is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return entry
+
+    def _delete(self, conn: sqlite3.Connection, rows: List[Tuple[str, int]]) -> None:
+        conn.executemany("DELETE FROM responses WHERE key = ?", [(key,) for key, _ in rows])
+        self.entries -= len(rows)
+        self.total_bytes -= sum(size for _, size in rows)
+
+    def generation(self, model: str) -> int:
+        """模型当前的失效代数"""
+        return self._generations.get(normalize_model_name(model), 0)
+
+    def _set(self, conn: sqlite3.Connection, key: str, model: str, value: Dict[str, Any], generation: int) -> None:
+        # 与 _invalidate_model 持有同一把锁：代数在失效开始前递增，这里检查后写入的条目不会被漏删
+        if self._generations.get(model, 0) != generation:
+            return
+        blob = zlib.compress(json.dumps(value, ensure_ascii=False).encode("utf-8"), self.compress_level)
+        if len(blob) > self.max_bytes:
+            return
+        old = conn.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+        if old is not None:
+            self._delete(conn, [(key, old[0])])
+        now = time.time()
+        conn.execute(
+            "INSERT INTO responses (key, model, value, size, expires_at, accessed_at) VALUES (?, ?, ?, ?, ?, ?)",
+            (key, model, blob, len(blob), now + self.ttl, now),
+        )
+        self.entries += 1
+        self.total_bytes += len(blob)
+        self.writes += 1
+        self._evict(conn, now)
+        conn.commit()
+
+    def _evict(self, conn: sqlite3.Connection, now: float) -> None:
+        if self.entries <= self.max_entries and self.total_bytes <= self.max_bytes:
+            return
+        expired = conn.execute("SELECT key, size FROM responses WHERE expires_at <= ?", (now,)).fetchall()
+        self._delete(conn, expired)
+        self.expirations += len(expired)
+        victims = []
+        entries, total_bytes = self.entries, self.total_bytes
+        for key, size in conn.execute("SELECT key, size FROM responses ORDER BY accessed_at"):
+            if entries <= self.max_entries and total_bytes <= self.max_bytes:
+                break
+            victims.append((key, size))
+            entries -= 1
+            total_bytes -= size
+        self._delete(conn, victims)
+        self.evictions += len(victims)
+
+    async def set(self, key: str, model: str, value: Dict[str, Any], generation: Optional[int] = None) -> None:
+        """generation 为生成该结果之前取得的失效代数，为空时取当前代数"""
+        if not self.enabled:
+            return
+        model = normalize_model_name(model)
+        if generation is None:
+            generation = self._generations.get(model, 0)
+        await self._call(self._set, key, model, value, generation)
+
+    def set_nowait(self, key: str, model: str, value: Dict[str, Any], generation: Optional[int] = None) -> None:
+        """在后台写入，不等待落盘"""
+        if not self.enabled:
+            return
+        if generation is None:
+            generation = self.generation(model)
+        task = asyncio.ensure_future(self.set(key, model, value, generation))
+        self._writes.add(task)
+        task.add_done_callback(self._writes.discard)
+
+    def _recent(self, conn: sqlite3.Connection, limit: int) -> List[DiskEntry]:
+        rows = conn.execute(
+            "SELECT key, model, value, size, expires_at FROM responses WHERE expires_at > ? "
+            "ORDER BY accessed_at DESC LIMIT ?",
+            (time.time(), limit),
+        ).fetchall()
+        entries, corrupt = [], []
+        for key, model, blob, size, expires_at in rows:
+            value = self._decode(key, blob)
+            if value is None:
+                corrupt.append((key, size))
+            else:
+                entries.append(DiskEntry(key, model, value, expires_at))
+        if corrupt:
+            self._delete(conn, corrupt)
+            conn.commit()
+        return entries
+
+    async def load_recent(self, limit: int) -> List[DiskEntry]:
+        """最近访问的 limit 个未过期条目，最近的在前，用于预热内存层"""
+        if not self.enabled or limit <= 0:
+            return []
+        return await self._call(self._recent, limit, default=[])
+
+    def _invalidate_model(self, conn: sqlite3.Connection, model: str) -> int:
+        rows = conn.execute("SELECT key, size FROM responses WHERE model = ?", (model,)).fetchall()
+        self._delete(conn, rows)
+        conn.commit()
+        return len(rows)
+
+    async def invalidate_model(self, model: str) -> int:
+        """删除某个模型的全部条目，返回删除数量"""
+        if not self.enabled:
+            return 0
+        model = normalize_model_name(model)
+        self._generations[model] = self._generations.get(model, 0) + 1
+        return await self._call(self._invalidate_model, model, default=0)
+
+    async def aclose(self) -> None:
+        """等后台写入完成后关闭数据库"""
+        if self._writes:
+            await asyncio.gather(*self._writes, return_exceptions=True)
+        if self._conn is not None:
+            conn, self._conn = self._conn, None
+            await asyncio.to_thread(self._run_close, conn)
+
+    def _run_close(self, conn: sqlite3.Connection) -> None:
+        with self._lock:
+            conn.close()
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "path": self.path or None,
+            "entries": self.entries,
+            "bytes": self.total_bytes,
+            "max_entries": self.max_entries,
+            "max_bytes": self.max_bytes,
+            "ttl": self.ttl,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_ratio": round(self.hits / lookups, 4) if lookups else None,
+            "writes": self.writes,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "errors": self.errors,
+        }
+
+
+@dataclass
+class Snapshot:
+    """一次刷新得到的响应体及其 ETag"""
+    body: bytes
+    etag: str
+    fetched_at: float
+
+
+class RefreshingCache:
+    """
+    缓存 loader 返回的 JSON 响应体（stale-while-revalidate）。
+
+    - 未超过 ttl：直接返回缓存；
+    - 超过 ttl 但未超过 ttl + stale_ttl：返回旧值，同时在后台刷新；
+    - 更旧或尚无缓存：等待刷新完成。并发的刷新会合并为一次。
+    """
+
+    def __init__(self, loader: Callable[[], Awaitable[bytes]], ttl: float, stale_ttl: float):
+        self.loader = loader
+        self.ttl = ttl
+        self.stale_ttl = stale_ttl
+        self.snapshot: Optional[Snapshot] = None
+        self._refreshing: Optional[asyncio.Task] = None
+        # invalidate() 时递增，丢弃失效之前发起的刷新结果
+        self._generation = 0
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self.refresh_errors = 0
+
+    async def _load(self) -> Snapshot:
+        generation = self._generation
+        body = await self.loader()
+        snapshot = Snapshot(
+            body=body,
+            etag='"' + hashlib.sha1(body).hexdigest() + '"',
+            fetched_at=time.monotonic(),
+        )
+        if generation == self._generation:
+            self.snapshot = snapshot
+        self.refreshes += 1
+        return snapshot
+
+    def _on_refreshed(self, task: asyncio.Task) -> None:
+        if self._refreshing is task:
+            self._refreshing = None
+        if not task.cancelled() and task.exception() is not None:
+            self.refresh_errors += 1
+            logger.warning("后台刷新缓存失败: %s", task.exception())
+
+    def refresh(self) -> "asyncio.Task[Snapshot]":
+        """开始（或加入进行中的）刷新"""
+        if self._refreshing is None:
+            self._refreshing = asyncio.ensure_future(self._load())
+            self._refreshing.add_done_callback(self._on_refreshed)
+        return self._refreshing
+
+    async def get(self) -> Snapshot:
+        snapshot = self.snapshot
+        if snapshot is not None:
+            age = time.monotonic() - snapshot.fetched_at
+            if age < self.ttl:
+                self.hits += 1
+                return snapshot
+            if age < self.ttl + self.stale_ttl:
+                self.stale_hits += 1
+                self.refresh()
+                return snapshot
+        self.misses += 1
+        return await asyncio.shield(self.refresh())
+
+    def invalidate(self) -> None:
+        self._generation += 1
+        self.snapshot = None
+        self._refreshing = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "ttl": self.ttl,
+            "stale_ttl": self.stale_ttl,
+            "age": round(time.monotonic() - self.snapshot.fetched_at, 3) if self.snapshot else None,
+            "etag": self.snapshot.etag if self.snapshot else None,
+            "hits": self.hits,
+            "stale_hits": self.stale_hits,
+            "misses": self.misses,
+            "refreshes": self.refreshes,
+            "refresh_errors": self.refresh_errors,
+        }
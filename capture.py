@@ -0,0 +1,205 @@
+"""
+/api/generate 流量记录。
+
+每个请求结束后生成一条记录（模型、prompt 的哈希和长度、生成参数、耗时和 token 数），
+放入有界队列后立即返回；后台任务按批（batch_size 条或 flush_interval 秒）在线程中追加写入
+JSONL 文件，不在事件循环里做磁盘 I/O。队列满时丢弃记录并计数，记录流量不会拖慢请求。
+
+默认不保存 prompt 原文，也不记录 API key 等请求头；include_prompts 为真时才保存原文。
+记录的文件可以用 replay.py 按原始或缩放后的时间间隔重放。
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import random
+import time
+from typing import Any, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# aclose() 放入队列的停止标记，写入任务取到后写完当前批次并退出
+_STOP = object()
+
+
+def sanitize_options(options: Optional[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    """只保留标量类型的生成参数"""
+    if not options:
+        return None
+    return {key: value for key, value in options.items() if isinstance(value, (int, float, str, bool))}
+
+
+def build_record(
+    *,
+    model: str,
+    prompt: str,
+    options: Optional[Dict[str, Any]],
+    stream: bool,
+    received_at: float,
+    duration: float,
+    status: int,
+    outcome: str,
+    include_prompt: bool,
+    ttft: Optional[float] = None,
+    result: Optional[Dict[str, Any]] = None,
+    **extra: Any,
+) -> Dict[str, Any]:
+    """
+    构造一条流量记录。received_at 为请求到达的 Unix 时间，duration / ttft 的单位为秒，
+    result 为 Ollama 返回的结束统计（prompt_eval_count、eval_count 等）。
+    """
+    record: Dict[str, Any] = {
+        "ts": round(received_at, 6),
+        "model": model,
+        "stream": stream,
+        "prompt_sha256": hashlib.sha256(prompt.encode("utf-8")).hexdigest(),
+        "prompt_chars": len(prompt),
+        "options": sanitize_options(options),
+        "status": status,
+        "outcome": outcome,
+        "duration_ms": round(duration * 1000, 3),
+        "ttft_ms": round(ttft * 1000, 3) if ttft is not None else None,
+        "prompt_eval_count": (result or {}).get("prompt_eval_count"),
+        "eval_count": (result or {}).get("eval_count"),
+    }
+    if include_prompt:
+        record["prompt"] = prompt
+    record.update({key: value for key, value in extra.items() if value is not None})
+    return record
+
+
+class TrafficRecorder:
+    """
+    把流量记录异步批量追加到 JSONL 文件。path 为空时不记录。
+
+    写入任务在第一次记录时才启动：记录器在导入 main 时就已创建，那时还没有运行中的事件循环。
+    aclose() 向队列放入停止标记并等待写入任务写完之前的记录后退出，
+    任何时候都只有写入任务一个写者，记录行不会交错。
+    """
+
+    def __init__(
+        self,
+        path: str,
+        include_prompts: bool = False,
+        sample_rate: float = 1.0,
+        batch_size: int = 256,
+        flush_interval: float = 1.0,
+        max_pending: int = 10000,
+    ):
+        self.path = path
+        self.include_prompts = include_prompts
+        self.sample_rate = sample_rate
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue: "asyncio.Queue[Any]" = asyncio.Queue(max_pending)
+        self._task: Optional[asyncio.Task] = None
+        self.written = 0
+        self.dropped = 0
+        self.sampled_out = 0
+        self.write_errors = 0
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.path)
+
+    def record(self, record: Dict[str, Any]) -> None:
+        """放入写入队列，不等待；队列已满时丢弃"""
+        if not self.enabled:
+            return
+        if self.sample_rate < 1.0 and random.random() >= self.sample_rate:
+            self.sampled_out += 1
+            return
+        try:
+            self._queue.put_nowait(record)
+        except asyncio.QueueFull:
+            self.dropped += 1
+            return
+        if self._task is None:
+            self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def _next_batch(self, batch: List[Dict[str, Any]]) -> bool:
+        """
+        等第一条记录，之后最多再等 flush_interval 秒凑满一批，记录追加到 batch；
+        取到停止标记时返回 True。
+        """
+        item = await self._queue.get()
+        if item is _STOP:
+            return True
+        batch.append(item)
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            try:
+                item = self._queue.get_nowait()
+            except asyncio.QueueEmpty:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                # 不用 wait_for：它在取到记录的同时被取消时会吞掉取消
+                getter = asyncio.ensure_future(self._queue.get())
+                try:
+                    done, _ = await asyncio.wait({getter}, timeout=remaining)
+                except asyncio.CancelledError:
+                    getter.cancel()
+                    raise
+                if not done:
+                    getter.cancel()
+                    break
+                item = getter.result()
+            if item is _STOP:
+                return True
+            batch.append(item)
+        return False
+
+    def _write(self, batch: List[Dict[str, Any]]) -> None:
+        data = "".join(json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n" for record in batch)
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(data)
+
+    async def _flush(self, batch: List[Dict[str, Any]]) -> None:
+        try:
+            await asyncio.to_thread(self._write, batch)
+            self.written += len(batch)
+        except OSError as e:
+            self.write_errors += 1
+            self.dropped += len(batch)
+            logger.warning("写入流量记录 %s 失败: %s", self.path, e)
+
+    async def _run(self) -> None:
+        stop = False
+        while not stop:
+            batch: List[Dict[str, Any]] = []
+            stop = await self._next_batch(batch)
+            if batch:
+                await self._flush(batch)
+
+    async def aclose(self) -> None:
+        """等写入任务写完已排队的记录后停止，再写出停止之后才到达的记录"""
+        task, self._task = self._task, None
+        if task is not None and not task.done():
+            await self._queue.put(_STOP)
+        if task is not None:
+            try:
+                await task
+            except Exception as e:
+                logger.warning("流量记录写入任务异常退出: %s", e)
+        # 写入任务已退出，这里是唯一的写者
+        batch = []
+        while not self._queue.empty():
+            item = self._queue.get_nowait()
+            if item is not _STOP:
+                batch.append(item)
+        if batch:
+            await self._flush(batch)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": self.enabled,
+            "path": self.path or None,
+            "include_prompts": self.include_prompts,
+            "sample_rate": self.sample_rate,
+            "pending": self._queue.qsize(),
+            "written": self.written,
+            "dropped": self.dropped,
+            "sampled_out": self.sampled_out,
+            "write_errors": self.write_errors,
+        }
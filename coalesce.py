@@ -0,0 +1,194 @@
+"""
+相同请求的合并。
+
+- SingleFlight：非流式请求在上游调用完成之前共享同一次调用的结果；
+- StreamHub：流式请求共享同一条上游 token 流，后加入的订阅者先回放已输出的前缀。
+
+一批同时到达的相同提示词只会触发一次生成。
+"""
+import asyncio
+import json
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional, Tuple
+
+from streaming import StreamItem
+
+
+class SingleFlight:
+    """
+    按键合并并发调用。
+
+    上游调用在独立的 task 中执行：即使发起调用的请求被取消（例如客户端断开），
+    其他等待者仍能拿到结果。
+    """
+
+    def __init__(self):
+        self._calls: Dict[str, asyncio.Task] = {}
+        self.leaders = 0
+        self.coalesced = 0
+
+    @staticmethod
+    def _consume_exception(task: asyncio.Task) -> None:
+        # 所有等待者都已离开时，避免 "Task exception was never retrieved" 警告
+        if not task.cancelled():
+            task.exception()
+
+    def _forget(self, key: str, task: asyncio.Task) -> None:
+        if self._calls.get(key) is task:
+            del self._calls[key]
+
+    async def do(self, key: str, fn: Callable[[], Awaitable[Any]]) -> Tuple[Any, bool]:
+        """
+        执行或加入键为 key 的调用，返回 (结果, 是否复用了进行中的调用)。
+        调用抛出的异常会原样传给所有等待者。
+        """
+        task = self._calls.get(key)
+        shared = task is not None
+        if shared:
+            self.coalesced += 1
+        else:
+            self.leaders += 1
+            task = asyncio.ensure_future(fn())
+            task.add_done_callback(self._consume_exception)
+            self._calls[key] = task
+            task.add_done_callback(lambda t: self._forget(key, t))
+        return await asyncio.shield(task), shared
+
+    def in_flight(self) -> int:
+        return len(self._calls)
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.leaders + self.coalesced
+        return {
+            "in_flight": len(self._calls),
+            "upstream_calls": self.leaders,
+            "coalesced_requests": self.coalesced,
+            "coalesced_ratio": round(self.coalesced / total, 4) if total else None,
+        }
+
+
+def item_size(item: StreamItem) -> int:
+    """流中一项的字节数：文本按 UTF-8 编码长度，结束事件按序列化后的长度"""
+    if isinstance(item, str):
+        return len(item.encode("utf-8"))
+    return len(json.dumps(item, ensure_ascii=False, separators=(",", ":")).encode("utf-8"))
+
+
+class StreamBroadcast:
+    """一条上游流及其已输出内容的缓冲区"""
+
+    def __init__(self, key: str):
+        self.key = key
+        self.chunks: List[StreamItem] = []
+        self.buffered_bytes = 0
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.subscribers = 0
+        self.task: Optional[asyncio.Task] = None
+        self._changed = asyncio.Event()
+
+    def publish(self, chunk: StreamItem) -> None:
+        self.chunks.append(chunk)
+        self.buffered_bytes += item_size(chunk)
+        self._notify()
+
+    def finish(self, error: Optional[BaseException] = None) -> None:
+        self.done = True
+        self.error = error
+        self._notify()
+
+    def _notify(self) -> None:
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    async def iterate(self) -> AsyncIterator[StreamItem]:
+        """从头回放缓冲区，然后跟随上游输出，直到流结束"""
+        position = 0
+        while True:
+            changed = self._changed
+            while position < len(self.chunks):
+                yield self.chunks[position]
+                position += 1
+            if self.done:
+                if self.error is not None:
+                    raise self.error
+                return
+            await changed.wait()
+
+
+class StreamHub:
+    """
+    按键共享上游流。
+
+    第一个订阅者启动上游流，之后相同键的订阅者加入同一个广播；所有订阅者都离开时
+    取消上游流。缓冲超过 max_replay_bytes 后不再接受新的订阅者，新请求会启动自己的流。
+    """
+
+    def __init__(self, max_replay_bytes: int):
+        self.max_replay_bytes = max_replay_bytes
+        self._broadcasts: Dict[str, StreamBroadcast] = {}
+        self.upstream_streams = 0
+        self.shared_subscribers = 0
+        self.late_joiners = 0
+        self.cancelled_streams = 0
+
+    def _joinable(self, key: str) -> Optional[StreamBroadcast]:
+        broadcast = self._broadcasts.get(key)
+        if broadcast is None or broadcast.done or broadcast.buffered_bytes > self.max_replay_bytes:
+            return None
+        return broadcast
+
+    async def _produce(self, broadcast: StreamBroadcast, producer: Callable[[], AsyncIterator[StreamItem]]) -> None:
+        try:
+            async for chunk in producer():
+                broadcast.publish(chunk)
+        except asyncio.CancelledError:
+            # 上游流被取消时仍在读取的订阅者收到错误条目后正常结束，不把取消传给它们
+            broadcast.publish({"error": "上游流已被取消"})
+            broadcast.finish()
+            raise
+        except Exception as e:
+            broadcast.finish(e)
+        else:
+            broadcast.finish()
+        finally:
+            if self._broadcasts.get(broadcast.key) is broadcast:
+                del self._broadcasts[broadcast.key]
+
+    async def subscribe(
+        self, key: str, producer: Callable[[], AsyncIterator[StreamItem]]
+    ) -> AsyncIterator[StreamItem]:
+        """订阅键为 key 的流，必要时用 producer 启动新的上游流"""
+        broadcast = self._joinable(key)
+        if broadcast is None:
+            broadcast = StreamBroadcast(key)
+            self._broadcasts[key] = broadcast
+            broadcast.task = asyncio.ensure_future(self._produce(broadcast, producer))
+            self.upstream_streams += 1
+        else:
+            self.shared_subscribers += 1
+            if broadcast.chunks:
+                self.late_joiners += 1
+
+        broadcast.subscribers += 1
+        try:
+            async for chunk in broadcast.iterate():
+                yield chunk
+        finally:
+            broadcast.subscribers -= 1
+            if broadcast.subscribers == 0 and not broadcast.done:
+                # 没有人再读取这条流，取消上游生成
+                self.cancelled_streams += 1
+                broadcast.task.cancel()
+                if self._broadcasts.get(key) is broadcast:
+                    del self._broadcasts[key]
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.upstream_streams + self.shared_subscribers
+        return {
+            "active_streams": len(self._broadcasts),
+            "upstream_streams": self.upstream_streams,
+            "shared_subscribers": self.shared_subscribers,
+            "late_joiners": self.late_joiners,
+            "cancelled_streams": self.cancelled_streams,
+            "shared_ratio": round(self.shared_subscribers / total, 4) if total else None,
+        }
@@ -0,0 +1,188 @@
+"""
+服务配置。
+
+所有配置项都可以通过同名环境变量覆盖，未设置时使用下面的默认值。
+"""
+import os
+from typing import Dict, List, Tuple
+
+
+def _env_float(name: str, default: float) -> float:
+    value = os.getenv(name)
+    return float(value) if value else default
+
+
+def _env_int(name: str, default: int) -> int:
+    value = os.getenv(name)
+    return int(value) if value else default
+
+
+def _env_bool(name: str, default: bool) -> bool:
+    value = os.getenv(name)
+    if not value:
+        return default
+    return value.lower() not in ("0", "false", "no", "off")
+
+
+def _parse_backends(value: str) -> List[Tuple[str, float]]:
+    """解析 "http://a:11434=2,http://b:11434" 形式的后端列表，权重默认为 1"""
+    backends = []
+    for item in value.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        url, sep, weight = item.rpartition("=")
+        if sep and url:
+            backends.append((url.rstrip("/"), float(weight)))
+        else:
+            backends.append((item.rstrip("/"), 1.0))
+    return backends
+
+
+def _parse_mapping(value: str) -> Dict[str, str]:
+    """解析 "a=1,b=2" 形式的键值对"""
+    mapping = {}
+    for item in value.split(","):
+        key, sep, val = item.strip().partition("=")
+        if sep and key:
+            mapping[key.strip()] = val.strip()
+    return mapping
+
+
+# Ollama API 基础地址
+OLLAMA_BASE_URL = os.getenv("OLLAMA_BASE_URL", "http://localhost:11434").rstrip("/")
+
+# Ollama 后端列表（带权重），未配置时只使用 OLLAMA_BASE_URL
+OLLAMA_BACKENDS = _parse_backends(os.getenv("OLLAMA_BACKENDS", "")) or [(OLLAMA_BASE_URL, 1.0)]
+
+# /api/generate 的路由策略：round_robin / least_requests / least_tokens
+ROUTING_POLICY = os.getenv("ROUTING_POLICY", "round_robin")
+
+# 是否优先路由到已加载目标模型的后端，以及拉取各后端模型状态的间隔（秒）
+MODEL_AFFINITY = _env_bool("MODEL_AFFINITY", True)
+MODEL_STATE_POLL_INTERVAL = _env_float("MODEL_STATE_POLL_INTERVAL", 10.0)
+# 已加载模型的后端每单位权重的未完成请求数达到该值时，允许溢出到其他后端
+AFFINITY_MAX_OUTSTANDING = _env_float("AFFINITY_MAX_OUTSTANDING", 4.0)
+
+# 准入控制：每个后端 / 每个模型的最大并发上游调用数（0 表示不限制），
+# 等待队列长度上限和最长排队时间（秒）
+ADMISSION_MAX_PER_BACKEND = _env_int("ADMISSION_MAX_PER_BACKEND", 8)
+ADMISSION_MAX_PER_MODEL = _env_int("ADMISSION_MAX_PER_MODEL", 0)
+ADMISSION_MAX_QUEUE = _env_int("ADMISSION_MAX_QUEUE", 256)
+ADMISSION_QUEUE_TIMEOUT = _env_float("ADMISSION_QUEUE_TIMEOUT", 30.0)
+# 排队请求每等待该秒数优先级提升一级，防止低优先级请求饿死
+ADMISSION_AGING_INTERVAL = _env_float("ADMISSION_AGING_INTERVAL", 10.0)
+
+# 每个租户最多排队的请求数（0 表示只受总队列长度限制）
+ADMISSION_MAX_QUEUE_PER_TENANT = _env_int("ADMISSION_MAX_QUEUE_PER_TENANT", 64)
+
+# 租户识别：从该请求头（或 Authorization: Bearer）读取 API key。
+# TENANT_API_KEYS 形如 "sk-abc=chat,sk-def=batch"，把 API key 映射为租户名；
+# 未登记的 key 共用 unregistered 租户，TENANT_PER_UNREGISTERED_KEY 为真时改为各自以哈希前缀
+# 作为租户名（客户端可以轮换 key 获得更多公平份额，只应在可信环境中开启）。
+# TENANT_WEIGHTS 形如 "chat=3,batch=1"。空闲超过 TENANT_IDLE_TTL 秒的租户从统计中移除。
+TENANT_HEADER = os.getenv("TENANT_HEADER", "X-API-Key")
+TENANT_API_KEYS = _parse_mapping(os.getenv("TENANT_API_KEYS", ""))
+TENANT_PER_UNREGISTERED_KEY = _env_bool("TENANT_PER_UNREGISTERED_KEY", False)
+TENANT_WEIGHTS = {name: float(w) for name, w in _parse_mapping(os.getenv("TENANT_WEIGHTS", "")).items()}
+DEFAULT_TENANT_WEIGHT = _env_float("DEFAULT_TENANT_WEIGHT", 1.0)
+TENANT_IDLE_TTL = _env_float("TENANT_IDLE_TTL", 300.0)
+
+# 后台健康探测的间隔，以及连续失败时指数退避的最大间隔（秒）
+HEALTH_PROBE_INTERVAL = _env_float("HEALTH_PROBE_INTERVAL", 5.0)
+HEALTH_PROBE_MAX_BACKOFF = _env_float("HEALTH_PROBE_MAX_BACKOFF", 60.0)
+
+# 估算未完成 token 量时，请求未指定 num_predict 时假设的输出长度
+EXPECTED_OUTPUT_TOKENS = _env_int("EXPECTED_OUTPUT_TOKENS", 256)
+
+# 每个后端的熔断器：连续 CIRCUIT_FAILURE_THRESHOLD 次连接错误 / 5xx / 超时后停止路由到该后端
+# CIRCUIT_OPEN_SECONDS 秒，之后放行一个试探请求；试探失败时熔断时间翻倍，最长 CIRCUIT_MAX_OPEN_SECONDS 秒
+CIRCUIT_BREAKER_ENABLED = _env_bool("CIRCUIT_BREAKER_ENABLED", True)
+CIRCUIT_FAILURE_THRESHOLD = _env_int("CIRCUIT_FAILURE_THRESHOLD", 5)
+CIRCUIT_OPEN_SECONDS = _env_float("CIRCUIT_OPEN_SECONDS", 5.0)
+CIRCUIT_MAX_OPEN_SECONDS = _env_float("CIRCUIT_MAX_OPEN_SECONDS", 60.0)
+
+# 非流式生成的请求对冲：等待超过该模型耗时的 HEDGE_PERCENTILE 分位数（不少于 HEDGE_MIN_DELAY 秒）
+# 仍未返回时，向另一个后端发送相同请求；对冲请求数不超过总请求数的 HEDGE_BUDGET_RATIO 倍
+HEDGE_ENABLED = _env_bool("HEDGE_ENABLED", False)
+HEDGE_PERCENTILE = _env_float("HEDGE_PERCENTILE", 0.95)
+HEDGE_MIN_DELAY = _env_float("HEDGE_MIN_DELAY", 0.5)
+HEDGE_MIN_SAMPLES = _env_int("HEDGE_MIN_SAMPLES", 20)
+HEDGE_BUDGET_RATIO = _env_float("HEDGE_BUDGET_RATIO", 0.05)
+HEDGE_BUDGET_BURST = _env_float("HEDGE_BUDGET_BURST", 10.0)
+
+# 非流式生成结果缓存：默认只缓存 temperature 为 0 或固定 seed 的请求
+RESPONSE_CACHE_ENABLED = _env_bool("RESPONSE_CACHE_ENABLED", True)
+RESPONSE_CACHE_DETERMINISTIC_ONLY = _env_bool("RESPONSE_CACHE_DETERMINISTIC_ONLY", True)
+RESPONSE_CACHE_MAX_ENTRIES = _env_int("RESPONSE_CACHE_MAX_ENTRIES", 1024)
+RESPONSE_CACHE_MAX_BYTES = _env_int("RESPONSE_CACHE_MAX_BYTES", 64 * 1024 * 1024)
+RESPONSE_CACHE_TTL = _env_float("RESPONSE_CACHE_TTL", 3600.0)
+
+# 非流式生成结果的磁盘缓存（SQLite），重启后仍然有效；RESPONSE_DISK_CACHE_PATH 为空时不启用。
+# 启动时把最近访问的 RESPONSE_DISK_CACHE_WARM_ENTRIES 个条目载入内存缓存
+RESPONSE_DISK_CACHE_PATH = os.getenv("RESPONSE_DISK_CACHE_PATH", "")
+RESPONSE_DISK_CACHE_MAX_ENTRIES = _env_int("RESPONSE_DISK_CACHE_MAX_ENTRIES", 100000)
+RESPONSE_DISK_CACHE_MAX_BYTES = _env_int("RESPONSE_DISK_CACHE_MAX_BYTES", 1024 * 1024 * 1024)
+RESPONSE_DISK_CACHE_TTL = _env_float("RESPONSE_DISK_CACHE_TTL", 7 * 24 * 3600.0)
+RESPONSE_DISK_CACHE_WARM_ENTRIES = _env_int("RESPONSE_DISK_CACHE_WARM_ENTRIES", RESPONSE_CACHE_MAX_ENTRIES)
+
+# /api/models 缓存：ttl 内直接返回，之后 stale_ttl 内先返回旧列表并在后台刷新
+MODELS_CACHE_TTL = _env_float("MODELS_CACHE_TTL", 30.0)
+MODELS_CACHE_STALE_TTL = _env_float("MODELS_CACHE_STALE_TTL", 300.0)
+
+# 合并进行中的相同非流式请求，默认只合并确定性请求
+REQUEST_COALESCING_ENABLED = _env_bool("REQUEST_COALESCING_ENABLED", True)
+REQUEST_COALESCING_DETERMINISTIC_ONLY = _env_bool("REQUEST_COALESCING_DETERMINISTIC_ONLY", True)
+
+# 相同的流式请求共享一条上游流；缓冲超过上限后不再接受新的订阅者
+STREAM_FANOUT_ENABLED = _env_bool("STREAM_FANOUT_ENABLED", True)
+STREAM_FANOUT_DETERMINISTIC_ONLY = _env_bool("STREAM_FANOUT_DETERMINISTIC_ONLY", True)
+STREAM_FANOUT_MAX_REPLAY_BYTES = _env_int("STREAM_FANOUT_MAX_REPLAY_BYTES", 1024 * 1024)
+
+# 解析上游流式响应使用的 JSON 解码器：auto / msgspec / orjson / json，未安装时退回 json
+STREAM_JSON_DECODER = os.getenv("STREAM_JSON_DECODER", "auto")
+
+# 流式输出的 token 合并：缓冲达到字节阈值或等待超过时间预算（毫秒）时写出一次，0 表示逐个写出
+STREAM_COALESCE_MS = _env_float("STREAM_COALESCE_MS", 15.0)
+STREAM_COALESCE_BYTES = _env_int("STREAM_COALESCE_BYTES", 1024)
+
+# 为真时 raw 格式的流式响应结束时追加一帧 data: {...}，携带 Ollama 返回的耗时和 token 统计。
+# 默认关闭：直接拼接 raw 响应体的已有客户端会把这一帧当作生成文本（ndjson / sse 格式总是以结束事件收尾）
+STREAM_TIMING_FRAME = _env_bool("STREAM_TIMING_FRAME", False)
+
+# /api/generate 流量记录：TRAFFIC_CAPTURE_PATH 为空时不记录，记录文件可以用 replay.py 重放。
+# 默认只保存 prompt 的哈希和长度；按 TRAFFIC_CAPTURE_SAMPLE_RATE 比例抽样
+TRAFFIC_CAPTURE_PATH = os.getenv("TRAFFIC_CAPTURE_PATH", "")
+TRAFFIC_CAPTURE_PROMPTS = _env_bool("TRAFFIC_CAPTURE_PROMPTS", False)
+TRAFFIC_CAPTURE_SAMPLE_RATE = _env_float("TRAFFIC_CAPTURE_SAMPLE_RATE", 1.0)
+TRAFFIC_CAPTURE_BATCH_SIZE = _env_int("TRAFFIC_CAPTURE_BATCH_SIZE", 256)
+TRAFFIC_CAPTURE_FLUSH_INTERVAL = _env_float("TRAFFIC_CAPTURE_FLUSH_INTERVAL", 1.0)
+TRAFFIC_CAPTURE_MAX_PENDING = _env_int("TRAFFIC_CAPTURE_MAX_PENDING", 10000)
+
+# 指标的 model 标签：后端报告存在或上游成功处理过的模型（后者最多 METRICS_MAX_MODELS 个）
+# 使用自己的名字，其他模型名都记为 other
+METRICS_MAX_MODELS = _env_int("METRICS_MAX_MODELS", 256)
+
+# 上游连接池配置
+UPSTREAM_MAX_CONNECTIONS = _env_int("UPSTREAM_MAX_CONNECTIONS", 100)
+UPSTREAM_MAX_KEEPALIVE_CONNECTIONS = _env_int("UPSTREAM_MAX_KEEPALIVE_CONNECTIONS", 20)
+UPSTREAM_KEEPALIVE_EXPIRY = _env_float("UPSTREAM_KEEPALIVE_EXPIRY", 30.0)
+UPSTREAM_CONNECT_TIMEOUT = _env_float("UPSTREAM_CONNECT_TIMEOUT", 5.0)
+
+# 生成请求的分阶段截止时间（秒），0 表示不限制：
+# 首 token（包含模型加载和提示词处理）、相邻 token 的最大间隔、整个生成的总耗时
+GENERATE_FIRST_TOKEN_TIMEOUT = _env_float("GENERATE_FIRST_TOKEN_TIMEOUT", 120.0)
+GENERATE_INTER_TOKEN_TIMEOUT = _env_float("GENERATE_INTER_TOKEN_TIMEOUT", 30.0)
+GENERATE_TOTAL_TIMEOUT = _env_float("GENERATE_TOTAL_TIMEOUT", 600.0)
+
+# 各类上游调用的超时时间（秒），0 表示不设读写超时（仍受连接超时限制）
+UPSTREAM_TIMEOUTS = {
+    # 非流式生成在完成前收不到任何数据，读超时即总耗时
+    "generate": _env_float("UPSTREAM_TIMEOUT_GENERATE", GENERATE_TOTAL_TIMEOUT),
+    # 流式生成由上面的分阶段截止时间控制
+    "stream": _env_float("UPSTREAM_TIMEOUT_STREAM", 0.0),
+    "health": _env_float("UPSTREAM_TIMEOUT_HEALTH", 5.0),
+    "models": _env_float("UPSTREAM_TIMEOUT_MODELS", 10.0),
+    "version": _env_float("UPSTREAM_TIMEOUT_VERSION", 5.0),
+    "delete": _env_float("UPSTREAM_TIMEOUT_DELETE", 30.0),
+}
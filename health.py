@@ -0,0 +1,173 @@
+"""
+后台健康探测。
+
+按固定间隔探测每个 Ollama 后端，失败时按指数退避拉长探测间隔，并保留最近的延迟历史。
+/health 和 /api/connectivity 直接读取最新的探测结果，不再每次请求都访问上游。
+"""
+import asyncio
+import logging
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Any, Deque, Dict, List, Optional
+
+import httpx
+
+from routing import BackendRegistry
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class ProbeResult:
+    """一次探测的结果"""
+    ok: bool
+    checked_at: float
+    latency_ms: float
+    error: Optional[str] = None
+
+
+@dataclass
+class BackendHealth:
+    """单个后端的健康状态"""
+    url: str
+    last: Optional[ProbeResult] = None
+    consecutive_failures: int = 0
+    next_probe_at: float = 0.0
+    history: Deque[ProbeResult] = field(default_factory=lambda: deque(maxlen=60))
+    # 生成请求在该后端上超时的次数和最近一次的原因
+    stalls: int = 0
+    last_stall: Optional[str] = None
+
+    @property
+    def healthy(self) -> bool:
+        return self.last is not None and self.last.ok
+
+    def to_dict(self) -> Dict[str, Any]:
+        latencies = [r.latency_ms for r in self.history if r.ok]
+        return {
+            "url": self.url,
+            "healthy": self.healthy,
+            "checked_at": self.last.checked_at if self.last else None,
+            "latency_ms": self.last.latency_ms if self.last else None,
+            "error": self.last.error if self.last else None,
+            "consecutive_failures": self.consecutive_failures,
+            "avg_latency_ms": round(sum(latencies) / len(latencies), 2) if latencies else None,
+            "history_ms": [r.latency_ms if r.ok else None for r in self.history],
+            "stalls": self.stalls,
+            "last_stall": self.last_stall,
+        }
+
+
+class HealthProber:
+    """
+    定期探测所有后端的 probe_path。
+
+    成功后下次探测在 interval 秒后；连续失败 n 次后在 min(interval * 2^n, max_backoff) 秒后。
+    """
+
+    def __init__(
+        self,
+        registry: BackendRegistry,
+        pool,
+        interval: float,
+        max_backoff: float,
+        probe_path: str = "/api/version",
+        history_size: int = 60,
+    ):
+        self.registry = registry
+        self.pool = pool
+        self.interval = interval
+        self.max_backoff = max_backoff
+        self.probe_path = probe_path
+        self.states: Dict[str, BackendHealth] = {
+            url: BackendHealth(url=url, history=deque(maxlen=history_size)) for url in registry.urls()
+        }
+        self._task: Optional[asyncio.Task] = None
+        self._wakeup = asyncio.Event()
+
+    def state(self, url: str) -> BackendHealth:
+        return self.states[url]
+
+    async def probe(self, url: str) -> ProbeResult:
+        """立即探测一个后端并更新其状态"""
+        start = time.perf_counter()
+        try:
+            response = await self.pool.get(url, self.probe_path, kind="health")
+            latency_ms = round((time.perf_counter() - start) * 1000, 2)
+            if response.status_code == 200:
+                result = ProbeResult(True, time.time(), latency_ms)
+            else:
+                result = ProbeResult(False, time.time(), latency_ms, f"HTTP {response.status_code}: {response.text}")
+        except httpx.RequestError as e:
+            latency_ms = round((time.perf_counter() - start) * 1000, 2)
+            result = ProbeResult(False, time.time(), latency_ms, f"连接错误: {str(e)}")
+        except Exception as e:
+            latency_ms = round((time.perf_counter() - start) * 1000, 2)
+            result = ProbeResult(False, time.time(), latency_ms, f"未知错误: {str(e)}")
+        self._record(url, result)
+        return result
+
+    def _record(self, url: str, result: ProbeResult) -> None:
+        state = self.states[url]
+        state.last = result
+        state.history.append(result)
+        if result.ok:
+            state.consecutive_failures = 0
+            delay = self.interval
+        else:
+            state.consecutive_failures += 1
+            delay = min(self.interval * 2 ** state.consecutive_failures, self.max_backoff)
+            logger.warning("后端 %s 健康探测失败（连续 %d 次）: %s", url, state.consecutive_failures, result.error)
+        state.next_probe_at = time.monotonic() + delay
+
+    def report_stall(self, url: str, detail: str) -> None:
+        """生成请求在后端上超时：记录下来并立即重新探测该后端"""
+        state = self.states.get(url)
+        if state is None:
+            return
+        state.stalls += 1
+        state.last_stall = detail
+        state.next_probe_at = 0.0
+        logger.warning("后端 %s 生成超时: %s", url, detail)
+        self.wake()
+
+    async def latest(self, url: str, fresh: bool = False) -> BackendHealth:
+        """返回后端的最新状态；尚未探测过或 fresh 为真时先探测一次"""
+        state = self.states[url]
+        if fresh or state.last is None:
+            await self.probe(url)
+        return state
+
+    async def _run(self) -> None:
+        while True:
+            now = time.monotonic()
+            due = [url for url, s in self.states.items() if s.next_probe_at <= now]
+            if due:
+                await asyncio.gather(*(self.probe(url) for url in due))
+            next_at = min(s.next_probe_at for s in self.states.values())
+            self._wakeup.clear()
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=max(next_at - time.monotonic(), 0.01))
+            except asyncio.TimeoutError:
+                pass
+
+    def wake(self) -> None:
+        """让后台任务立即检查是否有到期的探测（例如外部重置了某个后端的 next_probe_at）"""
+        self._wakeup.set()
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def stats(self) -> List[Dict[str, Any]]:
+        return [state.to_dict() for state in self.states.values()]
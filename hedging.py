@@ -0,0 +1,135 @@
+"""
+非流式生成的请求对冲（hedged requests）。
+
+主请求在按延迟分位数计算的等待时间内没有返回时，向另一个后端发送一份相同的请求，
+采用先成功返回的结果并取消另一个。对冲次数受预算限制：每个请求积累 budget_ratio
+个额度，每次对冲消耗一个，因此对冲请求数不会超过总请求数的 budget_ratio 倍（外加 burst）。
+"""
+import asyncio
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple, TypeVar
+
+from routing import normalize_model_name
+from scheduler import LatencyWindow
+
+T = TypeVar("T")
+
+
+class HedgePolicy:
+    """
+    按模型记录非流式生成的耗时，并管理对冲预算。
+
+    样本数少于 min_samples 时不对冲；等待时间为耗时的 percentile 分位数，不小于 min_delay。
+    """
+
+    def __init__(
+        self,
+        percentile: float,
+        min_delay: float,
+        min_samples: int,
+        budget_ratio: float,
+        budget_burst: float,
+        window_size: int = 256,
+    ):
+        self.percentile = percentile
+        self.min_delay = min_delay
+        self.min_samples = min_samples
+        self.budget_ratio = budget_ratio
+        self.budget_burst = budget_burst
+        self.window_size = window_size
+        self._latencies: Dict[str, LatencyWindow] = {}
+        self._credit = budget_burst
+        self.requests = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.budget_exhausted = 0
+        self.no_backend = 0
+
+    def record(self, model: str, seconds: float, hedged: bool = False) -> None:
+        """记录一次请求的耗时；hedged 表示结果来自对冲请求"""
+        if hedged:
+            self.hedge_wins += 1
+        model = normalize_model_name(model)
+        window = self._latencies.get(model)
+        if window is None:
+            window = self._latencies[model] = LatencyWindow(self.window_size)
+        window.add(seconds)
+
+    def delay(self, model: str) -> Optional[float]:
+        """本次请求的对冲等待时间；样本不足时返回 None（不对冲）"""
+        self.requests += 1
+        self._credit = min(self._credit + self.budget_ratio, self.budget_burst)
+        window = self._latencies.get(normalize_model_name(model))
+        if window is None or len(window) < self.min_samples:
+            return None
+        return max(window.percentile(self.percentile), self.min_delay)
+
+    def allow(self) -> bool:
+        """预算是否允许再发一个对冲请求"""
+        if self._credit >= 1:
+            return True
+        self.budget_exhausted += 1
+        return False
+
+    def spend(self) -> None:
+        self._credit -= 1
+        self.hedges += 1
+
+    def record_no_backend(self) -> None:
+        """预算允许但没有其他后端可用，未发出对冲请求"""
+        self.no_backend += 1
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "percentile": self.percentile,
+            "min_delay": self.min_delay,
+            "budget_ratio": self.budget_ratio,
+            "requests": self.requests,
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+            "hedge_ratio": round(self.hedges / self.requests, 4) if self.requests else None,
+            "budget_exhausted": self.budget_exhausted,
+            "no_backend": self.no_backend,
+            "delays": {
+                model: window.percentile(self.percentile)
+                for model, window in self._latencies.items()
+                if len(window) >= self.min_samples
+            },
+        }
+
+
+async def run_hedged(
+    primary: Callable[[], Awaitable[T]],
+    hedge: Callable[[], Optional[Awaitable[T]]],
+    delay: float,
+) -> Tuple[T, bool]:
+    """
+    执行 primary；delay 秒内没有完成时调用 hedge() 发出对冲请求（返回 None 表示不对冲）。
+    返回 (先成功的结果, 是否来自对冲请求)。一方失败时继续等待另一方；
+    都失败时抛出主请求的异常。未完成的一方会被取消。
+    """
+    first = asyncio.ensure_future(primary())
+    try:
+        done, _ = await asyncio.wait({first}, timeout=delay)
+        if done:
+            return first.result(), False
+        second_call = hedge()
+        if second_call is None:
+            return await first, False
+        second = asyncio.ensure_future(second_call)
+    except BaseException:
+        first.cancel()
+        raise
+
+    pending = {first, second}
+    try:
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in (first, second):
+                if task in done and task.exception() is None:
+                    return task.result(), task is second
+        # 两个请求都失败
+        second.exception()
+        return first.result(), False
+    finally:
+        for task in pending:
+            task.cancel()
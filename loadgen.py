@@ -0,0 +1,296 @@
+"""
+/api/generate 的并发负载生成工具。
+
+两种施压方式：
+
+- 闭环（--concurrency N）：N 个并发工作者，每个在上一个请求结束后立即发下一个；
+- 开环（--rate R）：按泊松过程以平均每秒 R 个请求到达，不等待之前的请求结束
+  （--max-in-flight 限制同时进行的请求数，超出的到达记为 dropped），
+  能反映排队造成的延迟，不会像闭环那样在服务变慢时自动降低压力。
+
+流式请求记录首 token 时间（TTFT）、token 间隔和总耗时，非流式请求记录总耗时；
+最后输出 p50/p90/p99/p999、吞吐量和错误率表格，可以用 --json-out 保存为 JSON 用于回归对比：
+
+    python loadgen.py --url http://localhost:8000 --model llama3 --concurrency 32 --requests 500
+    python loadgen.py --rate 20 --duration 60 --no-stream --json-out result.json
+"""
+import argparse
+import asyncio
+import json
+import math
+import random
+import time
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Optional, Sequence
+
+import httpx
+
+PERCENTILES = (("p50", 0.5), ("p90", 0.9), ("p99", 0.99), ("p999", 0.999))
+
+
+@dataclass
+class RequestResult:
+    """单个请求的测量结果，时间单位为秒"""
+    ok: bool
+    status: int = 0
+    error: Optional[str] = None
+    ttft: Optional[float] = None
+    total: float = 0.0
+    gaps: List[float] = field(default_factory=list)
+    tokens: int = 0
+
+
+def percentile(values: Sequence[float], p: float) -> Optional[float]:
+    """已排序序列的 p 分位数（最近秩法）"""
+    if not values:
+        return None
+    index = min(max(math.ceil(p * len(values)) - 1, 0), len(values) - 1)
+    return values[index]
+
+
+def summarize_latency(values: List[float]) -> Optional[Dict[str, float]]:
+    """返回以毫秒为单位的分位数、均值和最大值"""
+    if not values:
+        return None
+    values = sorted(values)
+    summary = {name: percentile(values, p) * 1000 for name, p in PERCENTILES}
+    summary["mean"] = sum(values) / len(values) * 1000
+    summary["max"] = values[-1] * 1000
+    return {key: round(value, 3) for key, value in summary.items()}
+
+
+def summarize(results: List[RequestResult], wall_time: float, dropped: int = 0) -> Dict[str, Any]:
+    """汇总一次压测的结果"""
+    ok = [r for r in results if r.ok]
+    errors: Dict[str, int] = {}
+    for r in results:
+        if not r.ok:
+            errors[r.error or "unknown"] = errors.get(r.error or "unknown", 0) + 1
+    tokens = sum(r.tokens for r in ok)
+    return {
+        "requests": len(results),
+        "succeeded": len(ok),
+        "errors": errors,
+        "error_rate": round((len(results) - len(ok)) / len(results), 4) if results else 0.0,
+        "dropped": dropped,
+        "wall_time_s": round(wall_time, 3),
+        "throughput_rps": round(len(ok) / wall_time, 3) if wall_time > 0 else 0.0,
+        "tokens_per_s": round(tokens / wall_time, 3) if wall_time > 0 else 0.0,
+        "latency_ms": {
+            "total": summarize_latency([r.total for r in ok]),
+            "ttft": summarize_latency([r.ttft for r in ok if r.ttft is not None]),
+            "inter_token": summarize_latency([gap for r in ok for gap in r.gaps]),
+        },
+    }
+
+
+def _classify(error: Exception) -> str:
+    if isinstance(error, httpx.TimeoutException):
+        return "timeout"
+    if isinstance(error, httpx.ConnectError):
+        return "connect"
+    if isinstance(error, httpx.RequestError):
+        return "request_error"
+    return type(error).__name__
+
+
+async def run_one(client: httpx.AsyncClient, payload: Dict[str, Any]) -> RequestResult:
+    """
+    发送一个生成请求并测量耗时。流式请求使用 NDJSON 格式，每行计为一个 token；
+    同一次读取中收到的多行之间的间隔记为 0，与客户端实际观察到的一致。
+    """
+    start = time.perf_counter()
+    try:
+        if not payload.get("stream"):
+            response = await client.post("/api/generate", json=payload)
+            total = time.perf_counter() - start
+            if response.status_code != 200:
+                return RequestResult(False, response.status_code, f"http_{response.status_code}", total=total)
+            data = response.json()
+            return RequestResult(True, 200, total=total, tokens=data.get("eval_count") or 0)
+
+        result = RequestResult(False)
+        last_at = None
+        async with client.stream("POST", "/api/generate", json=dict(payload, stream_format="ndjson")) as response:
+            result.status = response.status_code
+            if response.status_code != 200:
+                await response.aread()
+                result.error = f"http_{response.status_code}"
+                result.total = time.perf_counter() - start
+                return result
+            async for line in response.aiter_lines():
+                if not line.strip():
+                    continue
+                now = time.perf_counter()
+                frame = json.loads(line)
+                if "error" in frame:
+                    result.error = "stream_error"
+                    break
+                if frame.get("done"):
+                    result.ok = True
+                    break
+                if last_at is None:
+                    result.ttft = now - start
+                else:
+                    result.gaps.append(now - last_at)
+                last_at = now
+                result.tokens += 1
+        if not result.ok and result.error is None:
+            result.error = "truncated"
+        result.total = time.perf_counter() - start
+        return result
+    except Exception as e:
+        return RequestResult(False, error=_classify(e), total=time.perf_counter() - start)
+
+
+PayloadFactory = Callable[[int], Dict[str, Any]]
+
+
+async def run_closed_loop(
+    client: httpx.AsyncClient,
+    make_payload: PayloadFactory,
+    concurrency: int,
+    requests: Optional[int] = None,
+    duration: Optional[float] = None,
+) -> Dict[str, Any]:
+    """concurrency 个工作者循环发送请求，直到发满 requests 个或超过 duration 秒"""
+    results: List[RequestResult] = []
+    issued = 0
+    start = time.perf_counter()
+    deadline = start + duration if duration else None
+
+    async def worker() -> None:
+        nonlocal issued
+        while (requests is None or issued < requests) and (deadline is None or time.perf_counter() < deadline):
+            index = issued
+            issued += 1
+            results.append(await run_one(client, make_payload(index)))
+
+    await asyncio.gather(*(worker() for _ in range(max(concurrency, 1))))
+    return summarize(results, time.perf_counter() - start)
+
+
+async def run_open_loop(
+    client: httpx.AsyncClient,
+    make_payload: PayloadFactory,
+    rate: float,
+    requests: Optional[int] = None,
+    duration: Optional[float] = None,
+    max_in_flight: int = 1024,
+    seed: Optional[int] = None,
+) -> Dict[str, Any]:
+    """按平均每秒 rate 个的泊松到达发送请求，到达时间不受之前请求的影响"""
+    rng = random.Random(seed)
+    results: List[RequestResult] = []
+    tasks = set()
+    dropped = 0
+    index = 0
+    start = time.perf_counter()
+    next_at = start
+
+    async def fire(i: int) -> None:
+        results.append(await run_one(client, make_payload(i)))
+
+    while (requests is None or index < requests) and (duration is None or next_at - start < duration):
+        delay = next_at - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+        if len(tasks) >= max_in_flight:
+            dropped += 1
+        else:
+            task = asyncio.ensure_future(fire(index))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        index += 1
+        next_at += rng.expovariate(rate)
+    if tasks:
+        await asyncio.gather(*tasks)
+    return summarize(results, time.perf_counter() - start, dropped)
+
+
+def format_table(summary: Dict[str, Any]) -> str:
+    """把汇总结果格式化为文本表格"""
+    lines = [
+        f"requests: {summary['requests']}  succeeded: {summary['succeeded']}  "
+        f"error rate: {summary['error_rate']:.2%}  dropped: {summary['dropped']}",
+        f"throughput: {summary['throughput_rps']:.2f} req/s  {summary['tokens_per_s']:.1f} tokens/s  "
+        f"wall time: {summary['wall_time_s']:.2f}s",
+    ]
+    if summary["errors"]:
+        lines.append("errors: " + ", ".join(f"{name}={count}" for name, count in sorted(summary["errors"].items())))
+    columns = ["p50", "p90", "p99", "p999", "mean", "max"]
+    lines.append(f"{'latency (ms)':<14}" + "".join(f"{name:>10}" for name in columns))
+    for name, stats in summary["latency_ms"].items():
+        if stats:
+            lines.append(f"{name:<14}" + "".join(f"{stats[c]:>10.1f}" for c in columns))
+    return "\n".join(lines)
+
+
+def load_prompts(path: Optional[str], default: str) -> List[str]:
+    if not path:
+        return [default]
+    with open(path, encoding="utf-8") as f:
+        prompts = [line.rstrip("\n") for line in f if line.strip()]
+    return prompts or [default]
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", default="http://localhost:8000", help="代理服务地址")
+    parser.add_argument("--model", default="llama3")
+    parser.add_argument("--prompt", default="你好，请说一句话")
+    parser.add_argument("--prompts-file", help="每行一个 prompt，按顺序循环使用")
+    parser.add_argument("--stream", action=argparse.BooleanOptionalAction, default=True)
+    parser.add_argument("--num-predict", type=int, help="options.num_predict")
+    parser.add_argument("--priority", help="请求的 priority 字段")
+    parser.add_argument("--concurrency", type=int, default=8, help="闭环模式的并发数")
+    parser.add_argument("--rate", type=float, help="开环模式的平均到达速率（请求/秒），设置后忽略 --concurrency")
+    parser.add_argument("--max-in-flight", type=int, default=1024, help="开环模式同时进行的最大请求数")
+    parser.add_argument("--requests", type=int, help="总请求数")
+    parser.add_argument("--duration", type=float, help="压测时长（秒），与 --requests 都未设置时默认 30 秒")
+    parser.add_argument("--warmup", type=int, default=0, help="正式计时前先发送的请求数（不计入结果）")
+    parser.add_argument("--timeout", type=float, default=600.0)
+    parser.add_argument("--seed", type=int)
+    parser.add_argument("--json-out", help="把汇总结果写入 JSON 文件")
+    args = parser.parse_args()
+
+    duration = args.duration if args.duration or args.requests else 30.0
+    prompts = load_prompts(args.prompts_file, args.prompt)
+
+    def make_payload(index: int) -> Dict[str, Any]:
+        payload: Dict[str, Any] = {"model": args.model, "prompt": prompts[index % len(prompts)], "stream": args.stream}
+        if args.num_predict:
+            payload["options"] = {"num_predict": args.num_predict}
+        if args.priority:
+            payload["priority"] = args.priority
+        return payload
+
+    concurrency = args.concurrency if args.rate is None else args.max_in_flight
+    limits = httpx.Limits(max_connections=concurrency, max_keepalive_connections=concurrency)
+    async with httpx.AsyncClient(base_url=args.url, timeout=args.timeout, limits=limits) as client:
+        for i in range(args.warmup):
+            await run_one(client, make_payload(i))
+        if args.rate is not None:
+            summary = await run_open_loop(
+                client, make_payload, args.rate, args.requests, duration, args.max_in_flight, args.seed,
+            )
+        else:
+            summary = await run_closed_loop(client, make_payload, args.concurrency, args.requests, duration)
+
+    summary["config"] = {
+        "url": args.url,
+        "model": args.model,
+        "stream": args.stream,
+        "mode": "open" if args.rate is not None else "closed",
+        "concurrency": args.concurrency if args.rate is None else None,
+        "rate": args.rate,
+        "num_predict": args.num_predict,
+    }
+    print(format_table(summary))
+    if args.json_out:
+        with open(args.json_out, "w", encoding="utf-8") as f:
+            json.dump(summary, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,23 +1,61 @@
+import asyncio
 import httpx
 import uvicorn
-from fastapi import FastAPI, HTTPException
-from fastapi.responses import StreamingResponse
-import json
-from pydantic import BaseModel
-from typing import List, Optional,AsyncGenerator
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, HTTPException, Request, Response
+from fastapi.responses import PlainTextResponse
+from pydantic import BaseModel, Field, PrivateAttr
+from typing import Any, Dict, List, Literal, Optional, Tuple,AsyncGenerator
 import time
+import hashlib
+
+import config
+from breaker import CIRCUIT_STATE_VALUES, BreakerRegistry
+from cache import DiskResponseCache, RefreshingCache, ResponseCache, is_deterministic, make_cache_key
+from capture import TrafficRecorder, build_record
+from coalesce import SingleFlight, StreamHub
+from health import HealthProber
+from hedging import HedgePolicy, run_hedged
+import metrics
+from ndjson import iter_ndjson_lines, make_decoder
+from routing import BackendRegistry, ModelStatePoller, Router, estimate_tokens, make_policy, normalize_model_name
+from scheduler import DEFAULT_PRIORITY, DEFAULT_TENANT, PRIORITIES, UNREGISTERED_TENANT, Admission, AdmissionController, AdmissionRejected
+from streaming import CancellableStreamingResponse, StreamItem, coalesce_tokens, make_format
+from upstream import StreamDeadlines, StreamTimeout, StreamTruncated, UpstreamPool
 
 # 定义请求体模型
 class OllamaRequest(BaseModel):
     model: str
     prompt: str
     stream: bool = False # Ollama API 支持流式响应，这里默认为非流式
+    options: Optional[Dict[str, Any]] = None # 透传给 Ollama 的生成参数，如 temperature、seed
+    priority: Optional[Literal["high", "normal", "low"]] = None # 排队时的优先级，未设置时读取 X-Priority 请求头
+    coalesce_ms: Optional[float] = Field(default=None, ge=0) # 流式输出合并 token 的时间预算（毫秒），0 表示逐个输出
+    coalesce_bytes: Optional[int] = Field(default=None, ge=1) # 流式输出合并 token 的字节阈值
+    stream_format: Optional[Literal["raw", "ndjson", "sse"]] = None # 流式输出格式，未设置时按 Accept 请求头选择，默认 raw
+    _tenant: str = PrivateAttr(default=DEFAULT_TENANT) # 由 API key 请求头识别出的租户，不接受客户端直接指定
+
+# Ollama 在非流式响应和流式最后一帧中返回的耗时（纳秒）和 token 统计
+TIMING_FIELDS = (
+    "total_duration",
+    "load_duration",
+    "prompt_eval_count",
+    "prompt_eval_duration",
+    "eval_count",
+    "eval_duration",
+)
 
 # 定义响应体模型 (简化版，只包含响应文本)
 class OllamaResponse(BaseModel):
     model: str
     response: str
     done: bool
+    total_duration: Optional[int] = None # 以下字段直接转发 Ollama 的统计，耗时单位为纳秒
+    load_duration: Optional[int] = None
+    prompt_eval_count: Optional[int] = None
+    prompt_eval_duration: Optional[int] = None
+    eval_count: Optional[int] = None
+    eval_duration: Optional[int] = None
 
 # 健康检查响应模型
 class HealthResponse(BaseModel):
@@ -25,6 +63,8 @@ class HealthResponse(BaseModel):
     timestamp: str
     ollama_connected: bool
     ollama_url: str
+    backends_total: Optional[int] = None
+    backends_healthy: Optional[int] = None
 
 # Ollama 连通性测试响应模型
 class OllamaConnectivityResponse(BaseModel):
@@ -32,6 +72,7 @@ class OllamaConnectivityResponse(BaseModel):
     ollama_url: str
     response_time_ms: Optional[float] = None
     error_message: Optional[str] = None
+    checked_at: Optional[str] = None # 该结果的探测时间
 
 # 模型信息模型
 class ModelInfo(BaseModel):
@@ -49,212 +90,721 @@ class StreamChunk(BaseModel):
     response: str
     done: bool
 
+# Ollama 后端注册表和 /api/generate 的路由器
+backend_registry = BackendRegistry(config.OLLAMA_BACKENDS)
+router = Router(
+    backend_registry,
+    make_policy(config.ROUTING_POLICY),
+    model_affinity=config.MODEL_AFFINITY,
+    affinity_max_outstanding=config.AFFINITY_MAX_OUTSTANDING,
+)
+
+# 每个后端的熔断器，熔断的后端不参与 /api/generate 的路由
+circuit_breakers = BreakerRegistry(
+    backend_registry.urls(),
+    failure_threshold=config.CIRCUIT_FAILURE_THRESHOLD,
+    open_seconds=config.CIRCUIT_OPEN_SECONDS,
+    max_open_seconds=config.CIRCUIT_MAX_OPEN_SECONDS,
+)
+
+# 上游调用的准入控制：限制每个后端、每个模型的并发数，超出的请求排队等待
+admission_controller = AdmissionController(
+    router,
+    max_per_backend=config.ADMISSION_MAX_PER_BACKEND,
+    max_per_model=config.ADMISSION_MAX_PER_MODEL,
+    max_queue=config.ADMISSION_MAX_QUEUE,
+    queue_timeout=config.ADMISSION_QUEUE_TIMEOUT,
+    aging_interval=config.ADMISSION_AGING_INTERVAL,
+    tenant_weights=config.TENANT_WEIGHTS,
+    default_tenant_weight=config.DEFAULT_TENANT_WEIGHT,
+    max_queue_per_tenant=config.ADMISSION_MAX_QUEUE_PER_TENANT,
+    tenant_idle_ttl=config.TENANT_IDLE_TTL,
+    breakers=circuit_breakers if config.CIRCUIT_BREAKER_ENABLED else None,
+)
+
+OLLAMA_BASE_URL = backend_registry.primary.url  # 主 Ollama 后端地址，用于管理类接口
+OLLAMA_API_URL = f"{OLLAMA_BASE_URL}/api/generate" # Ollama API 的 generate 端点
+
+# 所有处理函数共享的上游连接池
+upstream_pool = UpstreamPool(
+    max_connections=config.UPSTREAM_MAX_CONNECTIONS,
+    max_keepalive_connections=config.UPSTREAM_MAX_KEEPALIVE_CONNECTIONS,
+    keepalive_expiry=config.UPSTREAM_KEEPALIVE_EXPIRY,
+    connect_timeout=config.UPSTREAM_CONNECT_TIMEOUT,
+    timeouts=config.UPSTREAM_TIMEOUTS,
+)
+
+# 非流式生成结果的精确匹配缓存
+response_cache = ResponseCache(
+    max_entries=config.RESPONSE_CACHE_MAX_ENTRIES,
+    max_bytes=config.RESPONSE_CACHE_MAX_BYTES,
+    ttl=config.RESPONSE_CACHE_TTL,
+)
+
+# 内存缓存之后的磁盘缓存层（RESPONSE_DISK_CACHE_PATH 为空时不启用）
+response_disk_cache = DiskResponseCache(
+    config.RESPONSE_DISK_CACHE_PATH,
+    max_entries=config.RESPONSE_DISK_CACHE_MAX_ENTRIES,
+    max_bytes=config.RESPONSE_DISK_CACHE_MAX_BYTES,
+    ttl=config.RESPONSE_DISK_CACHE_TTL,
+)
+
+# 合并进行中的相同非流式请求
+generate_flights = SingleFlight()
+
+# 相同的流式请求共享一条上游流
+stream_hub = StreamHub(max_replay_bytes=config.STREAM_FANOUT_MAX_REPLAY_BYTES)
+
+# /api/generate 流量记录（TRAFFIC_CAPTURE_PATH 为空时不记录）
+traffic_recorder = TrafficRecorder(
+    config.TRAFFIC_CAPTURE_PATH,
+    include_prompts=config.TRAFFIC_CAPTURE_PROMPTS,
+    sample_rate=config.TRAFFIC_CAPTURE_SAMPLE_RATE,
+    batch_size=config.TRAFFIC_CAPTURE_BATCH_SIZE,
+    flush_interval=config.TRAFFIC_CAPTURE_FLUSH_INTERVAL,
+    max_pending=config.TRAFFIC_CAPTURE_MAX_PENDING,
+)
+
+# 非流式生成的请求对冲
+hedge_policy = HedgePolicy(
+    percentile=config.HEDGE_PERCENTILE,
+    min_delay=config.HEDGE_MIN_DELAY,
+    min_samples=config.HEDGE_MIN_SAMPLES,
+    budget_ratio=config.HEDGE_BUDGET_RATIO,
+    budget_burst=config.HEDGE_BUDGET_BURST,
+)
+
+# 解析上游流式响应的解码器
+stream_decoder = make_decoder(config.STREAM_JSON_DECODER)
+
+# 后台健康探测，/health 和 /api/connectivity 读取其最新结果
+health_prober = HealthProber(
+    backend_registry,
+    upstream_pool,
+    interval=config.HEALTH_PROBE_INTERVAL,
+    max_backoff=config.HEALTH_PROBE_MAX_BACKOFF,
+)
+
+# 后台拉取各后端已加载/可用的模型，供模型亲和路由使用
+# 指标的 model 标签只使用已知的模型名
+model_labels = metrics.ModelLabels(
+    lambda model: any(backend.has_available(model) for backend in backend_registry.all()),
+    config.METRICS_MAX_MODELS,
+)
+model_state_poller = ModelStatePoller(backend_registry, upstream_pool, config.MODEL_STATE_POLL_INTERVAL)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    应用生命周期：启动时创建上游连接和后台任务，关闭时释放。
+    """
+    for url in backend_registry.urls():
+        upstream_pool.client(url)
+    await warm_response_cache()
+    health_prober.start()
+    if config.MODEL_AFFINITY:
+        model_state_poller.start()
+    yield
+    await model_state_poller.stop()
+    await health_prober.stop()
+    await traffic_recorder.aclose()
+    await response_disk_cache.aclose()
+    await upstream_pool.aclose()
+
+async def warm_response_cache() -> None:
+    """
+    用磁盘缓存中最近访问的条目预热内存缓存，剩余有效期不超过内存缓存的 ttl。
+    """
+    entries = await response_disk_cache.load_recent(config.RESPONSE_DISK_CACHE_WARM_ENTRIES)
+    now = time.time()
+    # 从最久未访问的开始放入，保持内存缓存的 LRU 顺序
+    for entry in reversed(entries):
+        response_cache.set(entry.key, entry.model, entry.value, ttl=min(entry.expires_at - now, config.RESPONSE_CACHE_TTL))
+
 app = FastAPI(
     title="Ollama FastAPI Server",
     description="一个使用 FastAPI 与 Ollama 模型进行交互的 API 服务器。",
     version="0.1.0",
+    lifespan=lifespan,
 )
 
-OLLAMA_API_URL = "http://localhost:11434/api/generate" # Ollama API 的 generate 端点
-OLLAMA_BASE_URL = "http://localhost:11434"  # Ollama API 基础地址
+def build_payload(request: OllamaRequest, stream: bool) -> Dict[str, Any]:
+    """
+    构造发送给 Ollama /api/generate 的请求体。
+    """
+    payload = {
+        "model": request.model,
+        "prompt": request.prompt,
+        "stream": stream,
+    }
+    if request.options:
+        payload["options"] = request.options
+    return payload
+
+def admission_http_error(e: AdmissionRejected) -> HTTPException:
+    """
+    将准入拒绝转换为带 Retry-After 的 HTTP 错误。
+    """
+    return HTTPException(status_code=e.status_code, detail=e.detail, headers={"Retry-After": str(e.retry_after)})
+
+async def acquire_admission(request: OllamaRequest) -> Admission:
+    """
+    等待上游调用名额。
+    """
+    admission = await admission_controller.acquire(
+        request.model,
+        estimate_tokens(request.prompt, expected_output_tokens(request)),
+        priority=request.priority or DEFAULT_PRIORITY,
+        tenant=request._tenant,
+    )
+    metrics.QUEUE_WAIT.observe(admission.queue_wait, admission.priority)
+    return admission
+
+def extract_timings(ollama_data: Dict[str, Any]) -> Dict[str, int]:
+    """
+    取出 Ollama 响应中的耗时和 token 统计，缺失的字段不返回。
+    """
+    return {name: ollama_data[name] for name in TIMING_FIELDS if ollama_data.get(name) is not None}
+
+def server_timing_header(timings: Dict[str, Any]) -> Optional[str]:
+    """
+    将 Ollama 的耗时（纳秒）转换为 Server-Timing 响应头（毫秒）。
+    """
+    entries = []
+    for name, field in (("load", "load_duration"), ("prompt_eval", "prompt_eval_duration"),
+                        ("eval", "eval_duration"), ("total", "total_duration")):
+        if timings.get(field) is not None:
+            entries.append(f"{name};dur={timings[field] / 1e6:.3f}")
+    return ", ".join(entries) or None
+
+# 生成超时的阶段名称
+TIMEOUT_PHASES = {"first_token": "首 token", "inter_token": "token 间隔", "total": "总耗时"}
+
+def expected_output_tokens(request: OllamaRequest) -> int:
+    """
+    预计的输出 token 数：优先使用请求的 num_predict。
+    """
+    num_predict = (request.options or {}).get("num_predict")
+    if isinstance(num_predict, int) and num_predict > 0:
+        return num_predict
+    return config.EXPECTED_OUTPUT_TOKENS
+
+def observe_tokens_per_second(model: str, backend_url: str, ollama_data: Dict[str, Any]) -> None:
+    """
+    根据 Ollama 返回的 eval_count / eval_duration（纳秒）记录生成速度。
+    """
+    eval_count = ollama_data.get("eval_count")
+    eval_duration = ollama_data.get("eval_duration")
+    if eval_count and eval_duration:
+        metrics.TOKENS_PER_SECOND.observe(eval_count / (eval_duration / 1e9), model, backend_url)
+
+def resolve_tenant(http_request: Request) -> str:
+    """
+    根据 API key 识别租户：已登记的 key 映射为配置的租户名，其他 key 共用 unregistered 租户
+    （TENANT_PER_UNREGISTERED_KEY 开启时使用 key 的哈希前缀，避免在统计中暴露 key），
+    没有 key 时为 anonymous。
+    """
+    api_key = http_request.headers.get(config.TENANT_HEADER)
+    if not api_key:
+        authorization = http_request.headers.get("authorization", "")
+        if authorization.lower().startswith("bearer "):
+            api_key = authorization[7:].strip()
+    if not api_key:
+        return DEFAULT_TENANT
+    tenant = config.TENANT_API_KEYS.get(api_key)
+    if tenant:
+        return tenant
+    if not config.TENANT_PER_UNREGISTERED_KEY:
+        return UNREGISTERED_TENANT
+    return "key-" + hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:12]
+
+def resolve_priority(request: OllamaRequest, http_request: Request) -> str:
+    """
+    请求体中的 priority 优先，其次是 X-Priority 请求头，默认为 normal。
+    """
+    if request.priority:
+        return request.priority
+    header = http_request.headers.get("x-priority")
+    if header is None:
+        return DEFAULT_PRIORITY
+    priority = header.strip().lower()
+    if priority not in PRIORITIES:
+        raise HTTPException(
+            status_code=400,
+            detail=f"无效的优先级: {header}，可选值: {', '.join(PRIORITIES)}",
+        )
+    return priority
+
+def resolve_stream_format(request: OllamaRequest, http_request: Request) -> str:
+    """
+    请求体中的 stream_format 优先，其次按 Accept 请求头：
+    text/event-stream 为 sse，application/x-ndjson 为 ndjson，其他为 raw。
+    """
+    if request.stream_format:
+        return request.stream_format
+    accept = http_request.headers.get("accept", "")
+    if "text/event-stream" in accept:
+        return "sse"
+    if "application/x-ndjson" in accept:
+        return "ndjson"
+    return "raw"
+
+def cache_bypassed(http_request: Request) -> bool:
+    """
+    请求头 X-Cache-Bypass 为真值，或 Cache-Control 含 no-cache / no-store 时跳过缓存读取。
+    """
+    if http_request.headers.get("x-cache-bypass", "").lower() in ("1", "true", "yes"):
+        return True
+    cache_control = http_request.headers.get("cache-control", "").lower()
+    return "no-cache" in cache_control or "no-store" in cache_control
 
 @app.post("/api/generate", response_model=OllamaResponse)
-async def generate_text(request: OllamaRequest):
+async def generate_text(request: OllamaRequest, http_request: Request, http_response: Response):
     """
     接收用户请求，调用 Ollama 服务生成文本。
     支持流式和非流式响应。
     """
+    request.priority = resolve_priority(request, http_request)
+    request._tenant = resolve_tenant(http_request)
+    received_at, start = time.time(), time.perf_counter()
     if request.stream:
         """
         流式响应处理
         """
-        return StreamingResponse(
-            stream_ollama_response(request),
-            media_type="text/plain; charset=utf-8",
+        # 流式响应一旦开始就无法再返回错误状态码，因此先检查等待队列是否已满
+        try:
+            admission_controller.check(request._tenant)
+        except AdmissionRejected as e:
+            capture_traffic(request, received_at, start, e.status_code, "rejected")
+            raise admission_http_error(e)
+        stream_format = make_format(resolve_stream_format(request, http_request), config.STREAM_TIMING_FRAME)
+        coalesce_ms = config.STREAM_COALESCE_MS if request.coalesce_ms is None else request.coalesce_ms
+        coalesce_bytes = request.coalesce_bytes or config.STREAM_COALESCE_BYTES
+        items = shared_stream(request)
+        if traffic_recorder.enabled:
+            items = captured_stream(request, items, received_at, start, stream_format.name)
+        return CancellableStreamingResponse(
+            coalesce_tokens(items, stream_format, coalesce_bytes, coalesce_ms / 1000),
+            media_type=stream_format.media_type,
+            headers=stream_format.headers,
             )
     else:
+        try:
+            result = await generate_cached(request, http_request, http_response)
+        except HTTPException as e:
+            capture_traffic(request, received_at, start, e.status_code, "error")
+            raise
+        capture_traffic(
+            request, received_at, start, 200, "ok",
+            result=result.model_dump(), cache=http_response.headers.get("X-Cache"),
+        )
+        # 缓存命中时没有发生生成，不附带当时的耗时
+        if http_response.headers.get("X-Cache") != "HIT":
+            server_timing = server_timing_header(result.model_dump())
+            if server_timing:
+                http_response.headers["Server-Timing"] = server_timing
+        return result
+
+def capture_traffic(
+    request: OllamaRequest,
+    received_at: float,
+    start: float,
+    status: int,
+    outcome: str,
+    **fields: Any,
+) -> None:
+    """
+    记录一次 /api/generate 调用（未开启流量记录时不做任何事）。
+    """
+    if not traffic_recorder.enabled:
+        return
+    traffic_recorder.record(build_record(
+        model=request.model,
+        prompt=request.prompt,
+        options=request.options,
+        stream=request.stream,
+        received_at=received_at,
+        duration=time.perf_counter() - start,
+        status=status,
+        outcome=outcome,
+        include_prompt=traffic_recorder.include_prompts,
+        priority=request.priority,
+        tenant=request._tenant,
+        **fields,
+    ))
+
+async def captured_stream(
+    request: OllamaRequest,
+    items: AsyncGenerator[StreamItem, None],
+    received_at: float,
+    start: float,
+    stream_format: str,
+) -> AsyncGenerator[StreamItem, None]:
+    """
+    透传流式条目，结束（包括客户端断开）时记录首 token 时间和结束统计。
+    """
+    ttft = None
+    final: Optional[Dict[str, Any]] = None
+    try:
+        async for item in items:
+            if isinstance(item, str):
+                if ttft is None:
+                    ttft = time.perf_counter() - start
+            else:
+                final = item
+            yield item
+    finally:
+        if final is None:
+            outcome = "cancelled"
+        else:
+            outcome = "error" if "error" in final else "ok"
+        capture_traffic(
+            request, received_at, start, 200, outcome,
+            ttft=ttft, result=final if outcome == "ok" else None, stream_format=stream_format,
+        )
+
+async def generate_cached(request: OllamaRequest, http_request: Request, http_response: Response) -> OllamaResponse:
+    """
+    带精确匹配缓存和请求合并的非流式生成。
+    内存缓存未命中时再查磁盘缓存，命中后放回内存缓存。
+    响应头 X-Cache 标明 HIT / MISS / BYPASS（命中时 X-Cache-Tier 标明 memory / disk），
+    复用进行中请求时带 X-Coalesced: 1。
+    """
+    deterministic = is_deterministic(request.options)
+    use_cache = config.RESPONSE_CACHE_ENABLED and (deterministic or not config.RESPONSE_CACHE_DETERMINISTIC_ONLY)
+    use_coalescing = config.REQUEST_COALESCING_ENABLED and (deterministic or not config.REQUEST_COALESCING_DETERMINISTIC_ONLY)
+    if not use_cache and not use_coalescing:
         return await generate_text_non_stream(request)
-    
 
-async def stream_ollama_response(request: OllamaRequest) -> AsyncGenerator[str, None]:
-    payload = {
-        "model": request.model,
-        "prompt": request.prompt,
-        "stream": True  # 设置为 True 以启用流式响应
-    }
+    key = make_cache_key(request.model, request.prompt, request.options)
+    bypass = cache_bypassed(http_request)
+    if use_cache and not bypass:
+        cached = response_cache.get(key)
+        tier = "memory"
+        if cached is None and response_disk_cache.enabled:
+            entry = await response_disk_cache.get(key)
+            if entry is not None:
+                cached, tier = entry.value, "disk"
+                response_cache.set(key, request.model, cached, ttl=min(entry.expires_at - time.time(), config.RESPONSE_CACHE_TTL))
+        if cached is not None:
+            http_response.headers["X-Cache"] = "HIT"
+            http_response.headers["X-Cache-Tier"] = tier
+            return OllamaResponse(**cached)
+
+    # 在请求上游之前取得失效代数，生成期间模型被删除时不把结果写入磁盘层
+    disk_generation = response_disk_cache.generation(request.model)
+    shared = False
+    if use_coalescing:
+        result, shared = await generate_flights.do(key, lambda: generate_text_non_stream(request))
+        if shared:
+            http_response.headers["X-Coalesced"] = "1"
+    else:
+        result = await generate_text_non_stream(request)
+
+    if use_cache:
+        # 复用进行中调用的请求拿到的是同一个结果，只由发起调用的请求写入缓存
+        if not shared and "no-store" not in http_request.headers.get("cache-control", "").lower():
+            value = result.model_dump()
+            response_cache.set(key, request.model, value)
+            response_disk_cache.set_nowait(key, request.model, value, disk_generation)
+        http_response.headers["X-Cache"] = "BYPASS" if bypass else "MISS"
+    return result
+
+def shared_stream(request: OllamaRequest) -> AsyncGenerator[StreamItem, None]:
+    """
+    相同的确定性流式请求共享一条上游流，后加入的客户端先收到已输出的内容。
+    """
+    if config.STREAM_FANOUT_ENABLED and (is_deterministic(request.options) or not config.STREAM_FANOUT_DETERMINISTIC_ONLY):
+        key = make_cache_key(request.model, request.prompt, request.options)
+        return stream_hub.subscribe(key, lambda: stream_ollama_response(request))
+    return stream_ollama_response(request)
+
+async def stream_ollama_response(request: OllamaRequest) -> AsyncGenerator[StreamItem, None]:
+    """
+    从上游读取流式生成结果：输出 token 文本，最后输出一个结束或错误事件（dict），
+    由各客户端选择的输出格式负责编码。
+    """
+    payload = build_payload(request, stream=True)
+    model = normalize_model_name(request.model)
+    label = model_labels.label(model)
+    backend_url = ""
     try:
-        async with httpx.AsyncClient(timeout=60.0) as client:
-            async with client.stream("POST", OLLAMA_API_URL, json=payload) as response:
-                response.raise_for_status()
+        admission = await acquire_admission(request)
+        backend_url = admission.backend.url
+        metrics.REQUESTS.inc(label, backend_url, "stream")
+        start = time.perf_counter()
+        first_token_at = last_token_at = None
+        token_chunks = 0
+        final_chunk = None
+        deadlines = StreamDeadlines(
+            config.GENERATE_FIRST_TOKEN_TIMEOUT,
+            config.GENERATE_INTER_TOKEN_TIMEOUT,
+            config.GENERATE_TOTAL_TIMEOUT,
+        )
+        try:
+            with circuit_breakers.guard(backend_url):
+                async with deadlines, upstream_pool.stream("POST", backend_url, "/api/generate", kind="stream", json=payload) as response:
+                    response.raise_for_status()
                 
-                async for line in response.aiter_lines():
-                    if line.strip():
+                    async for line in iter_ndjson_lines(response.aiter_bytes()):
                         try:
-                            # 解析每一行的 JSON 数据
-                            chunk_data = json.loads(line)
-                            
-                            # 提取响应文本
-                            chunk_text = chunk_data.get("response", "")
-                            is_done = chunk_data.get("done", False)
-                            
-                            # 发送文本块
-                            if chunk_text:
-                                yield chunk_text
-                            
-                            # 如果完成，退出循环
-                            if is_done:
-                                break
-                                
-                        except json.JSONDecodeError:
+                            # 只解码每一帧的文本和结束标记
+                            chunk_text, is_done, done_data = stream_decoder.decode(line)
+                        except ValueError:
                             # 跳过无法解析的行
                             continue
+                    
+                        # 发送文本块
+                        if chunk_text:
+                            now = time.perf_counter()
+                            if first_token_at is None:
+                                first_token_at = now
+                                label = model_labels.confirm(model)
+                                metrics.TIME_TO_FIRST_TOKEN.observe(now - start, label, backend_url)
+                            else:
+                                metrics.INTER_TOKEN_LATENCY.observe(now - last_token_at, label, backend_url)
+                            last_token_at = now
+                            token_chunks += 1
+                            # 下游消费 token 的时间不计入 token 间隔
+                            deadlines.suspend()
+                            yield chunk_text
+                            deadlines.resume()
+                    
+                        # 如果完成，退出循环
+                        if is_done:
+                            final_chunk = done_data
+                            break
+                if final_chunk is None:
+                    # 在熔断器的上下文内抛出，按后端故障计数
+                    raise StreamTruncated()
+        except (asyncio.CancelledError, GeneratorExit):
+            # 客户端已离开：退出 async with 时关闭上游连接，Ollama 随之中止生成
+            if final_chunk is None:
+                metrics.STREAM_CANCELLED.inc(label, backend_url)
+                metrics.STREAM_TOKENS_SAVED.inc(label, backend_url, amount=max(expected_output_tokens(request) - token_chunks, 0))
+            raise
+        finally:
+            admission.release()
+        metrics.REQUEST_DURATION.observe(time.perf_counter() - start, label, backend_url, "stream")
+        if final_chunk.get("eval_duration"):
+            observe_tokens_per_second(label, backend_url, final_chunk)
+        elif token_chunks > 1:
+            # 上游没有返回计时信息时，按收到的文本块估算
+            metrics.TOKENS_PER_SECOND.observe((token_chunks - 1) / max(last_token_at - first_token_at, 1e-6), label, backend_url)
+        # 响应头早已发出，统计信息以结束事件的形式发送
+        yield {"done": True, "model": final_chunk.get("model", request.model), **extract_timings(final_chunk)}
                             
+    except AdmissionRejected as e:
+        metrics.ERRORS.inc(label, backend_url, "stream", "rejected")
+        yield {"error": e.detail}
+    except StreamTruncated:
+        metrics.ERRORS.inc(label, backend_url, "stream", "truncated")
+        yield {"error": "Ollama 流式响应在完成前结束"}
+    except StreamTimeout as e:
+        metrics.ERRORS.inc(label, backend_url, "stream", f"timeout_{e.phase}")
+        error_msg = f"Ollama 生成超时（{TIMEOUT_PHASES[e.phase]}）: 超过 {e.limit:g} 秒"
+        health_prober.report_stall(backend_url, error_msg)
+        yield {"error": error_msg}
     except httpx.HTTPStatusError as e:
+        metrics.ERRORS.inc(label, backend_url, "stream", f"http_{e.response.status_code}")
         error_msg = f"Ollama 服务错误: {e.response.status_code}"
-        yield f"data: {json.dumps({'error': error_msg})}\n\n"
+        yield {"error": error_msg}
     except httpx.RequestError as e:
+        metrics.ERRORS.inc(label, backend_url, "stream", "request_error")
         error_msg = f"连接 Ollama 服务失败: {str(e)}"
-        yield f"data: {json.dumps({'error': error_msg})}\n\n"
+        yield {"error": error_msg}
     except Exception as e:
+        metrics.ERRORS.inc(label, backend_url, "stream", "internal")
         error_msg = f"内部错误: {str(e)}"
-        yield f"data: {json.dumps({'error': error_msg})}\n\n"
+        yield {"error": error_msg}
         
+async def post_generate(admission: Admission, payload: Dict[str, Any]) -> httpx.Response:
+    """
+    向已准入的后端发送非流式生成请求，结束后归还名额。
+    """
+    try:
+        with circuit_breakers.guard(admission.backend.url):
+            response = await upstream_pool.post(admission.backend.url, "/api/generate", kind="generate", json=payload)
+            response.raise_for_status()
+    finally:
+        admission.release()
+    return response
+
+async def post_generate_from(admission: Admission, payload: Dict[str, Any]) -> Tuple[httpx.Response, str]:
+    return await post_generate(admission, payload), admission.backend.url
+
+def start_hedge(request: OllamaRequest, primary: Admission, payload: Dict[str, Any]):
+    """
+    在预算允许且另一个后端有空闲名额时发出对冲请求，否则返回 None。
+    """
+    if not hedge_policy.allow():
+        return None
+    admission = admission_controller.try_acquire(
+        primary.model, primary.tokens, primary.priority, primary.tenant, exclude=primary.backend
+    )
+    if admission is None:
+        hedge_policy.record_no_backend()
+        return None
+    hedge_policy.spend()
+    metrics.REQUESTS.inc(model_labels.label(admission.model), admission.backend.url, "hedge")
+    return post_generate_from(admission, payload)
+
 async def generate_text_non_stream(request: OllamaRequest) -> OllamaResponse:
     """
     非流式响应处理（原有逻辑）
     """
-    payload = {
-        "model": request.model,
-        "prompt": request.prompt,
-        "stream": False,
-    }
+    payload = build_payload(request, stream=False)
+    model = normalize_model_name(request.model)
+    label = model_labels.label(model)
 
-    async with httpx.AsyncClient(timeout=60.0) as client:
-        try:
-            response = await client.post(OLLAMA_API_URL, json=payload)
-            response.raise_for_status()
-            
-            ollama_data = response.json()
-            
-            if "model" not in ollama_data or "response" not in ollama_data or "done" not in ollama_data:
-                raise HTTPException(status_code=500, detail="从 Ollama 收到的响应格式不正确")
-
-            return OllamaResponse(
-                model=ollama_data.get("model", request.model),
-                response=ollama_data.get("response", ""),
-                done=ollama_data.get("done", False)
+    try:
+        admission = await acquire_admission(request)
+    except AdmissionRejected as e:
+        metrics.ERRORS.inc(label, "", "non_stream", "rejected")
+        raise admission_http_error(e)
+
+    backend_url = admission.backend.url
+    metrics.REQUESTS.inc(label, backend_url, "non_stream")
+    start = time.perf_counter()
+    try:
+        delay = hedge_policy.delay(model) if config.HEDGE_ENABLED and len(backend_registry.all()) > 1 else None
+        hedged = False
+        if delay is None:
+            response = await post_generate(admission, payload)
+        else:
+            (response, backend_url), hedged = await run_hedged(
+                lambda: post_generate_from(admission, payload),
+                lambda: start_hedge(request, admission, payload),
+                delay,
             )
-        except httpx.HTTPStatusError as e:
-            error_detail = f"请求 Ollama 服务失败: {e.response.status_code} - {e.response.text}"
-            if e.response.status_code == 404:
-                error_detail = f"Ollama 模型 '{request.model}' 未找到或 Ollama API 端点 '{OLLAMA_API_URL}' 不存在。"
-            elif e.response.status_code == 400:
-                error_detail = f"向 Ollama 服务发送的请求无效: {e.response.text}"
-            raise HTTPException(status_code=e.response.status_code, detail=error_detail)
-        except httpx.RequestError as e:
-            raise HTTPException(status_code=503, detail=f"无法连接到 Ollama 服务: {e}")
-        except Exception as e:
-            raise HTTPException(status_code=500, detail=f"处理请求时发生内部错误: {str(e)}")
+        hedge_policy.record(model, time.perf_counter() - start, hedged)
+        label = model_labels.confirm(model)
+        metrics.REQUEST_DURATION.observe(time.perf_counter() - start, label, backend_url, "non_stream")
+        
+        ollama_data = response.json()
+        
+        if "model" not in ollama_data or "response" not in ollama_data or "done" not in ollama_data:
+            raise HTTPException(status_code=500, detail="从 Ollama 收到的响应格式不正确")
+        observe_tokens_per_second(label, backend_url, ollama_data)
+
+        return OllamaResponse(
+            model=ollama_data.get("model", request.model),
+            response=ollama_data.get("response", ""),
+            done=ollama_data.get("done", False),
+            **extract_timings(ollama_data),
+        )
+    except httpx.HTTPStatusError as e:
+        metrics.ERRORS.inc(label, backend_url, "non_stream", f"http_{e.response.status_code}")
+        error_detail = f"请求 Ollama 服务失败: {e.response.status_code} - {e.response.text}"
+        if e.response.status_code == 404:
+            error_detail = f"Ollama 模型 '{request.model}' 未找到或 Ollama API 端点 '{backend_url}/api/generate' 不存在。"
+        elif e.response.status_code == 400:
+            error_detail = f"向 Ollama 服务发送的请求无效: {e.response.text}"
+        raise HTTPException(status_code=e.response.status_code, detail=error_detail)
+    except httpx.ReadTimeout:
+        # 非流式生成完成前收不到任何数据，读超时即生成总耗时超限
+        metrics.ERRORS.inc(label, backend_url, "non_stream", "timeout_total")
+        error_detail = f"Ollama 生成超时（{TIMEOUT_PHASES['total']}）: 超过 {upstream_pool.timeout('generate').read:g} 秒"
+        health_prober.report_stall(backend_url, error_detail)
+        raise HTTPException(status_code=504, detail=error_detail)
+    except httpx.RequestError as e:
+        metrics.ERRORS.inc(label, backend_url, "non_stream", "request_error")
+        raise HTTPException(status_code=503, detail=f"无法连接到 Ollama 服务: {e}")
+    except Exception as e:
+        metrics.ERRORS.inc(label, backend_url, "non_stream", "internal")
+        raise HTTPException(status_code=500, detail=f"处理请求时发生内部错误: {str(e)}")
+
 
 
 
+def format_checked_at(checked_at: Optional[float]) -> Optional[str]:
+    if checked_at is None:
+        return None
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(checked_at))
 
 @app.get("/health", response_model=HealthResponse)
-async def health_check():
+async def health_check(fresh: bool = False):
     """
-    健康检查接口，检查服务状态和 Ollama 连接状态。
+    健康检查接口，返回服务状态和后台探测到的 Ollama 连接状态。
+    fresh=1 时先立即探测一次。
     """
     timestamp = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime())
-    ollama_connected = False
-    
-    # 检查 Ollama 连通性
-    try:
-        async with httpx.AsyncClient(timeout=5.0) as client:
-            response = await client.get(f"{OLLAMA_BASE_URL}/api/tags")
-            if response.status_code == 200:
-                ollama_connected = True
-    except:
-        ollama_connected = False
+    if fresh:
+        await asyncio.gather(*(health_prober.probe(url) for url in backend_registry.urls()))
+    state = await health_prober.latest(OLLAMA_BASE_URL)
     
     return HealthResponse(
         status="healthy",
         timestamp=timestamp,
-        ollama_connected=ollama_connected,
-        ollama_url=OLLAMA_BASE_URL
+        ollama_connected=state.healthy,
+        ollama_url=OLLAMA_BASE_URL,
+        backends_total=len(health_prober.states),
+        backends_healthy=sum(1 for s in health_prober.states.values() if s.healthy),
     )
 
 @app.get("/api/connectivity", response_model=OllamaConnectivityResponse)
-async def test_ollama_connectivity():
+async def test_ollama_connectivity(fresh: bool = False):
+    """
+    测试与 Ollama 服务的连通性，返回后台最近一次探测的结果。
+    fresh=1 时先立即探测一次。
+    """
+    state = await health_prober.latest(OLLAMA_BASE_URL, fresh=fresh)
+    return OllamaConnectivityResponse(
+        connected=state.healthy,
+        ollama_url=OLLAMA_BASE_URL,
+        response_time_ms=state.last.latency_ms,
+        error_message=state.last.error,
+        checked_at=format_checked_at(state.last.checked_at),
+    )
+
+@app.get("/api/health/backends")
+async def get_backend_health():
     """
-    测试与 Ollama 服务的连通性。
+    获取每个后端的健康状态、连续失败次数和最近的探测延迟历史。
     """
-    start_time = time.time()
+    return health_prober.stats()
+
+async def load_models_body() -> bytes:
+    """
+    从 Ollama 拉取模型列表并序列化为 JSON 响应体，由 models_cache 在每次刷新时调用。
+    """
+    response = await upstream_pool.get(OLLAMA_BASE_URL, "/api/tags", kind="models")
+    response.raise_for_status()
     
-    try:
-        async with httpx.AsyncClient(timeout=10.0) as client:
-            response = await client.get(f"{OLLAMA_BASE_URL}/api/tags")
-            end_time = time.time()
-            response_time_ms = (end_time - start_time) * 1000
-            
-            if response.status_code == 200:
-                return OllamaConnectivityResponse(
-                    connected=True,
-                    ollama_url=OLLAMA_BASE_URL,
-                    response_time_ms=round(response_time_ms, 2)
-                )
-            else:
-                return OllamaConnectivityResponse(
-                    connected=False,
-                    ollama_url=OLLAMA_BASE_URL,
-                    response_time_ms=round(response_time_ms, 2),
-                    error_message=f"HTTP {response.status_code}: {response.text}"
-                )
-    except httpx.RequestError as e:
-        end_time = time.time()
-        response_time_ms = (end_time - start_time) * 1000
-        return OllamaConnectivityResponse(
-            connected=False,
-            ollama_url=OLLAMA_BASE_URL,
-            response_time_ms=round(response_time_ms, 2),
-            error_message=f"连接错误: {str(e)}"
-        )
-    except Exception as e:
-        end_time = time.time()
-        response_time_ms = (end_time - start_time) * 1000
-        return OllamaConnectivityResponse(
-            connected=False,
-            ollama_url=OLLAMA_BASE_URL,
-            response_time_ms=round(response_time_ms, 2),
-            error_message=f"未知错误: {str(e)}"
-        )
+    ollama_data = response.json()
+    models = []
+    
+    # 解析 Ollama 返回的模型信息
+    if "models" in ollama_data:
+        for model_data in ollama_data["models"]:
+            size = model_data.get("size", None)
+            model_info = ModelInfo(
+                name=model_data.get("name", "unknown"),
+                size=str(size) if size is not None else None,
+                modified=model_data.get("modified_at", None)
+            )
+            models.append(model_info)
+    
+    return ModelsResponse(
+        models=models,
+        count=len(models)
+    ).model_dump_json().encode("utf-8")
+
+# 模型列表缓存：过期后先返回旧列表并在后台刷新
+models_cache = RefreshingCache(
+    load_models_body,
+    ttl=config.MODELS_CACHE_TTL,
+    stale_ttl=config.MODELS_CACHE_STALE_TTL,
+)
 
 @app.get("/api/models", response_model=ModelsResponse)
-async def get_available_models():
+async def get_available_models(http_request: Request):
     """
     获取 Ollama 中可用的模型列表。
+    响应带 ETag，客户端携带匹配的 If-None-Match 时返回 304。
     """
     try:
-        async with httpx.AsyncClient(timeout=10.0) as client:
-            response = await client.get(f"{OLLAMA_BASE_URL}/api/tags")
-            response.raise_for_status()
-            
-            ollama_data = response.json()
-            models = []
-            
-            # 解析 Ollama 返回的模型信息
-            if "models" in ollama_data:
-                for model_data in ollama_data["models"]:
-                    model_info = ModelInfo(
-                        name=model_data.get("name", "unknown"),
-                        size=model_data.get("size", None),
-                        modified=model_data.get("modified_at", None)
-                    )
-                    models.append(model_info)
-            
-            return ModelsResponse(
-                models=models,
-                count=len(models)
-            )
+        snapshot = await models_cache.get()
     except httpx.HTTPStatusError as e:
         raise HTTPException(
             status_code=e.response.status_code,
@@ -271,16 +821,21 @@ async def get_available_models():
             detail=f"获取模型列表时发生内部错误: {str(e)}"
         )
 
+    headers = {"ETag": snapshot.etag, "Cache-Control": f"max-age={int(config.MODELS_CACHE_TTL)}"}
+    if_none_match = http_request.headers.get("if-none-match")
+    if if_none_match and (if_none_match.strip() == "*" or snapshot.etag in [t.strip() for t in if_none_match.split(",")]):
+        return Response(status_code=304, headers=headers)
+    return Response(content=snapshot.body, media_type="application/json", headers=headers)
+
 @app.get("/api/version")
 async def get_ollama_version():
     """
     获取 Ollama 服务的版本信息。
     """
     try:
-        async with httpx.AsyncClient(timeout=5.0) as client:
-            response = await client.get(f"{OLLAMA_BASE_URL}/api/version")
-            response.raise_for_status()
-            return response.json()
+        response = await upstream_pool.get(OLLAMA_BASE_URL, "/api/version", kind="version")
+        response.raise_for_status()
+        return response.json()
     except httpx.HTTPStatusError as e:
         raise HTTPException(
             status_code=e.response.status_code,
@@ -300,14 +855,17 @@ async def get_ollama_version():
 @app.delete("/api/model/{model_name}")
 async def delete_model(model_name: str):
     """
-    删除指定的模型。
+    删除指定的模型。与其他管理类接口一样只作用于主后端，其他后端上的模型保留。
     """
     try:
-        async with httpx.AsyncClient(timeout=30.0) as client:
-            payload = {"name": model_name}
-            response = await client.delete(f"{OLLAMA_BASE_URL}/api/delete", json=payload)
-            response.raise_for_status()
-            return {"message": f"模型 '{model_name}' 删除成功"}
+        payload = {"name": model_name}
+        response = await upstream_pool.delete(OLLAMA_BASE_URL, "/api/delete", kind="delete", json=payload)
+        response.raise_for_status()
+        backend_registry.forget_model(model_name, OLLAMA_BASE_URL)
+        response_cache.invalidate_model(model_name)
+        await response_disk_cache.invalidate_model(model_name)
+        models_cache.invalidate()
+        return {"message": f"模型 '{model_name}' 删除成功"}
     except httpx.HTTPStatusError as e:
         if e.response.status_code == 404:
             raise HTTPException(
@@ -329,6 +887,145 @@ async def delete_model(model_name: str):
             detail=f"删除模型时发生内部错误: {str(e)}"
         )
 
+@app.get("/api/backends")
+async def get_backends():
+    """
+    获取 Ollama 后端列表、路由策略、各后端的实时负载和熔断状态。
+    """
+    return {
+        **router.stats(),
+        "circuit_breaker_enabled": config.CIRCUIT_BREAKER_ENABLED,
+        "circuit_breakers": circuit_breakers.stats(),
+    }
+
+@app.get("/api/admission/stats")
+async def get_admission_stats():
+    """
+    获取准入控制的排队、拒绝和排队等待时间统计。
+    """
+    return admission_controller.stats()
+
+@app.get("/api/cache/stats")
+async def get_cache_stats():
+    """
+    获取响应缓存和模型列表缓存的命中率和容量统计。
+    """
+    return {
+        "responses": response_cache.stats(),
+        "responses_disk": response_disk_cache.stats(),
+        "models": models_cache.stats(),
+    }
+
+@app.get("/api/capture/stats")
+async def get_capture_stats():
+    """
+    获取流量记录的写入、丢弃和抽样统计。
+    """
+    return traffic_recorder.stats()
+
+@app.get("/api/coalescing/stats")
+async def get_coalescing_stats():
+    """
+    获取非流式请求合并和流式共享的统计。
+    """
+    return {
+        "non_stream": generate_flights.stats(),
+        "stream": stream_hub.stats(),
+    }
+
+@app.get("/api/hedging/stats")
+async def get_hedging_stats():
+    """
+    获取请求对冲的次数、胜出次数、预算消耗和各模型的对冲等待时间。
+    """
+    return dict(hedge_policy.stats(), enabled=config.HEDGE_ENABLED)
+
+@app.get("/api/upstream/stats")
+async def get_upstream_stats():
+    """
+    获取上游连接池的配置和连接复用统计。
+    """
+    return upstream_pool.stats()
+
+def cache_lookups() -> Dict[str, Dict[str, int]]:
+    lookups = {
+        "responses": {"hits": response_cache.hits, "misses": response_cache.misses},
+        "models": {"hits": models_cache.hits + models_cache.stale_hits, "misses": models_cache.misses},
+    }
+    if response_disk_cache.enabled:
+        lookups["responses_disk"] = {"hits": response_disk_cache.hits, "misses": response_disk_cache.misses}
+    return lookups
+
+def cache_hit_ratios() -> Dict[tuple, float]:
+    ratios = {}
+    for name, lookups in cache_lookups().items():
+        total = lookups["hits"] + lookups["misses"]
+        if total:
+            ratios[(name,)] = lookups["hits"] / total
+    return ratios
+
+# 以下指标在抓取时从各模块已有的状态读取，请求路径上没有额外开销
+metrics.REGISTRY.gauge(
+    "ollama_proxy_backend_in_flight", "各后端正在处理的上游请求数", ("backend",),
+    collect=lambda: {(b.url,): b.outstanding_requests for b in backend_registry.all()},
+)
+metrics.REGISTRY.gauge(
+    "ollama_proxy_backend_outstanding_tokens", "各后端正在处理的预估 token 数", ("backend",),
+    collect=lambda: {(b.url,): b.outstanding_tokens for b in backend_registry.all()},
+)
+metrics.REGISTRY.gauge(
+    "ollama_proxy_backend_healthy", "后台健康探测的最新结果（1 为健康）", ("backend",),
+    collect=lambda: {(url,): int(state.healthy) for url, state in health_prober.states.items()},
+)
+metrics.REGISTRY.gauge(
+    "ollama_proxy_model_in_flight", "各模型正在处理的上游请求数", ("model",),
+    collect=lambda: {(model,): count for model, count in admission_controller.model_in_flight.items()},
+)
+metrics.REGISTRY.gauge(
+    "ollama_proxy_queue_length", "准入等待队列中的请求数",
+    collect=lambda: {(): len(admission_controller.queue)},
+)
+metrics.REGISTRY.counter(
+    "ollama_proxy_admission_rejections", "准入拒绝次数", ("reason",),
+    collect=lambda: {
+        ("queue_full",): admission_controller.rejected_queue_full,
+        ("timeout",): admission_controller.rejected_timeout,
+        ("circuit_open",): admission_controller.rejected_circuit_open,
+    },
+)
+metrics.REGISTRY.gauge(
+    "ollama_proxy_backend_circuit_state", "各后端的熔断状态（0 关闭，1 半开，2 熔断）", ("backend",),
+    collect=lambda: {
+        (breaker["url"],): CIRCUIT_STATE_VALUES[breaker["state"]] for breaker in circuit_breakers.stats()
+    },
+)
+metrics.REGISTRY.gauge(
+    "ollama_proxy_active_streams", "正在进行的共享上游流数",
+    collect=lambda: {(): stream_hub.stats()["active_streams"]},
+)
+metrics.REGISTRY.counter(
+    "ollama_proxy_coalesced_requests", "复用进行中上游调用的请求数", ("mode",),
+    collect=lambda: {("non_stream",): generate_flights.coalesced, ("stream",): stream_hub.shared_subscribers},
+)
+metrics.REGISTRY.counter(
+    "ollama_proxy_cache_hits", "缓存命中次数", ("cache",),
+    collect=lambda: {(name,): lookups["hits"] for name, lookups in cache_lookups().items()},
+)
+metrics.REGISTRY.counter(
+    "ollama_proxy_cache_misses", "缓存未命中次数", ("cache",),
+    collect=lambda: {(name,): lookups["misses"] for name, lookups in cache_lookups().items()},
+)
+metrics.REGISTRY.gauge(
+    "ollama_proxy_cache_hit_ratio", "缓存命中率", ("cache",), collect=cache_hit_ratios,
+)
+
+@app.get("/metrics", response_class=PlainTextResponse)
+async def get_metrics():
+    """
+    以 Prometheus 文本格式导出请求量、错误、延迟分布和运行时状态。
+    """
+    return PlainTextResponse(metrics.REGISTRY.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
+
 @app.get("/")
 async def read_root():
     return {"message": "欢迎使用 Ollama FastAPI 服务器!"}
@@ -0,0 +1,233 @@
+"""
+Prometheus 文本格式的指标。
+
+所有指标都只在事件循环线程中更新，计数直接累加到字典中的数值上，不需要加锁；
+直方图使用固定分桶，记录一次观测只需一次二分查找。
+运行时状态（在途请求数、缓存命中率等）通过采集回调在抓取时读取，不占用请求路径。
+"""
+import math
+from bisect import bisect_left
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Set, Tuple
+
+LabelValues = Tuple[str, ...]
+Sample = Tuple[str, Dict[str, str], float]
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(labels: Dict[str, str]) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(str(v))}"' for k, v in labels.items()) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+Collector = Callable[[], Dict[LabelValues, float]]
+
+
+class Metric:
+    type = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+
+    def _labels(self, values: LabelValues) -> Dict[str, str]:
+        return dict(zip(self.labelnames, values))
+
+    def samples(self) -> Iterable[Sample]:
+        raise NotImplementedError
+
+
+class Counter(Metric):
+    """
+    单调递增的计数器。
+
+    传入 collect 时在抓取时调用它获取 {标签值元组: 数值}，用于导出已有模块自己维护的计数。
+    """
+    type = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), collect: Optional[Collector] = None):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[LabelValues, float] = {}
+        self._collect = collect
+
+    def inc(self, *labels: str, amount: float = 1.0) -> None:
+        self._values[labels] = self._values.get(labels, 0.0) + amount
+
+    def value(self, *labels: str) -> float:
+        return self._values.get(labels, 0.0)
+
+    def samples(self) -> Iterable[Sample]:
+        values = self._collect() if self._collect is not None else self._values
+        for labels, value in values.items():
+            yield self.name + "_total", self._labels(labels), value
+
+
+class Gauge(Metric):
+    """
+    可增可减的数值。
+
+    传入 collect 时在抓取时读取现有的运行时状态（在途请求数、队列长度等）。
+    """
+    type = "gauge"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        collect: Optional[Collector] = None,
+    ):
+        super().__init__(name, documentation, labelnames)
+        self._values: Dict[LabelValues, float] = {}
+        self._collect = collect
+
+    def set(self, value: float, *labels: str) -> None:
+        self._values[labels] = value
+
+    def inc(self, *labels: str, amount: float = 1.0) -> None:
+        self._values[labels] = self._values.get(labels, 0.0) + amount
+
+    def dec(self, *labels: str, amount: float = 1.0) -> None:
+        self._values[labels] = self._values.get(labels, 0.0) - amount
+
+    def samples(self) -> Iterable[Sample]:
+        values = self._collect() if self._collect is not None else self._values
+        for labels, value in values.items():
+            yield self.name, self._labels(labels), value
+
+
+class Histogram(Metric):
+    """固定分桶的直方图"""
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str], buckets: Sequence[float]):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # 每个标签组合：[各分桶计数（最后一个为 +Inf）, 总和, 总数]
+        self._series: Dict[LabelValues, List] = {}
+
+    def observe(self, value: float, *labels: str) -> None:
+        series = self._series.get(labels)
+        if series is None:
+            series = self._series[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    def count(self, *labels: str) -> int:
+        series = self._series.get(labels)
+        return series[2] if series else 0
+
+    def samples(self) -> Iterable[Sample]:
+        for labels, (counts, total, count) in self._series.items():
+            base = self._labels(labels)
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (math.inf,), counts):
+                cumulative += bucket_count
+                yield self.name + "_bucket", dict(base, le=_format_value(bound)), cumulative
+            yield self.name + "_sum", base, total
+            yield self.name + "_count", base, count
+
+
+class ModelLabels:
+    """
+    把客户端请求中的模型名转换为 model 标签，防止随意的模型名产生无限多的时间序列。
+
+    is_known 认可的模型（后端报告存在的模型）和上游成功响应过的模型（最多 max_confirmed 个）
+    使用自己的名字，其余都记为 other。
+    """
+    OTHER = "other"
+
+    def __init__(self, is_known: Callable[[str], bool], max_confirmed: int = 256):
+        self.is_known = is_known
+        self.max_confirmed = max_confirmed
+        self._confirmed: Set[str] = set()
+
+    def label(self, model: str) -> str:
+        if model in self._confirmed or self.is_known(model):
+            return model
+        return self.OTHER
+
+    def confirm(self, model: str) -> str:
+        """上游成功处理了该模型的请求，返回此后使用的标签"""
+        if model not in self._confirmed and len(self._confirmed) < self.max_confirmed:
+            self._confirmed.add(model)
+        return self.label(model)
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = (), collect: Optional[Collector] = None) -> Counter:
+        return self.register(Counter(name, documentation, labelnames, collect))
+
+    def gauge(self, name: str, documentation: str, labelnames: Sequence[str] = (), collect: Optional[Collector] = None) -> Gauge:
+        return self.register(Gauge(name, documentation, labelnames, collect))
+
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str], buckets: Sequence[float]) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self) -> str:
+        """输出 Prometheus 文本格式（0.0.4）"""
+        lines = []
+        for metric in self._metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{_format_labels(labels)} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+TOKEN_GAP_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.02, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+TOKENS_PER_SECOND_BUCKETS = (1, 5, 10, 20, 30, 50, 75, 100, 150, 200, 400)
+
+REGISTRY = MetricsRegistry()
+
+REQUESTS = REGISTRY.counter(
+    "ollama_proxy_requests", "按模型、后端和模式统计的 /api/generate 上游请求数", ("model", "backend", "mode")
+)
+ERRORS = REGISTRY.counter(
+    "ollama_proxy_errors", "按类型统计的 /api/generate 错误数", ("model", "backend", "mode", "type")
+)
+QUEUE_WAIT = REGISTRY.histogram(
+    "ollama_proxy_queue_wait_seconds", "准入排队等待时间", ("priority",), LATENCY_BUCKETS
+)
+TIME_TO_FIRST_TOKEN = REGISTRY.histogram(
+    "ollama_proxy_time_to_first_token_seconds", "流式请求从发往上游到收到第一个 token 的时间", ("model", "backend"), LATENCY_BUCKETS
+)
+INTER_TOKEN_LATENCY = REGISTRY.histogram(
+    "ollama_proxy_inter_token_seconds", "流式输出中相邻 token 的间隔", ("model", "backend"), TOKEN_GAP_BUCKETS
+)
+REQUEST_DURATION = REGISTRY.histogram(
+    "ollama_proxy_request_duration_seconds", "上游生成的总耗时", ("model", "backend", "mode"), LATENCY_BUCKETS
+)
+TOKENS_PER_SECOND = REGISTRY.histogram(
+    "ollama_proxy_tokens_per_second", "生成速度（token/秒）", ("model", "backend"), TOKENS_PER_SECOND_BUCKETS
+)
+STREAM_WRITE_PARTS = REGISTRY.histogram(
+    "ollama_proxy_stream_write_parts", "流式响应每次写入合并的文本块数", (), (1, 2, 4, 8, 16, 32, 64, 128)
+)
+STREAM_CANCELLED = REGISTRY.counter(
+    "ollama_proxy_stream_cancelled", "客户端离开后提前中止的上游流式生成数", ("model", "backend")
+)
+STREAM_TOKENS_SAVED = REGISTRY.counter(
+    "ollama_proxy_stream_tokens_saved", "提前中止生成节省的 token 数（按 num_predict 或预期输出长度估算）", ("model", "backend")
+)
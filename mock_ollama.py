@@ -0,0 +1,376 @@
+"""
+模拟的 Ollama 服务，用于在没有 GPU 的环境中做负载和延迟测试。
+
+实现代理会调用的 /api/generate（流式和非流式）、/api/tags、/api/ps、/api/version
+和 /api/delete，响应格式与 Ollama 相同。可以配置：
+
+- 模型加载耗时：模型未加载（或 keep_alive 过期）时第一个请求等待 load_delay 秒；
+- 生成速度：prompt_delay 秒后开始按 tokens_per_second 输出，每个 token 的间隔按 jitter 随机抖动；
+- 错误注入：error_rate 比例的请求直接返回 error_status，truncate_rate 比例的流式响应在中途断开；
+- 并行槽位：每个模型最多 num_parallel 个请求同时生成，其余排队，
+  排队数超过 max_queue 时返回 503（与 OLLAMA_NUM_PARALLEL / OLLAMA_MAX_QUEUE 的行为一致）。
+
+既可以作为 ASGI 应用在进程内使用（配合 httpx.ASGITransport 或 UpstreamPool 的 transport_factory），
+也可以独立运行：
+
+    python mock_ollama.py --port 11434 --tokens-per-second 50 --load-delay 2 --num-parallel 4
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import random
+import time
+from dataclasses import dataclass, field
+from datetime import datetime, timedelta, timezone
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, Response, StreamingResponse
+from starlette.types import Receive, Scope, Send
+
+# 生成文本时循环使用的词表
+WORDS = ("the", "quick", "brown", "fox", "jumps", "over", "lazy", "dog", "你好", "世界")
+
+
+@dataclass
+class MockSettings:
+    """模拟服务的行为参数，时间单位为秒"""
+    models: List[str] = field(default_factory=lambda: ["llama3:latest", "qwen2:7b"])
+    load_delay: float = 0.0
+    keep_alive: float = 300.0
+    prompt_delay: float = 0.0
+    tokens_per_second: float = 0.0  # 0 表示不限速
+    jitter: float = 0.0  # 每个 token 间隔的随机抖动比例
+    output_tokens: int = 32  # 请求未指定 options.num_predict 时的输出 token 数
+    error_rate: float = 0.0
+    error_status: int = 500
+    truncate_rate: float = 0.0
+    num_parallel: int = 0  # 每个模型的并行槽位，0 表示不限制
+    max_queue: int = 512
+    seed: Optional[int] = None
+
+
+@dataclass
+class MockStats:
+    """模拟服务的请求统计，测试和基准测试用来核对代理的行为"""
+    requests: int = 0
+    active: int = 0
+    peak_active: int = 0
+    queued: int = 0
+    loads: int = 0
+    completed: int = 0
+    cancelled: int = 0
+    injected_errors: int = 0
+    rejected_busy: int = 0
+    tokens: int = 0
+
+    def to_dict(self) -> Dict[str, int]:
+        return dict(self.__dict__)
+
+
+class _ReleasingStreamingResponse(StreamingResponse):
+    """
+    响应结束时一定调用 on_close。客户端在第一次写入之前断开时 body 迭代器从未开始，
+    其中的 finally 不会执行，由这里归还并行槽位和 active 计数。
+    """
+
+    def __init__(self, content: AsyncIterator[bytes], on_close: Callable[[], None], **kwargs: Any):
+        super().__init__(content, **kwargs)
+        self.on_close = on_close
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        try:
+            await super().__call__(scope, receive, send)
+        finally:
+            self.on_close()
+
+
+def _now_iso() -> str:
+    return datetime.now(timezone.utc).isoformat().replace("+00:00", "Z")
+
+
+def _digest(name: str) -> str:
+    return hashlib.sha256(name.encode("utf-8")).hexdigest()
+
+
+def _normalize(name: str) -> str:
+    return name if ":" in name else f"{name}:latest"
+
+
+class MockOllama:
+    """模拟服务的状态：已加载的模型、并行槽位和统计"""
+
+    def __init__(self, settings: MockSettings):
+        self.settings = settings
+        self.models = {_normalize(name) for name in settings.models}
+        self.random = random.Random(settings.seed)
+        self.stats = MockStats()
+        self._loaded: Dict[str, float] = {}  # 模型 -> keep_alive 到期时间（monotonic）
+        self._load_locks: Dict[str, asyncio.Lock] = {}
+        self._slots: Dict[str, asyncio.Semaphore] = {}
+
+    def _chance(self, rate: float) -> bool:
+        return rate > 0 and self.random.random() < rate
+
+    def loaded_models(self) -> Dict[str, float]:
+        now = time.monotonic()
+        return {model: until for model, until in self._loaded.items() if until > now}
+
+    async def ensure_loaded(self, model: str) -> float:
+        """模型未加载时模拟加载，返回本次请求花在加载上的秒数"""
+        lock = self._load_locks.setdefault(model, asyncio.Lock())
+        start = time.monotonic()
+        async with lock:
+            if self._loaded.get(model, 0.0) <= time.monotonic():
+                self.stats.loads += 1
+                if self.settings.load_delay > 0:
+                    await asyncio.sleep(self.settings.load_delay)
+            self._loaded[model] = time.monotonic() + self.settings.keep_alive
+        return time.monotonic() - start
+
+    def slot(self, model: str) -> Optional[asyncio.Semaphore]:
+        if self.settings.num_parallel <= 0:
+            return None
+        semaphore = self._slots.get(model)
+        if semaphore is None:
+            semaphore = self._slots[model] = asyncio.Semaphore(self.settings.num_parallel)
+        return semaphore
+
+    def output_tokens(self, body: Dict[str, Any]) -> int:
+        num_predict = (body.get("options") or {}).get("num_predict")
+        if isinstance(num_predict, int) and num_predict > 0:
+            return num_predict
+        return self.settings.output_tokens
+
+    def token_interval(self) -> float:
+        if self.settings.tokens_per_second <= 0:
+            return 0.0
+        interval = 1.0 / self.settings.tokens_per_second
+        if self.settings.jitter > 0:
+            interval *= max(1.0 + self.random.uniform(-self.settings.jitter, self.settings.jitter), 0.0)
+        return interval
+
+    async def generate(self, model: str, prompt: str, tokens: int) -> AsyncIterator[Dict[str, Any]]:
+        """
+        按配置的节奏产生 Ollama 格式的生成结果帧，最后一帧带 done 和耗时统计（纳秒）。
+        调用方需要已经持有并行槽位。
+        """
+        start = time.monotonic()
+        load_duration = await self.ensure_loaded(model)
+        if self.settings.prompt_delay > 0:
+            await asyncio.sleep(self.settings.prompt_delay)
+        prompt_done = time.monotonic()
+
+        offset = int(_digest(prompt)[:8], 16)
+        next_at = prompt_done
+        for i in range(tokens):
+            interval = self.token_interval()
+            if interval:
+                # 按计划时间而不是逐个 sleep，避免长输出累积调度误差
+                next_at += interval
+                delay = next_at - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            self.stats.tokens += 1
+            word = WORDS[(offset + i) % len(WORDS)]
+            yield {"model": model, "created_at": _now_iso(), "response": word if i == 0 else " " + word, "done": False}
+
+        end = time.monotonic()
+        yield {
+            "model": model,
+            "created_at": _now_iso(),
+            "response": "",
+            "done": True,
+            "done_reason": "length" if tokens else "stop",
+            "context": [1, 2, 3],
+            "total_duration": int((end - start) * 1e9),
+            "load_duration": int(load_duration * 1e9),
+            "prompt_eval_count": max(len(prompt) // 4, 1),
+            "prompt_eval_duration": int((prompt_done - start - load_duration) * 1e9),
+            "eval_count": tokens,
+            "eval_duration": int((end - prompt_done) * 1e9),
+        }
+
+
+def create_app(settings: Optional[MockSettings] = None) -> FastAPI:
+    """创建模拟 Ollama 的 ASGI 应用，状态保存在 app.state.mock 中"""
+    mock = MockOllama(settings or MockSettings())
+    app = FastAPI(title="Mock Ollama")
+    app.state.mock = mock
+
+    def error(status_code: int, message: str) -> JSONResponse:
+        return JSONResponse(status_code=status_code, content={"error": message})
+
+    @app.post("/api/generate")
+    async def generate(request: Request) -> Response:
+        body = await request.json()
+        model = _normalize(str(body.get("model") or ""))
+        stats = mock.stats
+        stats.requests += 1
+        if model not in mock.models:
+            return error(404, f'model "{model}" not found, try pulling it first')
+        if mock._chance(mock.settings.error_rate):
+            stats.injected_errors += 1
+            return error(mock.settings.error_status, "mock injected error")
+
+        slot = mock.slot(model)
+        if slot is not None and slot.locked():
+            if stats.queued >= mock.settings.max_queue:
+                stats.rejected_busy += 1
+                return error(503, "server busy, please try again.  maximum pending requests exceeded")
+            stats.queued += 1
+            try:
+                await slot.acquire()
+            finally:
+                stats.queued -= 1
+        elif slot is not None:
+            await slot.acquire()
+
+        prompt = str(body.get("prompt") or "")
+        tokens = mock.output_tokens(body)
+        frames = mock.generate(model, prompt, tokens)
+        truncate_at = mock.random.randint(0, tokens) if mock._chance(mock.settings.truncate_rate) else None
+        stats.active += 1
+        stats.peak_active = max(stats.peak_active, stats.active)
+
+        finished = False
+
+        def finish(completed: bool) -> None:
+            # 流式响应的 body 和 _ReleasingStreamingResponse 都会调用，只计一次
+            nonlocal finished
+            if finished:
+                return
+            finished = True
+            stats.active -= 1
+            if completed:
+                stats.completed += 1
+            else:
+                stats.cancelled += 1
+            if slot is not None:
+                slot.release()
+
+        if body.get("stream", True) is False:
+            completed = False
+            try:
+                parts = []
+                async for frame in frames:
+                    parts.append(frame["response"])
+                    last = frame
+                completed = True
+            finally:
+                finish(completed)
+            last["response"] = "".join(parts)
+            return JSONResponse(last)
+
+        async def stream() -> AsyncIterator[bytes]:
+            completed = False
+            try:
+                count = 0
+                async for frame in frames:
+                    if truncate_at is not None and count == truncate_at:
+                        # 模拟后端在生成途中崩溃：不发送结束帧就关闭连接
+                        raise RuntimeError("mock truncated stream")
+                    count += 1
+                    yield json.dumps(frame, ensure_ascii=False).encode("utf-8") + b"\n"
+                completed = True
+            finally:
+                await frames.aclose()
+                finish(completed)
+
+        return _ReleasingStreamingResponse(stream(), lambda: finish(False), media_type="application/x-ndjson")
+
+    @app.get("/api/tags")
+    async def tags() -> Dict[str, Any]:
+        return {
+            "models": [
+                {
+                    "name": name,
+                    "model": name,
+                    "modified_at": _now_iso(),
+                    "size": 4_000_000_000,
+                    "digest": _digest(name),
+                    "details": {"format": "gguf", "family": name.split(":")[0], "parameter_size": "7B"},
+                }
+                for name in sorted(mock.models)
+            ]
+        }
+
+    @app.get("/api/ps")
+    async def ps() -> Dict[str, Any]:
+        now = time.monotonic()
+        return {
+            "models": [
+                {
+                    "name": name,
+                    "model": name,
+                    "size": 4_000_000_000,
+                    "digest": _digest(name),
+                    "expires_at": (datetime.now(timezone.utc) + timedelta(seconds=until - now)).isoformat(),
+                    "size_vram": 4_000_000_000,
+                }
+                for name, until in sorted(mock.loaded_models().items())
+            ]
+        }
+
+    @app.get("/api/version")
+    async def version() -> Dict[str, str]:
+        return {"version": "0.0.0-mock"}
+
+    @app.delete("/api/delete")
+    async def delete(request: Request) -> Response:
+        body = await request.json()
+        model = _normalize(str(body.get("name") or body.get("model") or ""))
+        if model not in mock.models:
+            return error(404, f"model '{model}' not found")
+        mock.models.discard(model)
+        mock._loaded.pop(model, None)
+        return Response(status_code=200)
+
+    @app.get("/mock/stats")
+    async def mock_stats() -> Dict[str, Any]:
+        return mock.stats.to_dict()
+
+    return app
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=11434)
+    parser.add_argument("--models", default="llama3:latest,qwen2:7b", help="逗号分隔的模型列表")
+    parser.add_argument("--load-delay", type=float, default=0.0, help="模型加载耗时（秒）")
+    parser.add_argument("--keep-alive", type=float, default=300.0, help="模型空闲多久后卸载（秒）")
+    parser.add_argument("--prompt-delay", type=float, default=0.0, help="首 token 之前的 prompt 处理耗时（秒）")
+    parser.add_argument("--tokens-per-second", type=float, default=50.0, help="0 表示不限速")
+    parser.add_argument("--jitter", type=float, default=0.0, help="token 间隔的随机抖动比例，如 0.2")
+    parser.add_argument("--output-tokens", type=int, default=32)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--error-status", type=int, default=500)
+    parser.add_argument("--truncate-rate", type=float, default=0.0)
+    parser.add_argument("--num-parallel", type=int, default=0, help="每个模型的并行槽位，0 表示不限制")
+    parser.add_argument("--max-queue", type=int, default=512)
+    parser.add_argument("--seed", type=int, default=None)
+    args = parser.parse_args()
+
+    settings = MockSettings(
+        models=[name.strip() for name in args.models.split(",") if name.strip()],
+        load_delay=args.load_delay,
+        keep_alive=args.keep_alive,
+        prompt_delay=args.prompt_delay,
+        tokens_per_second=args.tokens_per_second,
+        jitter=args.jitter,
+        output_tokens=args.output_tokens,
+        error_rate=args.error_rate,
+        error_status=args.error_status,
+        truncate_rate=args.truncate_rate,
+        num_parallel=args.num_parallel,
+        max_queue=args.max_queue,
+        seed=args.seed,
+    )
+    uvicorn.run(create_app(settings), host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
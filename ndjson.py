@@ -0,0 +1,107 @@
+"""
+Ollama 流式响应（NDJSON）的解析。
+
+- iter_ndjson_lines：直接在字节流上按换行切分，不先解码为 str 再按行拆分。
+  UTF-8 多字节字符中不会出现 0x0A，因此按字节切分不会截断字符；
+- ChunkDecoder：只取出每帧的 response 和 done，可选使用 orjson 或 msgspec。
+  msgspec 按固定结构解码，跳过 context 等不需要的字段；只有 done 帧才完整解码一次。
+"""
+import json
+from typing import Any, AsyncIterable, AsyncIterator, Callable, Dict, Optional, Tuple
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - 取决于运行环境
+    orjson = None
+
+try:
+    import msgspec
+except ImportError:  # pragma: no cover - 取决于运行环境
+    msgspec = None
+
+
+async def iter_ndjson_lines(chunks: AsyncIterable[bytes]) -> AsyncIterator[bytes]:
+    """
+    把任意切分的字节块重新切分为行（不含换行符），跳过空行；
+    流结束时没有换行结尾的最后一行也会输出。
+    """
+    pending = b""
+    async for chunk in chunks:
+        lines = (pending + chunk if pending else chunk).split(b"\n")
+        pending = lines.pop()
+        for line in lines:
+            if line and not line.isspace():
+                yield line
+    if pending and not pending.isspace():
+        yield pending
+
+
+# 单个流式帧：(本帧文本, 是否为最后一帧, 最后一帧的完整内容)
+DecodedChunk = Tuple[str, bool, Optional[Dict[str, Any]]]
+
+
+class ChunkDecoder:
+    """
+    把一行 NDJSON 解码为 DecodedChunk，无法解析时抛出 ValueError。
+    """
+
+    def __init__(self, name: str, loads: Callable[[bytes], Any]):
+        self.name = name
+        self._loads = loads
+
+    def decode(self, line: bytes) -> DecodedChunk:
+        data = self._loads(line)
+        if not isinstance(data, dict):
+            raise ValueError("流式帧不是 JSON 对象")
+        done = data.get("done", False)
+        return data.get("response", ""), done, data if done else None
+
+
+if msgspec is not None:
+
+    class _TokenFrame(msgspec.Struct):
+        response: str = ""
+        done: bool = False
+
+    class MsgspecChunkDecoder(ChunkDecoder):
+        def __init__(self):
+            super().__init__("msgspec", msgspec.json.decode)
+            self._frame = msgspec.json.Decoder(_TokenFrame)
+
+        def decode(self, line: bytes) -> DecodedChunk:
+            try:
+                frame = self._frame.decode(line)
+                return frame.response, frame.done, msgspec.json.decode(line) if frame.done else None
+            except msgspec.MsgspecError as e:
+                raise ValueError(str(e)) from e
+
+
+_json_decode = json.JSONDecoder().decode
+
+
+def _json_loads(line: bytes) -> Any:
+    # json.loads(bytes) 每次都要探测编码，流式响应固定为 UTF-8，直接解码更快
+    return _json_decode(line.decode("utf-8"))
+
+
+def available_decoders() -> Tuple[str, ...]:
+    names = ["json"]
+    if orjson is not None:
+        names.append("orjson")
+    if msgspec is not None:
+        names.append("msgspec")
+    return tuple(names)
+
+
+def make_decoder(name: str = "auto") -> ChunkDecoder:
+    """
+    name 为 auto 时按 msgspec、orjson、json 的顺序选择已安装的解码器；
+    指定的解码器未安装时退回标准库 json。
+    """
+    if name == "auto":
+        name = "msgspec" if msgspec is not None else "orjson" if orjson is not None else "json"
+    if name == "msgspec" and msgspec is not None:
+        return MsgspecChunkDecoder()
+    if name == "orjson" and orjson is not None:
+        return ChunkDecoder("orjson", orjson.loads)
+    return ChunkDecoder("json", _json_loads)
@@ -0,0 +1,143 @@
+"""
+重放 capture.py 记录的 /api/generate 流量。
+
+按记录中请求到达的时间间隔（可以用 --speed 缩放）向任意部署重新发送请求，
+复现真实流量的模型分布、prompt 长度、生成参数和到达节奏；结果按 loadgen.py 的格式汇总：
+
+    python replay.py traffic.jsonl --url http://staging:8000 --speed 2
+    python replay.py traffic.jsonl --speed 0 --concurrency 16 --json-out replay.json
+
+记录中没有 prompt 原文（默认只保存哈希）时，按原长度生成由哈希确定的占位文本，
+同一条记录每次重放的 prompt 都相同。--match-output 按记录的 eval_count 设置 num_predict，
+让输出长度也与原始流量一致。
+
+记录中的 stream_format 不会重放：流式请求都按 NDJSON 格式发送，以便逐行测量 token 时间。
+"""
+import argparse
+import asyncio
+import json
+import random
+import time
+from typing import Any, Dict, List, Optional
+
+import httpx
+
+from loadgen import RequestResult, format_table, run_one, summarize
+
+# 生成占位 prompt 使用的词表
+FILLER_WORDS = ("data", "model", "request", "token", "latency", "cache", "stream", "prompt", "你好", "世界")
+
+
+def load_records(path: str, limit: Optional[int] = None, only_ok: bool = False) -> List[Dict[str, Any]]:
+    """读取记录并按到达时间排序"""
+    records = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if only_ok and record.get("outcome") != "ok":
+                continue
+            records.append(record)
+    records.sort(key=lambda r: r["ts"])
+    return records[:limit] if limit else records
+
+
+def synthetic_prompt(record: Dict[str, Any]) -> str:
+    """按记录的 prompt 长度生成占位文本，以 prompt 哈希为随机种子"""
+    length = record.get("prompt_chars") or 1
+    rng = random.Random(record.get("prompt_sha256") or length)
+    words = []
+    size = 0
+    while size < length:
+        word = rng.choice(FILLER_WORDS)
+        words.append(word)
+        size += len(word) + 1
+    return " ".join(words)[:length]
+
+
+def build_payload(record: Dict[str, Any], model: Optional[str] = None, match_output: bool = False) -> Dict[str, Any]:
+    """由记录构造请求体；stream_format 不复制，由 run_one 统一使用 NDJSON"""
+    payload: Dict[str, Any] = {
+        "model": model or record["model"],
+        "prompt": record["prompt"] if "prompt" in record else synthetic_prompt(record),
+        "stream": bool(record.get("stream")),
+    }
+    options = dict(record.get("options") or {})
+    if match_output and record.get("eval_count"):
+        options["num_predict"] = record["eval_count"]
+    if options:
+        payload["options"] = options
+    if record.get("priority"):
+        payload["priority"] = record["priority"]
+    return payload
+
+
+async def replay(
+    client: httpx.AsyncClient,
+    records: List[Dict[str, Any]],
+    speed: float = 1.0,
+    concurrency: int = 64,
+    model: Optional[str] = None,
+    match_output: bool = False,
+) -> Dict[str, Any]:
+    """
+    重放记录。speed > 0 时按原始到达间隔除以 speed 发送（speed=2 表示两倍速），
+    speed <= 0 时不等待，以 concurrency 个并发尽快发送。
+    """
+    results: List[RequestResult] = []
+    semaphore = asyncio.Semaphore(max(concurrency, 1)) if speed <= 0 else None
+
+    async def fire(record: Dict[str, Any]) -> None:
+        payload = build_payload(record, model, match_output)
+        if semaphore is None:
+            results.append(await run_one(client, payload))
+            return
+        async with semaphore:
+            results.append(await run_one(client, payload))
+
+    tasks = []
+    start = time.perf_counter()
+    first_ts = records[0]["ts"] if records else 0.0
+    for record in records:
+        if speed > 0:
+            delay = (record["ts"] - first_ts) / speed - (time.perf_counter() - start)
+            if delay > 0:
+                await asyncio.sleep(delay)
+        tasks.append(asyncio.ensure_future(fire(record)))
+    await asyncio.gather(*tasks)
+    return summarize(results, time.perf_counter() - start)
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("path", help="capture.py 写出的 JSONL 文件")
+    parser.add_argument("--url", default="http://localhost:8000", help="重放目标的代理服务地址")
+    parser.add_argument("--speed", type=float, default=1.0, help="时间缩放倍数，0 表示不等待、尽快发送")
+    parser.add_argument("--concurrency", type=int, default=64, help="--speed 0 时的并发数")
+    parser.add_argument("--limit", type=int, help="只重放前 N 条记录")
+    parser.add_argument("--only-ok", action="store_true", help="只重放原来成功的请求")
+    parser.add_argument("--model", help="替换记录中的模型")
+    parser.add_argument("--match-output", action="store_true", help="按记录的 eval_count 设置 num_predict")
+    parser.add_argument("--timeout", type=float, default=600.0)
+    parser.add_argument("--json-out", help="把汇总结果写入 JSON 文件")
+    args = parser.parse_args()
+
+    records = load_records(args.path, args.limit, args.only_ok)
+    if not records:
+        raise SystemExit(f"{args.path} 中没有可重放的记录")
+    span = records[-1]["ts"] - records[0]["ts"]
+    print(f"重放 {len(records)} 条记录，原始时长 {span:.1f}s，速度 {args.speed:g}x")
+
+    async with httpx.AsyncClient(base_url=args.url, timeout=args.timeout, limits=httpx.Limits(max_connections=None)) as client:
+        summary = await replay(client, records, args.speed, args.concurrency, args.model, args.match_output)
+
+    summary["config"] = {"url": args.url, "path": args.path, "speed": args.speed, "records": len(records)}
+    print(format_table(summary))
+    if args.json_out:
+        with open(args.json_out, "w", encoding="utf-8") as f:
+            json.dump(summary, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,288 @@
+"""
+多后端路由。
+
+维护 Ollama 后端注册表（地址 + 权重 + 实时负载 + 模型状态），并按可插拔的策略
+为每个 /api/generate 请求选择后端。启用模型亲和时优先选择已经加载了目标模型的后端，
+避免在节点之间来回切换模型。
+"""
+import asyncio
+import logging
+import time
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Optional, Sequence, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_model_name(name: str) -> str:
+    """Ollama 中不带标签的模型名等价于 ':latest'"""
+    return name if ":" in name else f"{name}:latest"
+
+
+@dataclass
+class Backend:
+    """一个 Ollama 后端及其实时负载"""
+    url: str
+    weight: float = 1.0
+    outstanding_requests: int = 0
+    outstanding_tokens: int = 0
+    total_requests: int = 0
+    # 平滑加权轮询的当前权重
+    current_weight: float = 0.0
+    # 已加载到内存的模型（/api/ps）和磁盘上可用的模型（/api/tags）
+    loaded_models: Set[str] = field(default_factory=set)
+    available_models: Set[str] = field(default_factory=set)
+    models_updated_at: Optional[float] = None
+
+    def has_loaded(self, model: str) -> bool:
+        return model in self.loaded_models
+
+    def has_available(self, model: str) -> bool:
+        return model in self.available_models or model in self.loaded_models
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "url": self.url,
+            "weight": self.weight,
+            "outstanding_requests": self.outstanding_requests,
+            "outstanding_tokens": self.outstanding_tokens,
+            "total_requests": self.total_requests,
+            "loaded_models": sorted(self.loaded_models),
+            "available_models": sorted(self.available_models),
+            "models_updated_at": self.models_updated_at,
+        }
+
+
+class BackendRegistry:
+    """后端注册表，按配置顺序保存所有后端，第一个为主后端"""
+
+    def __init__(self, backends: Sequence[Tuple[str, float]]):
+        if not backends:
+            raise ValueError("至少需要配置一个 Ollama 后端")
+        self._backends: Dict[str, Backend] = {}
+        for url, weight in backends:
+            url = url.rstrip("/")
+            self._backends[url] = Backend(url=url, weight=weight)
+
+    @property
+    def primary(self) -> Backend:
+        return next(iter(self._backends.values()))
+
+    def all(self) -> List[Backend]:
+        return list(self._backends.values())
+
+    def get(self, url: str) -> Optional[Backend]:
+        return self._backends.get(url)
+
+    def urls(self) -> List[str]:
+        return list(self._backends)
+
+    def forget_model(self, model: str, url: Optional[str] = None) -> None:
+        """模型被删除后，从 url 对应后端（为空时为所有后端）的模型状态中移除"""
+        model = normalize_model_name(model)
+        for backend in self._backends.values():
+            if url is not None and backend.url != url:
+                continue
+            backend.loaded_models.discard(model)
+            backend.available_models.discard(model)
+
+
+class RoutingPolicy:
+    """路由策略基类：从候选后端中选出一个"""
+    name = ""
+
+    def choose(self, candidates: Sequence[Backend]) -> Backend:
+        raise NotImplementedError
+
+
+class RoundRobinPolicy(RoutingPolicy):
+    """平滑加权轮询（与 nginx 的 smooth weighted round-robin 相同）"""
+    name = "round_robin"
+
+    def choose(self, candidates: Sequence[Backend]) -> Backend:
+        total = 0.0
+        best = None
+        for backend in candidates:
+            backend.current_weight += backend.weight
+            total += backend.weight
+            if best is None or backend.current_weight > best.current_weight:
+                best = backend
+        best.current_weight -= total
+        return best
+
+
+class LeastOutstandingRequestsPolicy(RoutingPolicy):
+    """选择 未完成请求数 / 权重 最小的后端"""
+    name = "least_requests"
+
+    def choose(self, candidates: Sequence[Backend]) -> Backend:
+        return min(candidates, key=lambda b: (b.outstanding_requests / b.weight, b.total_requests))
+
+
+class LeastOutstandingTokensPolicy(RoutingPolicy):
+    """选择 未完成 token 估算量 / 权重 最小的后端"""
+    name = "least_tokens"
+
+    def choose(self, candidates: Sequence[Backend]) -> Backend:
+        return min(candidates, key=lambda b: (b.outstanding_tokens / b.weight, b.outstanding_requests))
+
+
+POLICIES = {
+    policy.name: policy
+    for policy in (RoundRobinPolicy, LeastOutstandingRequestsPolicy, LeastOutstandingTokensPolicy)
+}
+
+
+def make_policy(name: str) -> RoutingPolicy:
+    try:
+        return POLICIES[name]()
+    except KeyError:
+        raise ValueError(f"未知的路由策略: {name}，可选值: {', '.join(POLICIES)}")
+
+
+def estimate_tokens(prompt: str, expected_output_tokens: int) -> int:
+    """粗略估算一次生成的 token 量（约 4 个字符一个 token）"""
+    return len(prompt) // 4 + 1 + expected_output_tokens
+
+
+class Router:
+    """
+    按策略为请求选择后端，并在请求期间记录后端的未完成负载。
+
+    启用模型亲和（model_affinity）时的选择顺序：
+    1. 已加载目标模型且未饱和的后端，按路由策略选择；
+    2. 磁盘上有目标模型的后端，选择负载最低的一个；
+    3. 以上都没有（例如模型状态尚未拉取），在所有后端中按路由策略选择。
+
+    当所有已加载模型的后端的未完成请求数 / 权重都达到 affinity_max_outstanding 时，
+    视为饱和，允许请求溢出到其他有该模型的后端，以便同一模型也能横向扩展。
+    """
+
+    def __init__(
+        self,
+        registry: BackendRegistry,
+        policy: RoutingPolicy,
+        model_affinity: bool = True,
+        affinity_max_outstanding: float = 4.0,
+    ):
+        self.registry = registry
+        self.policy = policy
+        self.model_affinity = model_affinity
+        self.affinity_max_outstanding = affinity_max_outstanding
+        self._least_loaded = LeastOutstandingRequestsPolicy()
+        self.affinity_hits = {"loaded": 0, "available": 0, "fallback": 0}
+
+    def candidates(self, model: str) -> List[Backend]:
+        return self.registry.all()
+
+    def choose(self, model: str, candidates: Optional[Sequence[Backend]] = None) -> Backend:
+        if candidates is None:
+            candidates = self.candidates(model)
+        if not self.model_affinity:
+            return self.policy.choose(candidates)
+
+        model = normalize_model_name(model)
+        loaded = [
+            b for b in candidates
+            if b.has_loaded(model) and b.outstanding_requests / b.weight < self.affinity_max_outstanding
+        ]
+        if loaded:
+            self.affinity_hits["loaded"] += 1
+            return self.policy.choose(loaded)
+        available = [b for b in candidates if b.has_available(model)]
+        if available:
+            self.affinity_hits["available"] += 1
+            backend = self._least_loaded.choose(available)
+            # Ollama 会在处理请求时加载模型，在下次拉取状态前先乐观地记为已加载
+            backend.loaded_models.add(model)
+            return backend
+        self.affinity_hits["fallback"] += 1
+        return self.policy.choose(candidates)
+
+    def acquire(
+        self,
+        model: str,
+        tokens: int = 0,
+        eligible: Optional[Callable[[Backend], bool]] = None,
+    ) -> Optional[Backend]:
+        """
+        选择后端并计入其未完成请求数和 token 数。
+        eligible 用于过滤候选后端（例如排除已满的后端），没有可用后端时返回 None。
+        """
+        candidates = self.candidates(model)
+        if eligible is not None:
+            candidates = [b for b in candidates if eligible(b)]
+            if not candidates:
+                return None
+        backend = self.choose(model, candidates)
+        backend.outstanding_requests += 1
+        backend.outstanding_tokens += tokens
+        backend.total_requests += 1
+        return backend
+
+    def release(self, backend: Backend, tokens: int = 0) -> None:
+        backend.outstanding_requests -= 1
+        backend.outstanding_tokens -= tokens
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "policy": self.policy.name,
+            "model_affinity": self.model_affinity,
+            "affinity_hits": dict(self.affinity_hits),
+            "backends": [backend.to_dict() for backend in self.registry.all()],
+        }
+
+
+class ModelStatePoller:
+    """
+    后台定期拉取每个后端的 /api/ps 和 /api/tags，更新注册表中的模型状态。
+    """
+
+    def __init__(self, registry: BackendRegistry, pool, interval: float):
+        self.registry = registry
+        self.pool = pool
+        self.interval = interval
+        self._task: Optional[asyncio.Task] = None
+
+    async def refresh_backend(self, backend: Backend) -> None:
+        ps = await self.pool.get(backend.url, "/api/ps", kind="models")
+        ps.raise_for_status()
+        tags = await self.pool.get(backend.url, "/api/tags", kind="models")
+        tags.raise_for_status()
+        backend.loaded_models = {
+            normalize_model_name(m.get("name") or m.get("model", ""))
+            for m in ps.json().get("models") or []
+        }
+        backend.available_models = {
+            normalize_model_name(m.get("name") or m.get("model", ""))
+            for m in tags.json().get("models") or []
+        }
+        backend.models_updated_at = time.time()
+
+    async def refresh_once(self) -> None:
+        """并发刷新所有后端，单个后端失败时保留其上一次的状态"""
+        backends = self.registry.all()
+        results = await asyncio.gather(
+            *(self.refresh_backend(b) for b in backends), return_exceptions=True
+        )
+        for backend, result in zip(backends, results):
+            if isinstance(result, Exception):
+                logger.warning("刷新后端 %s 的模型状态失败: %s", backend.url, result)
+
+    async def _run(self) -> None:
+        while True:
+            await self.refresh_once()
+            await asyncio.sleep(self.interval)
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
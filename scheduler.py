@@ -0,0 +1,510 @@
+"""
+上游调用的准入控制。
+
+在请求发往 Ollama 之前限制每个后端、每个模型的并发数；超出时请求进入有界等待队列，
+队列已满或等待超时则立即拒绝（429 / 503 并带 Retry-After），
+而不是把请求堆积在 Ollama 内部的队列里。
+
+等待队列按优先级（high / normal / low）出队，低优先级请求每等待 aging_interval 秒
+提升一级，避免被持续的高优先级流量饿死；同一优先级内按租户做加权公平排队（WFQ），
+每个租户在争用时获得与权重成比例的份额，空闲时不受限制。
+"""
+import asyncio
+import math
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Any, Deque, Dict, Iterator, List, Optional, Tuple
+
+from breaker import BreakerRegistry
+from routing import Backend, Router, normalize_model_name
+
+
+# 优先级类别，数值越小越先服务
+PRIORITIES = {"high": 0, "normal": 1, "low": 2}
+DEFAULT_PRIORITY = "normal"
+DEFAULT_TENANT = "anonymous"
+# 未在配置中登记的 API key 共用的租户
+UNREGISTERED_TENANT = "unregistered"
+
+
+class LatencyWindow:
+    """保留最近若干个样本，用于计算分位数"""
+
+    def __init__(self, size: int = 1024):
+        self._samples: Deque[float] = deque(maxlen=size)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def add(self, value: float) -> None:
+        self._samples.append(value)
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def __len__(self) -> int:
+        return len(self._samples)
+
+    def percentile(self, p: float) -> Optional[float]:
+        """最近样本的 p 分位数（秒），没有样本时返回 None"""
+        if not self._samples:
+            return None
+        samples = sorted(self._samples)
+        return samples[min(len(samples) - 1, int(p * len(samples)))]
+
+    def summary_ms(self) -> Dict[str, Optional[float]]:
+        samples = sorted(self._samples)
+
+        def percentile(p: float) -> Optional[float]:
+            if not samples:
+                return None
+            return round(samples[min(len(samples) - 1, int(p * len(samples)))] * 1000, 2)
+
+        return {
+            "count": self.count,
+            "avg": round(self.total / self.count * 1000, 2) if self.count else None,
+            "p50": percentile(0.5),
+            "p90": percentile(0.9),
+            "p99": percentile(0.99),
+            "max": round(self.max * 1000, 2),
+        }
+
+
+class AdmissionRejected(Exception):
+    """请求未被准入，由调用方转换为 HTTP 错误"""
+
+    def __init__(self, status_code: int, detail: str, retry_after: int):
+        super().__init__(detail)
+        self.status_code = status_code
+        self.detail = detail
+        self.retry_after = retry_after
+
+
+@dataclass
+class Waiter:
+    """等待准入的请求"""
+    model: str
+    tokens: int
+    enqueued_at: float
+    future: asyncio.Future = field(repr=False)
+    priority: str = DEFAULT_PRIORITY
+    seq: int = 0
+    tenant: str = DEFAULT_TENANT
+    # 加权公平排队的虚拟完成时间
+    finish_tag: float = 0.0
+
+
+class FifoQueue:
+    """先进先出的等待队列"""
+
+    def __init__(self):
+        self._waiters: Deque[Waiter] = deque()
+
+    def __len__(self) -> int:
+        return len(self._waiters)
+
+    def push(self, waiter: Waiter) -> None:
+        self._waiters.append(waiter)
+
+    def remove(self, waiter: Waiter) -> None:
+        try:
+            self._waiters.remove(waiter)
+        except ValueError:
+            pass
+
+    def candidates(self) -> Iterator[Waiter]:
+        """按服务顺序遍历等待者（返回快照，遍历期间可以安全地 remove）"""
+        return iter(list(self._waiters))
+
+    def served(self, waiter: Waiter) -> None:
+        """等待者被准入后调用"""
+
+
+class PriorityQueue(FifoQueue):
+    """
+    按优先级出队的等待队列，同一优先级内先进先出。
+
+    每等待 aging_interval 秒，等待者的有效优先级提升一级（最高到 high），
+    因此低优先级请求最多等待 2 * aging_interval 秒后就会与高优先级请求平等竞争。
+    """
+
+    def __init__(self, aging_interval: float):
+        super().__init__()
+        self.aging_interval = aging_interval
+
+    def _effective_priority(self, waiter: Waiter, now: float) -> int:
+        rank = PRIORITIES[waiter.priority]
+        if self.aging_interval > 0:
+            rank -= int((now - waiter.enqueued_at) / self.aging_interval)
+        return max(rank, 0)
+
+    def _rank(self, waiter: Waiter, now: float) -> Tuple:
+        return self._effective_priority(waiter, now), waiter.seq
+
+    def candidates(self) -> Iterator[Waiter]:
+        now = time.monotonic()
+        return iter(sorted(self._waiters, key=lambda w: self._rank(w, now)))
+
+
+class WeightedFairQueue(PriorityQueue):
+    """
+    在优先级之内按租户加权公平排队。
+
+    入队时为请求计算虚拟完成时间：
+        finish = max(虚拟时钟, 该租户上一个请求的 finish) + 代价 / 租户权重
+    同一有效优先级内按 finish 从小到大出队，代价为请求的估算 token 数。
+    虚拟时钟随出队推进，因此空闲的租户回来时不会积攒额度。
+    """
+
+    def __init__(self, aging_interval: float, tenant_weights: Dict[str, float], default_weight: float = 1.0):
+        super().__init__(aging_interval)
+        self.tenant_weights = dict(tenant_weights)
+        self.default_weight = default_weight
+        self.virtual_time = 0.0
+        self._last_finish: Dict[str, float] = {}
+        self.queued_by_tenant: Dict[str, int] = {}
+
+    def weight(self, tenant: str) -> float:
+        return self.tenant_weights.get(tenant, self.default_weight)
+
+    def push(self, waiter: Waiter) -> None:
+        start = max(self.virtual_time, self._last_finish.get(waiter.tenant, 0.0))
+        waiter.finish_tag = start + max(waiter.tokens, 1) / self.weight(waiter.tenant)
+        self._last_finish[waiter.tenant] = waiter.finish_tag
+        self.queued_by_tenant[waiter.tenant] = self.queued_by_tenant.get(waiter.tenant, 0) + 1
+        super().push(waiter)
+
+    def remove(self, waiter: Waiter) -> None:
+        if waiter in self._waiters:
+            remaining = self.queued_by_tenant.get(waiter.tenant, 0) - 1
+            if remaining > 0:
+                self.queued_by_tenant[waiter.tenant] = remaining
+            else:
+                self.queued_by_tenant.pop(waiter.tenant, None)
+                if self._last_finish.get(waiter.tenant, 0.0) <= self.virtual_time:
+                    self._last_finish.pop(waiter.tenant, None)
+        super().remove(waiter)
+
+    def forget(self, tenant: str) -> None:
+        """丢弃没有排队请求的租户的虚拟完成时间"""
+        if tenant not in self.queued_by_tenant:
+            self._last_finish.pop(tenant, None)
+
+    def served(self, waiter: Waiter) -> None:
+        self.virtual_time = max(self.virtual_time, waiter.finish_tag - max(waiter.tokens, 1) / self.weight(waiter.tenant))
+
+    def _rank(self, waiter: Waiter, now: float) -> Tuple:
+        return self._effective_priority(waiter, now), waiter.finish_tag, waiter.seq
+
+
+class Admission:
+    """一次已准入的上游调用，release() 可重复调用"""
+
+    def __init__(
+        self,
+        controller: "AdmissionController",
+        backend: Backend,
+        model: str,
+        tokens: int,
+        queue_wait: float,
+        priority: str = DEFAULT_PRIORITY,
+        tenant: str = DEFAULT_TENANT,
+    ):
+        self.controller = controller
+        self.backend = backend
+        self.model = model
+        self.tokens = tokens
+        self.queue_wait = queue_wait
+        self.priority = priority
+        self.tenant = tenant
+        self.admitted_at = time.monotonic()
+        self._released = False
+
+    def release(self) -> None:
+        if not self._released:
+            self._released = True
+            self.controller._release(self)
+
+
+class AdmissionController:
+    """
+    每个后端最多 max_per_backend 个、每个模型最多 max_per_model 个进行中的上游调用
+    （0 表示不限制）。无法立即准入的请求最多 max_queue 个排队（每个租户最多
+    max_queue_per_tenant 个，0 表示不单独限制），最长等待 queue_timeout 秒，
+    按优先级和租户权重出队。传入 breakers 时跳过已熔断的后端，全部熔断时立即拒绝。
+    没有进行中和排队请求、超过 tenant_idle_ttl 秒未出现的租户从统计中移除。
+    """
+
+    def __init__(
+        self,
+        router: Router,
+        max_per_backend: int,
+        max_per_model: int,
+        max_queue: int,
+        queue_timeout: float,
+        aging_interval: float = 10.0,
+        tenant_weights: Optional[Dict[str, float]] = None,
+        default_tenant_weight: float = 1.0,
+        max_queue_per_tenant: int = 0,
+        breakers: Optional[BreakerRegistry] = None,
+        tenant_idle_ttl: float = 300.0,
+    ):
+        self.router = router
+        self.breakers = breakers
+        self.max_per_backend = max_per_backend
+        self.max_per_model = max_per_model
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self.max_queue_per_tenant = max_queue_per_tenant
+        self.queue = WeightedFairQueue(aging_interval, tenant_weights or {}, default_tenant_weight)
+        self.tenants: Dict[str, Dict[str, int]] = {}
+        self.tenant_idle_ttl = tenant_idle_ttl
+        self._tenant_seen: Dict[str, float] = {}
+        self._tenants_pruned_at = time.monotonic()
+        self.model_in_flight: Dict[str, int] = {}
+        self._seq = 0
+        self._reopen_timer: Optional[asyncio.TimerHandle] = None
+
+        self.admitted = 0
+        self.queued = 0
+        self.rejected_queue_full = 0
+        self.rejected_timeout = 0
+        self.rejected_circuit_open = 0
+        self.queue_waits = LatencyWindow()
+        # 每个优先级类别的排队时间和端到端耗时（排队 + 上游调用）
+        self.class_queue_waits = {name: LatencyWindow() for name in PRIORITIES}
+        self.class_latencies = {name: LatencyWindow() for name in PRIORITIES}
+        # 上游调用耗时的指数滑动平均，用于估算 Retry-After
+        self._service_time_ewma = 1.0
+
+    def _backend_has_room(self, backend: Backend) -> bool:
+        if self.breakers is not None and not self.breakers.available(backend.url):
+            return False
+        return self.max_per_backend <= 0 or backend.outstanding_requests < self.max_per_backend
+
+    def _try_admit(self, model: str, tokens: int, exclude: Optional[Backend] = None) -> Optional[Backend]:
+        if self.max_per_model > 0 and self.model_in_flight.get(model, 0) >= self.max_per_model:
+            return None
+        if exclude is None:
+            eligible = self._backend_has_room
+        else:
+            eligible = lambda b: b is not exclude and self._backend_has_room(b)
+        backend = self.router.acquire(model, tokens, eligible=eligible)
+        if backend is None:
+            return None
+        if self.breakers is not None:
+            self.breakers.on_dispatch(backend.url)
+        self.model_in_flight[model] = self.model_in_flight.get(model, 0) + 1
+        self.admitted += 1
+        return backend
+
+    def retry_after(self) -> int:
+        """按排队长度和平均调用耗时估算客户端多久后重试（秒）"""
+        backends = len(self.router.registry.all())
+        capacity = self.max_per_backend * backends if self.max_per_backend > 0 else backends
+        seconds = self._service_time_ewma * (len(self.queue) + 1) / max(capacity, 1)
+        return max(1, min(60, math.ceil(seconds)))
+
+    def _tenant_stats(self, tenant: str) -> Dict[str, int]:
+        now = time.monotonic()
+        if now - self._tenants_pruned_at >= self.tenant_idle_ttl:
+            self._prune_tenants(now)
+        self._tenant_seen[tenant] = now
+        stats = self.tenants.get(tenant)
+        if stats is None:
+            stats = self.tenants[tenant] = {"admitted": 0, "in_flight": 0, "rejected": 0}
+        return stats
+
+    def _prune_tenants(self, now: float) -> None:
+        """移除空闲租户的统计和公平队列状态"""
+        self._tenants_pruned_at = now
+        for tenant, seen in list(self._tenant_seen.items()):
+            if now - seen < self.tenant_idle_ttl or tenant in self.queue.queued_by_tenant:
+                continue
+            if self.tenants.get(tenant, {}).get("in_flight", 0) > 0:
+                continue
+            del self._tenant_seen[tenant]
+            self.tenants.pop(tenant, None)
+            self.queue.forget(tenant)
+
+    def check(self, tenant: str = DEFAULT_TENANT) -> None:
+        """队列已满或所有后端都已熔断时立即拒绝，用于在开始流式响应之前返回 429 / 503"""
+        if self.breakers is not None and not any(self.breakers.available(b.url) for b in self.router.registry.all()):
+            self.rejected_circuit_open += 1
+            self._tenant_stats(tenant)["rejected"] += 1
+            raise AdmissionRejected(503, "所有 Ollama 后端均已熔断，请稍后重试", max(1, math.ceil(self.breakers.reopens_in())))
+        if len(self.queue) >= self.max_queue:
+            self.rejected_queue_full += 1
+            self._tenant_stats(tenant)["rejected"] += 1
+            raise AdmissionRejected(429, "请求过多，等待队列已满，请稍后重试", self.retry_after())
+        if 0 < self.max_queue_per_tenant <= self.queue.queued_by_tenant.get(tenant, 0):
+            self.rejected_queue_full += 1
+            self._tenant_stats(tenant)["rejected"] += 1
+            raise AdmissionRejected(429, "该租户排队的请求过多，请稍后重试", self.retry_after())
+
+    def _admitted(self, priority: str, tenant: str, waited: float) -> None:
+        self.queue_waits.add(waited)
+        self.class_queue_waits[priority].add(waited)
+        stats = self._tenant_stats(tenant)
+        stats["admitted"] += 1
+        stats["in_flight"] += 1
+
+    def _has_capacity(self) -> bool:
+        return any(self._backend_has_room(b) for b in self.router.registry.all())
+
+    async def acquire(
+        self,
+        model: str,
+        tokens: int = 0,
+        priority: str = DEFAULT_PRIORITY,
+        tenant: str = DEFAULT_TENANT,
+    ) -> Admission:
+        """等待准入并返回 Admission，调用方负责在调用结束后 release()"""
+        model = normalize_model_name(model)
+        if not len(self.queue):
+            backend = self._try_admit(model, tokens)
+            if backend is not None:
+                self._admitted(priority, tenant, 0.0)
+                return Admission(self, backend, model, tokens, 0.0, priority, tenant)
+
+        self.check(tenant)
+
+        loop = asyncio.get_running_loop()
+        self._seq += 1
+        waiter = Waiter(
+            model=model,
+            tokens=tokens,
+            enqueued_at=time.monotonic(),
+            future=loop.create_future(),
+            priority=priority,
+            seq=self._seq,
+            tenant=tenant,
+        )
+        self.queue.push(waiter)
+        self.queued += 1
+        # 队列中前面的请求可能受模型并发限制而无法准入，此时新请求仍可能立即被准入
+        self._dispatch()
+        try:
+            done, _ = await asyncio.wait([waiter.future], timeout=self.queue_timeout)
+        except asyncio.CancelledError:
+            self._abandon(waiter)
+            raise
+        if not done:
+            self._abandon(waiter)
+            self.rejected_timeout += 1
+            raise AdmissionRejected(503, f"等待上游空闲超时（{self.queue_timeout} 秒）", self.retry_after())
+        return waiter.future.result()
+
+    def try_acquire(
+        self,
+        model: str,
+        tokens: int = 0,
+        priority: str = DEFAULT_PRIORITY,
+        tenant: str = DEFAULT_TENANT,
+        exclude: Optional[Backend] = None,
+    ) -> Optional[Admission]:
+        """
+        不排队的准入：没有请求在排队且有空闲名额时立即返回 Admission，否则返回 None。
+        exclude 排除某个后端，用于把对冲请求发往另一个后端。
+        """
+        model = normalize_model_name(model)
+        if len(self.queue):
+            return None
+        backend = self._try_admit(model, tokens, exclude)
+        if backend is None:
+            return None
+        self._admitted(priority, tenant, 0.0)
+        return Admission(self, backend, model, tokens, 0.0, priority, tenant)
+
+    def _abandon(self, waiter: Waiter) -> None:
+        """放弃等待：已经被准入的要归还名额，否则移出队列"""
+        if waiter.future.done() and not waiter.future.cancelled():
+            waiter.future.result().release()
+        else:
+            waiter.future.cancel()
+            self.queue.remove(waiter)
+
+    def _release(self, admission: Admission) -> None:
+        elapsed = time.monotonic() - admission.admitted_at
+        self._service_time_ewma = 0.9 * self._service_time_ewma + 0.1 * elapsed
+        self.class_latencies[admission.priority].add(admission.queue_wait + elapsed)
+        self._tenant_stats(admission.tenant)["in_flight"] -= 1
+        self.router.release(admission.backend, admission.tokens)
+        remaining = self.model_in_flight.get(admission.model, 0) - 1
+        if remaining > 0:
+            self.model_in_flight[admission.model] = remaining
+        else:
+            self.model_in_flight.pop(admission.model, None)
+        self._dispatch()
+
+    def _dispatch(self) -> None:
+        """按队列顺序准入所有当前能够准入的等待者"""
+        now = time.monotonic()
+        for waiter in self.queue.candidates():
+            if not self._has_capacity():
+                break
+            if waiter.future.done():
+                self.queue.remove(waiter)
+                continue
+            backend = self._try_admit(waiter.model, waiter.tokens)
+            if backend is None:
+                continue
+            self.queue.remove(waiter)
+            self.queue.served(waiter)
+            waited = now - waiter.enqueued_at
+            self._admitted(waiter.priority, waiter.tenant, waited)
+            waiter.future.set_result(
+                Admission(self, backend, waiter.model, waiter.tokens, waited, waiter.priority, waiter.tenant)
+            )
+        self._dispatch_on_reopen()
+
+    def _dispatch_on_reopen(self) -> None:
+        """
+        还有请求在排队时，在最早一个熔断的后端进入半开时再分派一次：没有请求在进行中时，
+        不会有 release() 触发分派。
+        """
+        if self.breakers is None or not len(self.queue) or self._reopen_timer is not None:
+            return
+        delay = self.breakers.reopens_in()
+        if delay > 0:
+            self._reopen_timer = asyncio.get_running_loop().call_later(delay, self._reopened)
+
+    def _reopened(self) -> None:
+        self._reopen_timer = None
+        self._dispatch()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "limits": {
+                "max_per_backend": self.max_per_backend,
+                "max_per_model": self.max_per_model,
+                "max_queue": self.max_queue,
+                "queue_timeout": self.queue_timeout,
+                "aging_interval": self.queue.aging_interval,
+                "max_queue_per_tenant": self.max_queue_per_tenant,
+            },
+            "queue_length": len(self.queue),
+            "model_in_flight": dict(self.model_in_flight),
+            "admitted": self.admitted,
+            "queued": self.queued,
+            "rejected_queue_full": self.rejected_queue_full,
+            "rejected_timeout": self.rejected_timeout,
+            "rejected_circuit_open": self.rejected_circuit_open,
+            "queue_wait_ms": self.queue_waits.summary_ms(),
+            "priorities": {
+                name: {
+                    "queue_wait_ms": self.class_queue_waits[name].summary_ms(),
+                    "latency_ms": self.class_latencies[name].summary_ms(),
+                }
+                for name in PRIORITIES
+            },
+            "tenants": {
+                tenant: dict(
+                    stats,
+                    weight=self.queue.weight(tenant),
+                    queued=self.queue.queued_by_tenant.get(tenant, 0),
+                )
+                for tenant, stats in self.tenants.items()
+            },
+        }
@@ -0,0 +1,289 @@
+"""
+流式响应的输出阶段。
+
+上游流（及其共享广播）输出与格式无关的条目：token 文本为 str，结束和错误为 dict
+（{"done": True, ...统计} / {"error": "..."}）。每个客户端按自己选择的格式编码：
+
+- raw：纯文本，错误沿用 data: {...} 帧（兼容原有客户端），结束时默认不输出任何内容，
+  include_metadata 为真时才追加一帧 data: {...} 耗时统计；
+- ndjson：每行一个 JSON 对象，最后一行带 done 和耗时统计；
+- sse：text/event-stream，token 为 data 事件，结束为 event: done，错误为 event: error。
+
+帧的前后缀预先编码为字节，每个 token 只需编码一次文本。
+
+coalesce_tokens：把逐个到达的 token 合并成较大的写入块。缓冲的内容达到字节阈值，
+或第一个缓冲的 token 已等待 max_delay 秒时输出一次；每个 token 不再单独触发一次
+HTTP 分块写入。第一个 token 总是立即输出，不增加首 token 延迟。
+
+CancellableStreamingResponse：客户端断开时立即关闭整条生成器链，上游连接随之关闭，
+Ollama 中止生成。
+"""
+import asyncio
+import json
+import time
+from typing import Any, AsyncIterator, Dict, List, Optional, Union
+
+from starlette.responses import StreamingResponse
+from starlette.types import Receive, Scope, Send
+
+import metrics
+
+try:
+    import orjson
+except ImportError:  # pragma: no cover - 取决于运行环境
+    orjson = None
+
+StreamItem = Union[str, Dict[str, Any]]
+
+
+def _dumps(value: Any) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(value)
+    return json.dumps(value, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+class StreamFormat:
+    """把流式条目编码为线上的字节帧"""
+    name = ""
+    media_type = ""
+    headers: Dict[str, str] = {}
+
+    def encode(self, item: StreamItem) -> bytes:
+        if isinstance(item, str):
+            return self.text(item)
+        if "error" in item:
+            return self.error(item)
+        return self.done(item)
+
+    def text(self, text: str) -> bytes:
+        raise NotImplementedError
+
+    def done(self, metadata: Dict[str, Any]) -> bytes:
+        raise NotImplementedError
+
+    def error(self, error: Dict[str, Any]) -> bytes:
+        raise NotImplementedError
+
+
+class RawFormat(StreamFormat):
+    name = "raw"
+    media_type = "text/plain; charset=utf-8"
+
+    def __init__(self, include_metadata: bool = False):
+        self.include_metadata = include_metadata
+
+    def text(self, text: str) -> bytes:
+        return text.encode("utf-8")
+
+    def done(self, metadata: Dict[str, Any]) -> bytes:
+        return self._data_frame(metadata) if self.include_metadata else b""
+
+    def error(self, error: Dict[str, Any]) -> bytes:
+        return self._data_frame(error)
+
+    @staticmethod
+    def _data_frame(data: Dict[str, Any]) -> bytes:
+        return b"data: " + _dumps(data) + b"\n\n"
+
+
+class NdjsonFormat(StreamFormat):
+    name = "ndjson"
+    media_type = "application/x-ndjson"
+    _TEXT_PREFIX = b'{"response":'
+    _TEXT_SUFFIX = b',"done":false}\n'
+
+    def text(self, text: str) -> bytes:
+        return self._TEXT_PREFIX + _dumps(text) + self._TEXT_SUFFIX
+
+    def done(self, metadata: Dict[str, Any]) -> bytes:
+        return _dumps(metadata) + b"\n"
+
+    def error(self, error: Dict[str, Any]) -> bytes:
+        return _dumps(dict(error, done=True)) + b"\n"
+
+
+class SseFormat(StreamFormat):
+    name = "sse"
+    media_type = "text/event-stream; charset=utf-8"
+    headers = {"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    _TEXT_PREFIX = b'data: {"response":'
+    _TEXT_SUFFIX = b"}\n\n"
+    _DONE_PREFIX = b"event: done\ndata: "
+    _ERROR_PREFIX = b"event: error\ndata: "
+    _EVENT_SUFFIX = b"\n\n"
+
+    def text(self, text: str) -> bytes:
+        return self._TEXT_PREFIX + _dumps(text) + self._TEXT_SUFFIX
+
+    def done(self, metadata: Dict[str, Any]) -> bytes:
+        return self._DONE_PREFIX + _dumps(metadata) + self._EVENT_SUFFIX
+
+    def error(self, error: Dict[str, Any]) -> bytes:
+        return self._ERROR_PREFIX + _dumps(error) + self._EVENT_SUFFIX
+
+
+STREAM_FORMATS = ("raw", "ndjson", "sse")
+
+
+def make_format(name: str, include_metadata: bool = False) -> StreamFormat:
+    if name == "ndjson":
+        return NdjsonFormat()
+    if name == "sse":
+        return SseFormat()
+    return RawFormat(include_metadata)
+
+
+class _TokenBuffer:
+    """上游读取任务和输出循环之间共享的缓冲区"""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.parts: List[bytes] = []
+        self.size = 0
+        self.first_at = 0.0
+        self.done = False
+        self.error: Optional[BaseException] = None
+        # 输出循环等待的字节数，以及等待中的 future
+        self._wanted = 0
+        self._readable: Optional[asyncio.Future] = None
+        self._writable: Optional[asyncio.Future] = None
+
+    def put(self, part: bytes) -> None:
+        if not self.parts:
+            self.first_at = time.monotonic()
+        self.parts.append(part)
+        self.size += len(part)
+        if self.size >= self._wanted:
+            self._wake_reader()
+
+    def finish(self, error: Optional[BaseException] = None) -> None:
+        self.done = True
+        self.error = error
+        self._wake_reader()
+
+    def take(self) -> bytes:
+        data = b"".join(self.parts)
+        metrics.STREAM_WRITE_PARTS.observe(len(self.parts))
+        self.parts.clear()
+        self.size = 0
+        if self._writable is not None and not self._writable.done():
+            self._writable.set_result(None)
+        return data
+
+    def _wake_reader(self) -> None:
+        if self._readable is not None and not self._readable.done():
+            self._readable.set_result(None)
+
+    async def wait_readable(self, wanted: int, timeout: Optional[float] = None) -> None:
+        """等到缓冲达到 wanted 字节、上游结束或超时"""
+        if self.done or self.size >= wanted:
+            return
+        loop = asyncio.get_running_loop()
+        self._wanted = wanted
+        self._readable = loop.create_future()
+        timer = loop.call_later(timeout, self._wake_reader) if timeout is not None else None
+        try:
+            await self._readable
+        finally:
+            if timer is not None:
+                timer.cancel()
+            self._readable = None
+
+    async def wait_writable(self) -> None:
+        """缓冲已满时等输出循环取走内容，把客户端的背压传递给上游"""
+        if self.size < self.max_bytes:
+            return
+        self._writable = asyncio.get_running_loop().create_future()
+        try:
+            await self._writable
+        finally:
+            self._writable = None
+
+
+async def _pump(source: AsyncIterator[StreamItem], stream_format: StreamFormat, buffer: _TokenBuffer) -> None:
+    try:
+        async for item in source:
+            frame = stream_format.encode(item)
+            if frame:
+                buffer.put(frame)
+                await buffer.wait_writable()
+    except asyncio.CancelledError:
+        buffer.finish()
+        raise
+    except Exception as e:
+        buffer.finish(e)
+    else:
+        buffer.finish()
+
+
+async def coalesce_tokens(
+    source: AsyncIterator[StreamItem],
+    stream_format: StreamFormat,
+    max_bytes: int,
+    max_delay: float,
+) -> AsyncIterator[bytes]:
+    """
+    按 stream_format 编码 source 的条目，并按字节阈值 max_bytes 和时间预算 max_delay（秒）合并写入。
+    max_delay <= 0 时不合并，逐帧输出。
+    """
+    if max_delay <= 0:
+        async for item in source:
+            frame = stream_format.encode(item)
+            if frame:
+                yield frame
+        return
+
+    buffer = _TokenBuffer(max(max_bytes, 1))
+    task = asyncio.ensure_future(_pump(source, stream_format, buffer))
+    first = True
+    try:
+        while True:
+            await buffer.wait_readable(1)
+            if buffer.parts and not first:
+                remaining = buffer.first_at + max_delay - time.monotonic()
+                if remaining > 0:
+                    await buffer.wait_readable(buffer.max_bytes, remaining)
+            first = False
+            if buffer.parts:
+                yield buffer.take()
+            elif buffer.done:
+                if buffer.error is not None:
+                    raise buffer.error
+                return
+    finally:
+        if not task.done():
+            # 客户端已离开，停止读取上游
+            task.cancel()
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+
+
+class CancellableStreamingResponse(StreamingResponse):
+    """
+    始终监听 http.disconnect，并在响应结束（包括客户端断开）时关闭 body 迭代器。
+
+    StreamingResponse 在 ASGI 2.4 下只能在下一次写入失败时发现断开，且断开后不会关闭
+    body 迭代器；等待上游 token（如模型加载）期间客户端离开时，上游生成会一直继续。
+    """
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        streaming = asyncio.ensure_future(self.stream_response(send))
+        disconnected = asyncio.ensure_future(self.listen_for_disconnect(receive))
+        try:
+            await asyncio.wait({streaming, disconnected}, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            streaming.cancel()
+            disconnected.cancel()
+            await asyncio.gather(streaming, disconnected, return_exceptions=True)
+            aclose = getattr(self.body_iterator, "aclose", None)
+            if aclose is not None:
+                await aclose()
+        if not streaming.cancelled():
+            error = streaming.exception()
+            # 写入时发现连接已断开（OSError）按断开处理，其他错误照常抛出
+            if error is not None and not isinstance(error, OSError):
+                raise error
+        if self.background is not None:
+            await self.background()
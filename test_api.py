@@ -1,4 +1,7 @@
+import json
+
 import pytest
+import pytest_asyncio
 import httpx # Required for Request, Response, HTTPStatusError, RequestError
 from httpx import AsyncClient, Response as HttpxResponse, Request as HttpxRequest, HTTPStatusError, RequestError
 from fastapi import status
@@ -9,7 +12,7 @@ from main import app
 # 将此模块中的所有测试标记为异步执行
 pytestmark = pytest.mark.asyncio
 
-@pytest.fixture
+@pytest_asyncio.fixture
 async def client():
     """
     创建一个异步的 HTTP 测试客户端。
@@ -43,8 +46,8 @@ async def test_generate_text_success(client: AsyncClient, mocker):
     mock_http_response.json.return_value = mock_ollama_api_response_data
     mock_http_response.raise_for_status = mocker.Mock() # 对于成功的响应，raise_for_status 不应抛出异常
 
-    # 修补 main.py 中 httpx.AsyncClient().post 方法
-    mocker.patch("main.httpx.AsyncClient.post", return_value=mock_http_response)
+    # 修补 main.py 中共享连接池的 post 方法
+    mocker.patch("main.upstream_pool.post", return_value=mock_http_response)
 
     request_payload = {"model": "requested-model", "prompt": "你好"}
     api_response = await client.post("/api/generate", json=request_payload)
@@ -77,7 +80,7 @@ async def test_generate_text_ollama_model_not_found(client: AsyncClient, mocker)
     )
     mock_ollama_error_response.raise_for_status = mocker.Mock(side_effect=http_status_error)
 
-    mocker.patch("main.httpx.AsyncClient.post", return_value=mock_ollama_error_response)
+    mocker.patch("main.upstream_pool.post", return_value=mock_ollama_error_response)
 
     request_payload = {"model": "non-existent-model", "prompt": "你好"}
     api_response = await client.post("/api/generate", json=request_payload)
@@ -96,7 +99,7 @@ async def test_generate_text_ollama_request_error(client: AsyncClient, mocker):
     mock_request_obj.url = "http://localhost:11434/api/generate"
 
     request_error = RequestError(message="Connection refused", request=mock_request_obj)
-    mocker.patch("main.httpx.AsyncClient.post", side_effect=request_error)
+    mocker.patch("main.upstream_pool.post", side_effect=request_error)
 
     request_payload = {"model": "any-model", "prompt": "你好"}
     api_response = await client.post("/api/generate", json=request_payload)
@@ -118,7 +121,7 @@ async def test_generate_text_ollama_malformed_response(client: AsyncClient, mock
     mock_http_response.json.return_value = mock_ollama_malformed_data
     mock_http_response.raise_for_status = mocker.Mock()
 
-    mocker.patch("main.httpx.AsyncClient.post", return_value=mock_http_response)
+    mocker.patch("main.upstream_pool.post", return_value=mock_http_response)
 
     request_payload = {"model": "test-model", "prompt": "你好"}
     api_response = await client.post("/api/generate", json=request_payload)
@@ -145,7 +148,7 @@ async def test_generate_text_ollama_other_http_error(client: AsyncClient, mocker
     )
     mock_ollama_error_response.raise_for_status = mocker.Mock(side_effect=http_status_error)
 
-    mocker.patch("main.httpx.AsyncClient.post", return_value=mock_ollama_error_response)
+    mocker.patch("main.upstream_pool.post", return_value=mock_ollama_error_response)
 
     request_payload = {"model": "some-model", "prompt": "你好"}
     api_response = await client.post("/api/generate", json=request_payload)
@@ -158,10 +161,236 @@ async def test_generate_text_unexpected_exception(client: AsyncClient, mocker):
     """
     测试在请求处理过程中发生意外的非 HTTPX 异常时的错误处理。
     """
-    mocker.patch("main.httpx.AsyncClient.post", side_effect=ValueError("发生了意外的内部值错误"))
+    mocker.patch("main.upstream_pool.post", side_effect=ValueError("发生了意外的内部值错误"))
 
     request_payload = {"model": "any-model", "prompt": "你好"}
     api_response = await client.post("/api/generate", json=request_payload)
 
     assert api_response.status_code == status.HTTP_500_INTERNAL_SERVER_ERROR
-    assert "处理请求时发生内部错误: 发生了意外的内部值错误" in api_response.json()["detail"]
\ No newline at end of file
+    assert "处理请求时发生内部错误: 发生了意外的内部值错误" in api_response.json()["detail"]
+
+async def test_generate_text_invalid_priority_header(client: AsyncClient):
+    """
+    测试 X-Priority 请求头取值无效时返回 400。
+    """
+    request_payload = {"model": "any-model", "prompt": "你好"}
+    api_response = await client.post("/api/generate", json=request_payload, headers={"X-Priority": "urgent"})
+
+    assert api_response.status_code == status.HTTP_400_BAD_REQUEST
+    assert "无效的优先级" in api_response.json()["detail"]
+
+async def test_generate_text_forwards_timings(client: AsyncClient, mocker):
+    """
+    测试非流式响应转发 Ollama 的耗时统计，并生成 Server-Timing 响应头。
+    """
+    mock_http_response = mocker.Mock(spec=HttpxResponse)
+    mock_http_response.status_code = status.HTTP_200_OK
+    mock_http_response.json.return_value = {
+        "model": "timed-model",
+        "response": "好",
+        "done": True,
+        "total_duration": 250_000_000,
+        "load_duration": 50_000_000,
+        "prompt_eval_count": 4,
+        "eval_count": 10,
+        "eval_duration": 150_000_000,
+    }
+    mock_http_response.raise_for_status = mocker.Mock()
+    mocker.patch("main.upstream_pool.post", return_value=mock_http_response)
+
+    api_response = await client.post("/api/generate", json={"model": "timed-model", "prompt": "你好"})
+
+    assert api_response.status_code == status.HTTP_200_OK
+    data = api_response.json()
+    assert data["eval_count"] == 10 and data["load_duration"] == 50_000_000
+    assert data["prompt_eval_duration"] is None
+    assert api_response.headers["Server-Timing"] == "load;dur=50.000, eval;dur=150.000, total;dur=250.000"
+
+def mock_stream_pool(mocker):
+    """
+    用返回固定 NDJSON 流的连接池替换 main.upstream_pool。
+    """
+    from upstream import UpstreamPool
+
+    lines = [
+        {"model": "timed-model", "response": "你", "done": False},
+        {"model": "timed-model", "response": "好", "done": False},
+        {"model": "timed-model", "response": "", "done": True, "eval_count": 2, "eval_duration": 100_000_000},
+    ]
+    body = "".join(json.dumps(line) + "\n" for line in lines).encode("utf-8")
+    pool = UpstreamPool(10, 5, 5.0, 1.0, {}, transport_factory=lambda url: httpx.MockTransport(
+        lambda request: httpx.Response(200, content=body)
+    ))
+    mocker.patch("main.upstream_pool", pool)
+
+async def test_stream_ends_with_timing_frame(client: AsyncClient, mocker):
+    """
+    测试 raw 流式响应默认只包含生成文本，开启 STREAM_TIMING_FRAME 后在文本之后追加一帧耗时统计。
+    """
+    mock_stream_pool(mocker)
+    payload = {"model": "timed-model", "prompt": "你好", "stream": True}
+    api_response = await client.post("/api/generate", json=payload)
+    assert api_response.status_code == status.HTTP_200_OK
+    assert api_response.text == "你好"
+
+    mocker.patch("main.config.STREAM_TIMING_FRAME", True)
+    api_response = await client.post("/api/generate", json=payload)
+    assert api_response.status_code == status.HTTP_200_OK
+    text, frame = api_response.text.split("data: ")
+    assert text == "你好"
+    assert json.loads(frame) == {"done": True, "model": "timed-model", "eval_count": 2, "eval_duration": 100_000_000}
+
+async def test_stream_formats(client: AsyncClient, mocker):
+    """
+    测试 stream_format 和 Accept 请求头选择 NDJSON / SSE 输出格式。
+    """
+    mock_stream_pool(mocker)
+    payload = {"model": "timed-model", "prompt": "你好", "stream": True}
+
+    api_response = await client.post("/api/generate", json=dict(payload, stream_format="ndjson"))
+    assert api_response.headers["content-type"] == "application/x-ndjson"
+    lines = [json.loads(line) for line in api_response.text.splitlines()]
+    assert [line.get("response") for line in lines[:-1]] == ["你", "好"]
+    assert lines[-1] == {"done": True, "model": "timed-model", "eval_count": 2, "eval_duration": 100_000_000}
+
+    api_response = await client.post("/api/generate", json=payload, headers={"Accept": "text/event-stream"})
+    assert api_response.headers["content-type"].startswith("text/event-stream")
+    events = api_response.text.strip().split("\n\n")
+    assert events[0] == 'data: {"response":"你"}'
+    assert events[-1].startswith("event: done\ndata: ")
+
+async def test_stream_truncated_counts_as_breaker_failure(client: AsyncClient, mocker):
+    """
+    测试上游流没有结束帧就关闭时返回错误事件，并计为熔断器的一次失败。
+    """
+    from breaker import BreakerRegistry
+    from main import backend_registry
+    from upstream import UpstreamPool
+
+    body = b'{"model":"cut-model","response":"\xe4\xbd\xa0","done":false}\n'
+    pool = UpstreamPool(10, 5, 5.0, 1.0, {}, transport_factory=lambda url: httpx.MockTransport(
+        lambda request: httpx.Response(200, content=body)
+    ))
+    mocker.patch("main.upstream_pool", pool)
+    breakers = BreakerRegistry(backend_registry.urls(), failure_threshold=5, open_seconds=30, max_open_seconds=60)
+    mocker.patch("main.circuit_breakers", breakers)
+
+    payload = {"model": "cut-model", "prompt": "你好", "stream": True, "stream_format": "ndjson"}
+    api_response = await client.post("/api/generate", json=payload)
+
+    lines = [json.loads(line) for line in api_response.text.splitlines()]
+    assert lines[0]["response"] == "你"
+    assert lines[-1] == {"error": "Ollama 流式响应在完成前结束", "done": True}
+    breaker = breakers.get(backend_registry.primary.url)
+    assert breaker.consecutive_failures == 1
+    assert breaker.last_error.startswith("StreamTruncated")
+
+async def test_stream_disconnect_cancels_upstream(mocker):
+    """
+    测试客户端断开后立即关闭上游流，并记录中止的生成和节省的 token 数。
+    """
+    import asyncio
+
+    import metrics
+    from main import backend_registry
+    from upstream import UpstreamPool
+
+    upstream_closed = asyncio.Event()
+
+    class StalledStream(httpx.AsyncByteStream):
+        async def __aiter__(self):
+            yield b'{"response":"first","done":false}\n'
+            await asyncio.Event().wait()
+
+        async def aclose(self):
+            upstream_closed.set()
+
+    pool = UpstreamPool(10, 5, 5.0, 1.0, {}, transport_factory=lambda url: httpx.MockTransport(
+        lambda request: httpx.Response(200, stream=StalledStream())
+    ))
+    mocker.patch("main.upstream_pool", pool)
+
+    body = json.dumps({"model": "slow-model", "prompt": "你好", "stream": True, "options": {"num_predict": 100}}).encode()
+    received = []
+
+    async def receive():
+        if not received:
+            received.append(True)
+            return {"type": "http.request", "body": body, "more_body": False}
+        await asyncio.sleep(0.1)
+        return {"type": "http.disconnect"}
+
+    sent = []
+
+    async def send(message):
+        sent.append(message)
+
+    scope = {
+        "type": "http", "asgi": {"version": "3.0", "spec_version": "2.4"}, "http_version": "1.1",
+        "method": "POST", "scheme": "http", "path": "/api/generate", "raw_path": b"/api/generate",
+        "query_string": b"", "root_path": "", "headers": [(b"content-type", b"application/json")],
+        "client": ("test", 1), "server": ("testserver", 80),
+    }
+    labels = ("slow-model:latest", backend_registry.primary.url)
+    cancelled_before = metrics.STREAM_CANCELLED.value(*labels)
+
+    await asyncio.wait_for(app(scope, receive, send), timeout=5)
+
+    assert upstream_closed.is_set()
+    assert any(message.get("body") == b"first" for message in sent)
+    assert metrics.STREAM_CANCELLED.value(*labels) == cancelled_before + 1
+    assert metrics.STREAM_TOKENS_SAVED.value(*labels) >= 99
+
+async def test_stream_first_token_timeout_reports_stall(client: AsyncClient, mocker):
+    """
+    测试首 token 超时时返回错误事件，并把后端报告给健康探测。
+    """
+    import asyncio
+
+    from main import backend_registry, health_prober
+    from upstream import UpstreamPool
+
+    async def stalled(request):
+        await asyncio.sleep(1)
+        return httpx.Response(200, content=b"")
+
+    pool = UpstreamPool(10, 5, 5.0, 1.0, {}, transport_factory=lambda url: httpx.MockTransport(stalled))
+    mocker.patch("main.upstream_pool", pool)
+    mocker.patch("main.config.GENERATE_FIRST_TOKEN_TIMEOUT", 0.05)
+    state = health_prober.state(backend_registry.primary.url)
+    stalls_before = state.stalls
+
+    payload = {"model": "stuck-model", "prompt": "你好", "stream": True, "stream_format": "ndjson"}
+    api_response = await client.post("/api/generate", json=payload)
+
+    assert json.loads(api_response.text) == {"error": "Ollama 生成超时（首 token）: 超过 0.05 秒", "done": True}
+    assert state.stalls == stalls_before + 1
+
+async def test_generate_text_read_timeout_returns_504(client: AsyncClient, mocker):
+    """
+    测试非流式生成超过总耗时（读超时）时返回 504。
+    """
+    mocker.patch("main.upstream_pool.post", side_effect=httpx.ReadTimeout("timed out"))
+
+    api_response = await client.post("/api/generate", json={"model": "slow-model", "prompt": "你好"})
+
+    assert api_response.status_code == status.HTTP_504_GATEWAY_TIMEOUT
+    assert "Ollama 生成超时（总耗时）" in api_response.json()["detail"]
+
+async def test_unregistered_api_keys_share_one_tenant(mocker):
+    """
+    测试未登记的 API key 默认共用 unregistered 租户，开启 TENANT_PER_UNREGISTERED_KEY 后各自成为租户。
+    """
+    from fastapi import Request
+    from main import resolve_tenant
+
+    def request_with_key(key):
+        return Request({"type": "http", "headers": [(b"x-api-key", key.encode())]})
+
+    mocker.patch("main.config.TENANT_API_KEYS", {"sk-chat": "chat"})
+    assert resolve_tenant(request_with_key("sk-chat")) == "chat"
+    assert resolve_tenant(request_with_key("sk-a")) == resolve_tenant(request_with_key("sk-b")) == "unregistered"
+
+    mocker.patch("main.config.TENANT_PER_UNREGISTERED_KEY", True)
+    assert resolve_tenant(request_with_key("sk-a")).startswith("key-")
+    assert resolve_tenant(request_with_key("sk-a")) != resolve_tenant(request_with_key("sk-b"))
@@ -0,0 +1,37 @@
+import pytest
+
+import main
+from bench_proxy import METRICS, compare, run_suite
+
+pytestmark = pytest.mark.asyncio
+
+async def test_compare_applies_relative_budgets():
+    """
+    测试超出相对预算的指标被报告为回归，单独指定的预算优先，负数基线按绝对值计算余量。
+    """
+    baseline = {"generate_stream_us": 100.0, "models_us": -20.0, "stream_memory_kb": 4.0}
+    assert compare({"generate_stream_us": 119.0, "models_us": -17.0}, baseline, threshold=0.2) == []
+
+    regressions = compare(
+        {"generate_stream_us": 121.0, "models_us": -15.0, "stream_memory_kb": 4.3},
+        baseline,
+        threshold=0.2,
+        budgets={"stream_memory_kb": 0.05},
+    )
+    assert [line.split(":")[0] for line in regressions] == ["generate_stream_us", "models_us", "stream_memory_kb"]
+    assert compare({"new_metric": 1.0}, baseline, threshold=0.2) == []
+
+async def test_suite_runs_against_mock_upstream():
+    """
+    测试基准套件能对模拟上游跑完并给出全部指标，且不改动应用共享的连接池和准入控制器。
+    """
+    pool, admission_controller = main.upstream_pool, main.admission_controller
+    max_per_backend = admission_controller.max_per_backend
+    results = await run_suite(iterations=3, repeat=1, tokens=8, streams=4)
+    assert set(results["metrics"]) == set(METRICS)
+    assert results["details"]["generate_stream_us"]["proxy_cpu_us"] > 0
+    # 基准结束后应用的连接池和准入控制器保持原样
+    assert main.upstream_pool is pool and main.health_prober.pool is pool
+    assert main.admission_controller is admission_controller
+    assert admission_controller.max_per_backend == max_per_backend
+    assert pool.transport_factory is None
@@ -0,0 +1,106 @@
+import asyncio
+
+import httpx
+import pytest
+
+from breaker import CLOSED, HALF_OPEN, OPEN, BreakerRegistry, CircuitBreaker
+from routing import BackendRegistry, LeastOutstandingRequestsPolicy, Router
+from scheduler import AdmissionController, AdmissionRejected
+
+pytestmark = pytest.mark.asyncio
+
+def http_error(status: int) -> httpx.HTTPStatusError:
+    request = httpx.Request("POST", "http://a/api/generate")
+    return httpx.HTTPStatusError("error", request=request, response=httpx.Response(status, request=request))
+
+def fail(registry: BreakerRegistry, url: str, error: Exception) -> None:
+    with pytest.raises(type(error)):
+        with registry.guard(url):
+            raise error
+
+async def test_trips_after_consecutive_failures_only():
+    """
+    测试连续失败达到阈值后熔断；4xx 和成功的调用会清零失败计数。
+    """
+    registry = BreakerRegistry(["http://a"], failure_threshold=3, open_seconds=5, max_open_seconds=60)
+    breaker = registry.get("http://a")
+
+    fail(registry, "http://a", httpx.ConnectError("refused"))
+    fail(registry, "http://a", http_error(500))
+    fail(registry, "http://a", http_error(404))
+    assert breaker.state == CLOSED and breaker.consecutive_failures == 0
+
+    for _ in range(3):
+        fail(registry, "http://a", httpx.ReadTimeout("slow"))
+    assert breaker.state == OPEN
+    assert not registry.available("http://a")
+    assert registry.stats()[0]["trips"] == 1
+
+async def test_half_open_trial_recovers_or_backs_off():
+    """
+    测试熔断时间结束后只放行一个试探请求：失败时熔断时间翻倍，成功时恢复。
+    """
+    breaker = CircuitBreaker("http://a", failure_threshold=1, open_seconds=1, max_open_seconds=3)
+    breaker.record_failure(httpx.ConnectError("refused"))
+    assert breaker.state == OPEN
+
+    breaker.open_until = 0.0
+    assert breaker.available()
+    breaker.on_dispatch()
+    assert breaker.state == HALF_OPEN
+    assert not breaker.available()
+
+    breaker.record_failure(httpx.ConnectError("refused"))
+    assert breaker.state == OPEN and breaker._cooldown == 2
+
+    breaker.open_until = 0.0
+    breaker.on_dispatch()
+    breaker.record_neutral()  # 试探请求被客户端取消，不影响状态
+    assert breaker.state == HALF_OPEN and breaker.available()
+    breaker.on_dispatch()
+    breaker.record_success()
+    assert breaker.state == CLOSED and breaker._cooldown == 1
+
+async def test_admission_skips_open_backends_and_fails_fast():
+    """
+    测试准入控制跳过已熔断的后端，全部熔断时立即返回 503。
+    """
+    registry = BackendRegistry([("http://a", 1.0), ("http://b", 1.0)])
+    router = Router(registry, LeastOutstandingRequestsPolicy(), model_affinity=False)
+    breakers = BreakerRegistry(registry.urls(), failure_threshold=1, open_seconds=30, max_open_seconds=60)
+    controller = AdmissionController(router, 0, 0, max_queue=8, queue_timeout=1, breakers=breakers)
+
+    fail(breakers, "http://a", httpx.ConnectError("refused"))
+    for _ in range(3):
+        admission = await controller.acquire("m")
+        assert admission.backend.url == "http://b"
+        admission.release()
+
+    fail(breakers, "http://b", httpx.ConnectError("refused"))
+    with pytest.raises(AdmissionRejected) as exc_info:
+        controller.check()
+    assert exc_info.value.status_code == 503
+    assert exc_info.value.retry_after >= 29
+    assert controller.stats()["rejected_circuit_open"] == 1
+
+async def test_queued_requests_dispatched_when_breaker_half_opens():
+    """
+    测试唯一的后端熔断后，排队的请求在冷却结束（半开）时被准入，不必等其他请求结束。
+    """
+    registry = BackendRegistry([("http://a", 1.0)])
+    router = Router(registry, LeastOutstandingRequestsPolicy(), model_affinity=False)
+    breakers = BreakerRegistry(registry.urls(), failure_threshold=1, open_seconds=0.05, max_open_seconds=1)
+    controller = AdmissionController(router, 1, 0, max_queue=8, queue_timeout=1, breakers=breakers)
+
+    first = await controller.acquire("m")
+    queued = asyncio.ensure_future(controller.acquire("m"))
+    await asyncio.sleep(0)
+    fail(breakers, "http://a", httpx.ConnectError("refused"))
+    first.release()
+    await asyncio.sleep(0)
+    assert not queued.done()
+
+    admission = await asyncio.wait_for(queued, 0.5)
+    assert admission.backend.url == "http://a"
+    assert breakers.get("http://a").state == HALF_OPEN
+    admission.release()
@@ -0,0 +1,238 @@
+import asyncio
+import sqlite3
+import time
+import zlib
+
+import pytest
+import pytest_asyncio
+from httpx import AsyncClient, Response as HttpxResponse
+from fastapi import status
+
+import main
+from cache import DiskResponseCache, ResponseCache, is_deterministic, make_cache_key
+from main import app
+
+pytestmark = pytest.mark.asyncio
+
+@pytest_asyncio.fixture
+async def client():
+    main.response_cache.clear()
+    async with AsyncClient(app=app, base_url="http://testserver") as ac:
+        yield ac
+
+def mock_generate(mocker, text="缓存的响应"):
+    mock_http_response = mocker.Mock(spec=HttpxResponse)
+    mock_http_response.status_code = status.HTTP_200_OK
+    mock_http_response.json.return_value = {"model": "m:latest", "response": text, "done": True}
+    mock_http_response.raise_for_status = mocker.Mock()
+    return mocker.patch("main.upstream_pool.post", return_value=mock_http_response)
+
+async def test_cache_key_is_normalized():
+    """
+    测试缓存键对参数顺序和模型默认标签不敏感。
+    """
+    assert make_cache_key("m", "p", {"temperature": 0, "seed": 1}) == make_cache_key("m:latest", "p", {"seed": 1, "temperature": 0})
+    assert make_cache_key("m", "p", None) != make_cache_key("m", "q", None)
+    assert is_deterministic({"temperature": 0})
+    assert not is_deterministic({"temperature": 0.7})
+
+async def test_lru_ttl_and_size_bounds(monkeypatch):
+    """
+    测试条目数、字节数上限的 LRU 淘汰以及 TTL 过期。
+    """
+    cache = ResponseCache(max_entries=2, max_bytes=10, ttl=60)
+    cache.set("a", "m", {"response": "aaa"})
+    cache.set("b", "m", {"response": "bbb"})
+    assert cache.get("a") is not None
+    cache.set("c", "m", {"response": "ccc"})
+    assert cache.get("b") is None
+    cache.set("d", "m", {"response": "dddddd"})
+    assert cache.get("a") is None
+    assert len(cache) == 2 and cache.total_bytes == 9
+
+    now = time.monotonic()
+    monkeypatch.setattr("cache.time.monotonic", lambda: now + 61)
+    assert cache.get("d") is None
+    assert cache.stats()["expirations"] == 1
+
+async def test_disk_cache_persists_compresses_and_evicts(tmp_path, monkeypatch):
+    """
+    测试磁盘缓存跨实例保留、压缩存储、按最近访问淘汰、TTL 过期以及按模型失效。
+    """
+    path = str(tmp_path / "responses.db")
+    text = "重复的响应内容" * 200
+    disk = DiskResponseCache(path, max_entries=2, max_bytes=1024 * 1024, ttl=60)
+    await disk.set("a", "m", {"response": text})
+    await disk.set("b", "m", {"response": "b"})
+    assert (await disk.get("a")).value["response"] == text
+    assert disk.total_bytes < len(text.encode("utf-8"))
+    await disk.set("c", "other", {"response": "c"})
+    assert await disk.get("b") is None
+    await disk.aclose()
+
+    reopened = DiskResponseCache(path, max_entries=2, max_bytes=1024 * 1024, ttl=60)
+    assert [entry.key for entry in await reopened.load_recent(10)] == ["c", "a"]
+    assert await reopened.invalidate_model("m:latest") == 1
+    assert reopened.stats()["entries"] == 1
+
+    now = time.time()
+    monkeypatch.setattr("cache.time.time", lambda: now + 61)
+    assert await reopened.get("c") is None
+    assert reopened.stats()["expirations"] == 1
+    await reopened.aclose()
+
+async def test_disk_cache_treats_corrupt_rows_as_misses(tmp_path):
+    """
+    测试无法解码的条目按未命中处理并被删除，预热时跳过而不中断。
+    """
+    path = str(tmp_path / "responses.db")
+    disk = DiskResponseCache(path, max_entries=10, max_bytes=1024 * 1024, ttl=60)
+    await disk.set("a", "m", {"response": "a"})
+    await disk.set("b", "m", {"response": "b"})
+    await disk.set("c", "m", {"response": "c"})
+    await disk.aclose()
+    with sqlite3.connect(path) as conn:
+        conn.execute("UPDATE responses SET value = ? WHERE key = ?", (b"garbage", "a"))
+        conn.execute("UPDATE responses SET value = ? WHERE key = ?", (zlib.compress(b"{not json"), "b"))
+
+    reopened = DiskResponseCache(path, max_entries=10, max_bytes=1024 * 1024, ttl=60)
+    assert await reopened.get("a") is None
+    assert [entry.key for entry in await reopened.load_recent(10)] == ["c"]
+    stats = reopened.stats()
+    assert stats["errors"] == 2 and stats["entries"] == 1 and stats["misses"] == 1
+    assert await reopened.get("b") is None
+    await reopened.aclose()
+
+async def test_disk_cache_drops_writes_started_before_invalidation(tmp_path):
+    """
+    测试删除模型之前取得失效代数的写入在失效之后不会落盘。
+    """
+    disk = DiskResponseCache(str(tmp_path / "responses.db"), max_entries=10, max_bytes=1024 * 1024, ttl=60)
+    generation = disk.generation("m")
+    await disk.invalidate_model("m")
+    disk.set_nowait("a", "m", {"response": "stale"}, generation)
+    disk.set_nowait("b", "m", {"response": "fresh"})
+    await disk.aclose()
+    assert await disk.get("a") is None
+    assert (await disk.get("b")).value["response"] == "fresh"
+    await disk.aclose()
+
+async def test_generate_falls_back_to_disk_cache_and_warms_memory(client: AsyncClient, mocker, tmp_path):
+    """
+    测试内存缓存未命中时从磁盘缓存返回，以及启动时用磁盘缓存预热内存缓存。
+    """
+    disk = DiskResponseCache(str(tmp_path / "responses.db"), max_entries=10, max_bytes=1024 * 1024, ttl=60)
+    mocker.patch("main.response_disk_cache", disk)
+    upstream = mock_generate(mocker)
+    payload = {"model": "m", "prompt": "持久化", "options": {"temperature": 0}}
+
+    first = await client.post("/api/generate", json=payload)
+    assert first.headers["x-cache"] == "MISS"
+    await disk.aclose()  # 等后台写入落盘
+
+    main.response_cache.clear()
+    second = await client.post("/api/generate", json=payload)
+    assert second.headers["x-cache"] == "HIT" and second.headers["x-cache-tier"] == "disk"
+    assert second.json() == first.json()
+    third = await client.post("/api/generate", json=payload)
+    assert third.headers["x-cache-tier"] == "memory"
+    assert upstream.call_count == 1
+
+    main.response_cache.clear()
+    await main.warm_response_cache()
+    assert len(main.response_cache) == 1
+    await disk.aclose()
+
+async def test_coalesced_requests_write_cache_once(client: AsyncClient, mocker, tmp_path):
+    """
+    测试合并到同一次上游调用的请求只由发起调用的请求写入内存和磁盘缓存。
+    """
+    disk = DiskResponseCache(str(tmp_path / "responses.db"), max_entries=10, max_bytes=1024 * 1024, ttl=60)
+    mocker.patch("main.response_disk_cache", disk)
+    response = mock_generate(mocker).return_value
+
+    async def slow_post(*args, **kwargs):
+        await asyncio.sleep(0.05)
+        return response
+
+    upstream = mocker.patch("main.upstream_pool.post", side_effect=slow_post)
+    memory_set = mocker.spy(main.response_cache, "set")
+    disk_set = mocker.spy(disk, "set_nowait")
+    payload = {"model": "m", "prompt": "合并写入", "options": {"temperature": 0}}
+
+    responses = await asyncio.gather(*(client.post("/api/generate", json=payload) for _ in range(5)))
+    assert all(r.headers["x-cache"] == "MISS" for r in responses)
+    assert sum(r.headers.get("x-coalesced") == "1" for r in responses) == 4
+    assert upstream.call_count == 1
+    assert memory_set.call_count == 1 and disk_set.call_count == 1
+    await disk.aclose()
+
+async def test_generate_uses_cache_and_bypass(client: AsyncClient, mocker):
+    """
+    测试确定性请求命中缓存、绕过请求头，以及非确定性请求不缓存。
+    """
+    upstream = mock_generate(mocker)
+    payload = {"model": "m", "prompt": "你好", "options": {"temperature": 0}}
+
+    first = await client.post("/api/generate", json=payload)
+    second = await client.post("/api/generate", json=payload)
+    assert first.headers["x-cache"] == "MISS"
+    assert second.headers["x-cache"] == "HIT"
+    assert second.json() == first.json()
+    assert upstream.call_count == 1
+
+    bypass = await client.post("/api/generate", json=payload, headers={"X-Cache-Bypass": "1"})
+    assert bypass.headers["x-cache"] == "BYPASS"
+    assert upstream.call_count == 2
+
+    await client.post("/api/generate", json={"model": "m", "prompt": "你好"})
+    await client.post("/api/generate", json={"model": "m", "prompt": "你好"})
+    assert upstream.call_count == 4
+
+async def test_delete_model_invalidates_cache(client: AsyncClient, mocker):
+    """
+    测试删除模型后该模型的缓存条目被清除。
+    """
+    mock_generate(mocker)
+    await client.post("/api/generate", json={"model": "m", "prompt": "你好", "options": {"temperature": 0}})
+    assert len(main.response_cache) == 1
+
+    delete_response = mocker.Mock(spec=HttpxResponse)
+    delete_response.raise_for_status = mocker.Mock()
+    mocker.patch("main.upstream_pool.delete", return_value=delete_response)
+    response = await client.delete("/api/model/m")
+    assert response.status_code == status.HTTP_200_OK
+    assert len(main.response_cache) == 0
+
+async def test_models_endpoint_cached_with_etag(client: AsyncClient, mocker, monkeypatch):
+    """
+    测试 /api/models 缓存模型列表、支持 If-None-Match 返回 304，过期后先返回旧值再后台刷新。
+    """
+    main.models_cache.invalidate()
+    tags = {"models": [{"name": "llama3:latest", "size": 4661224676, "modified_at": "2024-05-01T00:00:00Z"}]}
+    tags_response = mocker.Mock(spec=HttpxResponse)
+    tags_response.json.return_value = tags
+    tags_response.raise_for_status = mocker.Mock()
+    upstream = mocker.patch("main.upstream_pool.get", return_value=tags_response)
+
+    first = await client.get("/api/models")
+    assert first.status_code == status.HTTP_200_OK
+    assert first.json()["count"] == 1
+    assert first.json()["models"][0]["size"] == "4661224676"
+    etag = first.headers["etag"]
+
+    second = await client.get("/api/models", headers={"If-None-Match": etag})
+    assert second.status_code == status.HTTP_304_NOT_MODIFIED
+    assert upstream.call_count == 1
+
+    # 超过 ttl 后仍立即返回旧列表，同时在后台刷新
+    tags["models"].append({"name": "qwen:7b"})
+    now = time.monotonic()
+    monkeypatch.setattr("cache.time.monotonic", lambda: now + main.config.MODELS_CACHE_TTL + 1)
+    stale = await client.get("/api/models")
+    assert stale.json()["count"] == 1
+    await main.models_cache._refreshing
+    fresh = await client.get("/api/models", headers={"If-None-Match": etag})
+    assert fresh.status_code == status.HTTP_200_OK
+    assert fresh.json()["count"] == 2
+    main.models_cache.invalidate()
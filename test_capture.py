@@ -0,0 +1,104 @@
+import asyncio
+import json
+import threading
+import time
+
+import httpx
+import pytest
+
+from capture import TrafficRecorder, build_record
+from mock_ollama import MockSettings, create_app
+from upstream import UpstreamPool
+
+pytestmark = pytest.mark.asyncio
+
+def record(i: int) -> dict:
+    return build_record(
+        model="m", prompt=f"secret prompt {i}", options={"temperature": 0, "stop": ["x"]}, stream=False,
+        received_at=1000.0 + i, duration=0.5, status=200, outcome="ok", include_prompt=False,
+        result={"eval_count": 3}, cache=None,
+    )
+
+async def test_records_are_sanitized():
+    """
+    测试记录中不含 prompt 原文，只保留标量生成参数并去掉值为空的附加字段。
+    """
+    entry = record(1)
+    assert "prompt" not in entry and entry["prompt_chars"] == len("secret prompt 1")
+    assert entry["options"] == {"temperature": 0}
+    assert entry["eval_count"] == 3 and entry["duration_ms"] == 500.0
+    assert "cache" not in entry
+
+async def test_batched_writer_flushes_on_close_and_drops_when_full(tmp_path):
+    """
+    测试记录按批写入文件、关闭时写出剩余记录，队列满时丢弃而不阻塞。
+    """
+    path = tmp_path / "traffic.jsonl"
+    recorder = TrafficRecorder(str(path), batch_size=2, flush_interval=10, max_pending=3)
+    for i in range(5):
+        recorder.record(record(i))
+    assert recorder.dropped == 2
+
+    await asyncio.sleep(0.05)
+    assert recorder.written == 2
+    await recorder.aclose()
+    lines = [json.loads(line) for line in path.read_text(encoding="utf-8").splitlines()]
+    assert [line["ts"] for line in lines] == [1000.0, 1001.0, 1002.0]
+    assert recorder.stats()["written"] == 3
+
+    TrafficRecorder("").record(record(0))  # 未配置路径时不记录
+
+async def test_close_waits_for_in_flight_write(tmp_path, monkeypatch):
+    """
+    测试关闭时等待进行中的写入完成，不会有两个写者同时追加文件。
+    """
+    path = tmp_path / "traffic.jsonl"
+    recorder = TrafficRecorder(str(path), batch_size=1, flush_interval=10)
+    write = recorder._write
+    lock = threading.Lock()
+    active = overlapped = 0
+
+    def slow_write(batch):
+        nonlocal active, overlapped
+        with lock:
+            active += 1
+            overlapped = max(overlapped, active)
+        time.sleep(0.05)
+        write(batch)
+        with lock:
+            active -= 1
+
+    monkeypatch.setattr(recorder, "_write", slow_write)
+    for i in range(3):
+        recorder.record(record(i))
+    await asyncio.sleep(0.01)  # 第一批正在线程中写入
+    await recorder.aclose()
+    assert overlapped == 1
+    lines = [json.loads(line) for line in path.read_text(encoding="utf-8").splitlines()]
+    assert [line["ts"] for line in lines] == [1000.0, 1001.0, 1002.0]
+
+async def test_proxy_captures_generate_calls(tmp_path, mocker):
+    """
+    测试代理为流式和非流式请求写出流量记录。
+    """
+    import main
+
+    upstream = create_app(MockSettings(output_tokens=3))
+    pool = UpstreamPool(10, 5, 5.0, 1.0, {}, transport_factory=lambda url: httpx.ASGITransport(app=upstream))
+    recorder = TrafficRecorder(str(tmp_path / "traffic.jsonl"), flush_interval=0.01)
+    mocker.patch("main.upstream_pool", pool)
+    mocker.patch("main.traffic_recorder", recorder)
+
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://proxy") as client:
+        await client.post("/api/generate", json={"model": "llama3", "prompt": "capture me", "stream": False})
+        await client.post("/api/generate", json={"model": "llama3", "prompt": "capture me too", "stream": True})
+        await client.post("/api/generate", json={"model": "missing", "prompt": "x", "stream": False})
+    await recorder.aclose()
+
+    lines = [json.loads(line) for line in (tmp_path / "traffic.jsonl").read_text(encoding="utf-8").splitlines()]
+    by_prompt = {line["prompt_chars"]: line for line in lines}
+    assert by_prompt[len("capture me")]["outcome"] == "ok"
+    assert by_prompt[len("capture me")]["eval_count"] == 3
+    streamed = by_prompt[len("capture me too")]
+    assert streamed["stream"] and streamed["ttft_ms"] is not None and streamed["stream_format"] == "raw"
+    assert by_prompt[1]["outcome"] == "error" and by_prompt[1]["status"] >= 400
@@ -0,0 +1,149 @@
+import asyncio
+
+import pytest
+
+from coalesce import SingleFlight
+
+pytestmark = pytest.mark.asyncio
+
+async def test_concurrent_calls_share_one_upstream_call():
+    """
+    测试并发的相同键只触发一次调用，所有调用方拿到同一个结果。
+    """
+    flights = SingleFlight()
+    calls = 0
+    release = asyncio.Event()
+
+    async def generate():
+        nonlocal calls
+        calls += 1
+        await release.wait()
+        return "结果"
+
+    waiters = [asyncio.ensure_future(flights.do("k", generate)) for _ in range(5)]
+    await asyncio.sleep(0)
+    assert flights.in_flight() == 1
+    release.set()
+    results = await asyncio.gather(*waiters)
+
+    assert calls == 1
+    assert [r for r, _ in results] == ["结果"] * 5
+    assert sum(shared for _, shared in results) == 4
+    assert flights.stats()["coalesced_requests"] == 4
+    assert flights.in_flight() == 0
+
+async def test_errors_propagate_and_leader_cancel_does_not_abort():
+    """
+    测试异常传给所有等待者；发起者被取消时其他等待者仍能拿到结果。
+    """
+    flights = SingleFlight()
+
+    async def fail():
+        await asyncio.sleep(0)
+        raise ValueError("上游失败")
+
+    results = await asyncio.gather(flights.do("e", fail), flights.do("e", fail), return_exceptions=True)
+    assert all(isinstance(r, ValueError) for r in results)
+
+    release = asyncio.Event()
+
+    async def slow():
+        await release.wait()
+        return 42
+
+    leader = asyncio.ensure_future(flights.do("s", slow))
+    await asyncio.sleep(0)
+    follower = asyncio.ensure_future(flights.do("s", slow))
+    await asyncio.sleep(0)
+    leader.cancel()
+    release.set()
+    assert await follower == (42, True)
+
+async def test_stream_hub_fans_out_with_replay():
+    """
+    测试多个订阅者共享一条上游流，后加入者先回放已输出的前缀。
+    """
+    from coalesce import StreamHub
+
+    hub = StreamHub(max_replay_bytes=1024)
+    started = 0
+    step = asyncio.Event()
+
+    async def producer():
+        nonlocal started
+        started += 1
+        yield "一"
+        await step.wait()
+        yield "二"
+        yield "三"
+
+    async def collect(stream):
+        return [chunk async for chunk in stream]
+
+    first = asyncio.ensure_future(collect(hub.subscribe("k", producer)))
+    for _ in range(3):
+        await asyncio.sleep(0)
+    late = asyncio.ensure_future(collect(hub.subscribe("k", producer)))
+    await asyncio.sleep(0)
+    step.set()
+
+    assert await first == ["一", "二", "三"]
+    assert await late == ["一", "二", "三"]
+    assert started == 1
+    assert hub.stats()["late_joiners"] == 1
+    assert hub.stats()["active_streams"] == 0
+
+async def test_stream_hub_cancels_upstream_when_all_leave():
+    """
+    测试所有订阅者都离开后上游流被取消。
+    """
+    from coalesce import StreamHub
+
+    hub = StreamHub(max_replay_bytes=1024)
+    closed = asyncio.Event()
+
+    async def producer():
+        try:
+            while True:
+                yield "x"
+                await asyncio.sleep(0)
+        finally:
+            closed.set()
+
+    stream = hub.subscribe("k", producer)
+    assert await stream.__anext__() == "x"
+    await stream.aclose()
+    await asyncio.wait_for(closed.wait(), 1)
+    assert hub.stats()["cancelled_streams"] == 1
+
+async def test_stream_hub_ends_subscribers_when_upstream_cancelled():
+    """
+    测试上游流在仍有订阅者时被取消，订阅者收到错误条目后正常结束，而不是收到 CancelledError。
+    """
+    from coalesce import StreamHub
+
+    hub = StreamHub(max_replay_bytes=1024)
+
+    async def producer():
+        yield "x"
+        await asyncio.Event().wait()
+
+    stream = hub.subscribe("k", producer)
+    assert await stream.__anext__() == "x"
+    broadcast = hub._broadcasts["k"]
+    broadcast.task.cancel()
+    assert [chunk async for chunk in stream] == [{"error": "上游流已被取消"}]
+    assert broadcast.task.cancelled()
+    assert hub.stats()["active_streams"] == 0
+
+async def test_stream_broadcast_counts_encoded_bytes():
+    """
+    测试回放缓冲按 UTF-8 编码后的字节数计算，结束事件按序列化后的长度计算。
+    """
+    from coalesce import StreamBroadcast
+
+    broadcast = StreamBroadcast("k")
+    broadcast.publish("你好")
+    assert broadcast.buffered_bytes == 6
+    broadcast.publish({"done": True})
+    assert broadcast.buffered_bytes == 6 + len('{"done":true}')
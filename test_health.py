@@ -0,0 +1,70 @@
+import time
+
+import pytest
+import httpx
+
+from health import HealthProber
+from routing import BackendRegistry
+from upstream import UpstreamPool
+
+pytestmark = pytest.mark.asyncio
+
+def make_prober(handler) -> HealthProber:
+    pool = UpstreamPool(10, 5, 5.0, 1.0, {}, transport_factory=lambda url: httpx.MockTransport(handler))
+    registry = BackendRegistry([("http://a", 1.0), ("http://b", 1.0)])
+    return HealthProber(registry, pool, interval=1.0, max_backoff=4.0)
+
+async def test_probe_records_latency_and_backoff():
+    """
+    测试探测结果、延迟历史记录以及失败时的指数退避。
+    """
+    def handler(request: httpx.Request) -> httpx.Response:
+        if request.url.host == "b":
+            raise httpx.ConnectError("refused", request=request)
+        return httpx.Response(200, json={"version": "0.1.0"})
+
+    prober = make_prober(handler)
+    assert (await prober.probe("http://a")).ok
+    for _ in range(3):
+        result = await prober.probe("http://b")
+    assert not result.ok and "连接错误" in result.error
+
+    a, b = prober.state("http://a"), prober.state("http://b")
+    assert a.healthy and len(a.history) == 1
+    assert b.consecutive_failures == 3
+    # 1 * 2^3 = 8 秒，受 max_backoff 限制为 4 秒
+    assert 3.5 < b.next_probe_at - time.monotonic() <= 4.0
+    assert prober.stats()[1]["history_ms"] == [None, None, None]
+
+async def test_latest_only_probes_when_needed():
+    """
+    测试 latest() 在已有结果时不访问上游，fresh 时强制探测。
+    """
+    calls = 0
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        nonlocal calls
+        calls += 1
+        return httpx.Response(503, text="loading")
+
+    prober = make_prober(handler)
+    state = await prober.latest("http://a")
+    await prober.latest("http://a")
+    assert calls == 1
+    assert not state.healthy and state.last.error == "HTTP 503: loading"
+    await prober.latest("http://a", fresh=True)
+    assert calls == 2
+
+async def test_report_stall_triggers_immediate_probe():
+    """
+    测试上报生成停滞后立即重新探测该后端，未知后端的上报被忽略。
+    """
+    prober = make_prober(lambda request: httpx.Response(200, json={"version": "0.1.0"}))
+    await prober.probe("http://a")
+    assert prober.state("http://a").next_probe_at > time.monotonic()
+
+    prober.report_stall("http://a", "Ollama 生成超时")
+    state = prober.state("http://a")
+    assert state.next_probe_at == 0.0
+    assert prober.stats()[0]["stalls"] == 1 and state.last_stall == "Ollama 生成超时"
+    prober.report_stall("http://unknown", "ignored")
@@ -0,0 +1,114 @@
+import asyncio
+
+import pytest
+
+from hedging import HedgePolicy, run_hedged
+from routing import BackendRegistry, Router, make_policy
+from scheduler import AdmissionController
+
+pytestmark = pytest.mark.asyncio
+
+async def call(result, delay: float, log: list, name: str):
+    try:
+        await asyncio.sleep(delay)
+    except asyncio.CancelledError:
+        log.append(f"{name} cancelled")
+        raise
+    if isinstance(result, Exception):
+        raise result
+    return result
+
+async def test_fast_primary_is_not_hedged():
+    """
+    测试主请求在对冲等待时间内返回时不发出对冲请求。
+    """
+    log = []
+    hedges = []
+    result = await run_hedged(
+        lambda: call("a", 0.01, log, "primary"),
+        lambda: hedges.append(1),
+        delay=0.1,
+    )
+    assert result == ("a", False)
+    assert hedges == []
+
+async def test_slow_primary_loses_to_hedge_and_is_cancelled():
+    """
+    测试主请求超过对冲等待时间后发出对冲请求，对冲先返回时取消主请求。
+    """
+    log = []
+    result = await run_hedged(
+        lambda: call("slow", 1, log, "primary"),
+        lambda: call("fast", 0.01, log, "hedge"),
+        delay=0.02,
+    )
+    await asyncio.sleep(0)
+    assert result == ("fast", True)
+    assert log == ["primary cancelled"]
+
+async def test_failed_attempt_falls_back_to_the_other():
+    """
+    测试一方失败时采用另一方的结果，都失败时抛出主请求的异常。
+    """
+    log = []
+    result = await run_hedged(
+        lambda: call("late", 0.1, log, "primary"),
+        lambda: call(RuntimeError("hedge failed"), 0.01, log, "hedge"),
+        delay=0.02,
+    )
+    assert result == ("late", False)
+
+    with pytest.raises(ValueError, match="primary failed"):
+        await run_hedged(
+            lambda: call(ValueError("primary failed"), 0.05, log, "primary"),
+            lambda: call(RuntimeError("hedge failed"), 0.01, log, "hedge"),
+            delay=0.02,
+        )
+
+async def test_no_hedge_when_factory_declines():
+    """
+    测试 hedge() 返回 None 时继续等待主请求。
+    """
+    log = []
+    result = await run_hedged(lambda: call("a", 0.05, log, "primary"), lambda: None, delay=0.01)
+    assert result == ("a", False)
+
+async def test_policy_delay_and_budget():
+    """
+    测试样本不足时不对冲、等待时间取分位数并受下限约束，以及对冲预算。
+    """
+    policy = HedgePolicy(percentile=0.9, min_delay=0.5, min_samples=10, budget_ratio=0.25, budget_burst=1)
+    assert policy.delay("m") is None
+    for i in range(10):
+        policy.record("m", float(i + 1))
+    assert policy.delay("m:latest") == 10.0
+    for _ in range(10):
+        policy.record("fast", 0.01)
+    assert policy.delay("fast") == 0.5
+
+    assert policy.allow()
+    policy.spend()
+    assert not policy.allow()
+    for _ in range(4):
+        policy.delay("m")
+    assert policy.allow()
+    assert policy.stats()["budget_exhausted"] == 1
+
+    policy.record("m", 1.0, hedged=True)
+    policy.record_no_backend()
+    assert policy.stats()["hedge_wins"] == 1 and policy.stats()["no_backend"] == 1
+
+async def test_try_acquire_excludes_backend_and_never_queues():
+    """
+    测试对冲准入排除主请求的后端，没有空闲名额时立即返回 None 而不排队。
+    """
+    registry = BackendRegistry([("http://a", 1.0), ("http://b", 1.0)])
+    router = Router(registry, make_policy("round_robin"), model_affinity=False)
+    controller = AdmissionController(router, max_per_backend=1, max_per_model=0, max_queue=8, queue_timeout=1)
+
+    primary = await controller.acquire("m")
+    hedge = controller.try_acquire("m", exclude=primary.backend)
+    assert hedge is not None and hedge.backend is not primary.backend
+    assert controller.try_acquire("m") is None
+    hedge.release()
+    primary.release()
@@ -0,0 +1,62 @@
+import httpx
+import pytest
+
+from loadgen import RequestResult, format_table, percentile, run_closed_loop, run_open_loop, summarize
+from mock_ollama import MockSettings, create_app
+from upstream import UpstreamPool
+
+pytestmark = pytest.mark.asyncio
+
+@pytest.fixture
+def proxy_client(mocker):
+    """接到模拟 Ollama 的代理客户端"""
+    import main
+
+    upstream = create_app(MockSettings(output_tokens=4))
+    pool = UpstreamPool(10, 5, 5.0, 1.0, {}, transport_factory=lambda url: httpx.ASGITransport(app=upstream))
+    mocker.patch("main.upstream_pool", pool)
+    mocker.patch("main.config.RESPONSE_CACHE_ENABLED", False)
+    return httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://proxy")
+
+async def test_percentiles_and_summary():
+    """
+    测试最近秩法分位数，以及汇总结果中的错误率和延迟分位数。
+    """
+    values = [i / 1000 for i in range(1, 1001)]
+    assert percentile(values, 0.5) == 0.5
+    assert percentile(values, 0.999) == 0.999
+    assert percentile([], 0.5) is None
+
+    results = [RequestResult(True, 200, total=0.1, ttft=0.01, gaps=[0.002], tokens=2), RequestResult(False, 429, "http_429")]
+    summary = summarize(results, wall_time=1.0)
+    assert summary["error_rate"] == 0.5 and summary["errors"] == {"http_429": 1}
+    assert summary["latency_ms"]["ttft"]["p50"] == 10.0
+    assert "ttft" in format_table(summary)
+
+async def test_closed_loop_against_mock_upstream(proxy_client):
+    """
+    测试闭环模式对流式和非流式请求的测量：TTFT、token 间隔和 token 数。
+    """
+    async with proxy_client as client:
+        summary = await run_closed_loop(
+            client, lambda i: {"model": "llama3", "prompt": f"p{i}", "stream": True}, concurrency=3, requests=6,
+        )
+        assert summary["requests"] == 6 and summary["succeeded"] == 6
+        assert summary["latency_ms"]["ttft"] is not None
+        assert summary["latency_ms"]["inter_token"] is not None
+        assert summary["tokens_per_s"] > 0
+
+        summary = await run_closed_loop(
+            client, lambda i: {"model": "missing", "prompt": "x", "stream": False}, concurrency=2, requests=2,
+        )
+        assert summary["succeeded"] == 0 and summary["error_rate"] == 1.0
+
+async def test_open_loop_sends_requested_count(proxy_client):
+    """
+    测试开环模式按到达速率发满指定数量的请求。
+    """
+    async with proxy_client as client:
+        summary = await run_open_loop(
+            client, lambda i: {"model": "llama3", "prompt": f"p{i}", "stream": False}, rate=200, requests=5, seed=1,
+        )
+    assert summary["requests"] == 5 and summary["succeeded"] == 5 and summary["dropped"] == 0
@@ -0,0 +1,92 @@
+import httpx
+import pytest
+from fastapi import status
+from httpx import AsyncClient, Response as HttpxResponse
+
+from main import app, backend_registry
+from metrics import MetricsRegistry, ModelLabels
+
+pytestmark = pytest.mark.asyncio
+
+async def test_histogram_and_counter_rendering():
+    """
+    测试直方图的累计分桶、计数器的 _total 后缀、标签转义以及采集回调。
+    """
+    registry = MetricsRegistry()
+    requests = registry.counter("demo_requests", "请求数", ("model",))
+    latency = registry.histogram("demo_latency_seconds", "延迟", ("model",), (0.1, 1.0))
+    registry.gauge("demo_queue", "队列长度", collect=lambda: {(): 3})
+
+    requests.inc('m"1')
+    requests.inc('m"1', amount=2)
+    for value in (0.05, 0.5, 5.0):
+        latency.observe(value, "m")
+
+    text = registry.render()
+    assert '# TYPE demo_requests counter' in text
+    assert 'demo_requests_total{model="m\\"1"} 3' in text
+    assert 'demo_latency_seconds_bucket{model="m",le="0.1"} 1' in text
+    assert 'demo_latency_seconds_bucket{model="m",le="1"} 2' in text
+    assert 'demo_latency_seconds_bucket{model="m",le="+Inf"} 3' in text
+    assert 'demo_latency_seconds_sum{model="m"} 5.55' in text
+    assert 'demo_latency_seconds_count{model="m"} 3' in text
+    assert 'demo_queue 3' in text
+
+async def test_metrics_endpoint_records_generate(mocker):
+    """
+    测试非流式生成会记录请求数、耗时和生成速度，/metrics 能导出这些指标。
+    """
+    mock_http_response = mocker.Mock(spec=HttpxResponse)
+    mock_http_response.status_code = status.HTTP_200_OK
+    mock_http_response.json.return_value = {
+        "model": "metrics-model",
+        "response": "ok",
+        "done": True,
+        "eval_count": 50,
+        "eval_duration": 1_000_000_000,
+    }
+    mock_http_response.raise_for_status = mocker.Mock()
+    mocker.patch("main.upstream_pool.post", return_value=mock_http_response)
+    # 后端报告存在的模型使用自己的名字作为标签
+    mocker.patch.object(backend_registry.primary, "available_models", {"metrics-model:latest"})
+
+    async with AsyncClient(app=app, base_url="http://testserver") as client:
+        api_response = await client.post("/api/generate", json={"model": "metrics-model", "prompt": "你好"})
+        assert api_response.status_code == status.HTTP_200_OK
+        scrape = await client.get("/metrics")
+
+    assert scrape.status_code == status.HTTP_200_OK
+    assert scrape.headers["content-type"].startswith("text/plain; version=0.0.4")
+    text = scrape.text
+    assert 'ollama_proxy_requests_total{model="metrics-model:latest"' in text
+    assert 'ollama_proxy_request_duration_seconds_count{model="metrics-model:latest"' in text
+    assert "ollama_proxy_queue_wait_seconds_count" in text
+    assert "ollama_proxy_backend_in_flight{backend=" in text
+    assert "ollama_proxy_queue_length 0" in text
+    # 50 个 token / 1 秒
+    backend = f'backend="{backend_registry.primary.url}"'
+    assert f'ollama_proxy_tokens_per_second_sum{{model="metrics-model:latest",{backend}}} 50' in text
+
+async def test_unknown_model_names_do_not_create_series(mocker):
+    """
+    测试随意的模型名都记为 model="other"，指标的时间序列数不随模型名增长；上游成功处理过的模型保留名字。
+    """
+    not_found = mocker.Mock(spec=HttpxResponse)
+    not_found.status_code = status.HTTP_404_NOT_FOUND
+    not_found.text = "model not found"
+    error = httpx.HTTPStatusError("not found", request=httpx.Request("POST", "http://ollama"), response=not_found)
+    mocker.patch("main.upstream_pool.post", side_effect=error)
+
+    async with AsyncClient(app=app, base_url="http://testserver") as client:
+        for i in range(50):
+            response = await client.post("/api/generate", json={"model": f"random-{i}", "prompt": "你好"})
+            assert response.status_code == status.HTTP_404_NOT_FOUND
+        text = (await client.get("/metrics")).text
+
+    assert "random-" not in text
+    assert 'ollama_proxy_errors_total{model="other"' in text
+
+    labels = ModelLabels(lambda model: model == "known", max_confirmed=2)
+    assert labels.label("known") == "known" and labels.label("a") == "other"
+    assert labels.confirm("a") == "a" and labels.confirm("b") == "b"
+    assert labels.confirm("c") == "other"
@@ -0,0 +1,123 @@
+import asyncio
+import json
+import time
+
+import httpx
+import pytest
+
+from mock_ollama import MockSettings, create_app
+from upstream import UpstreamPool
+
+pytestmark = pytest.mark.asyncio
+
+def mock_client(**settings) -> httpx.AsyncClient:
+    app = create_app(MockSettings(**settings))
+    return httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://mock")
+
+async def test_generate_stream_and_non_stream_shapes():
+    """
+    测试流式响应为 Ollama 格式的 NDJSON，最后一行带 done 和耗时统计；非流式响应合并全部文本。
+    """
+    async with mock_client(output_tokens=5) as client:
+        response = await client.post("/api/generate", json={"model": "llama3", "prompt": "hi", "stream": True})
+        lines = [json.loads(line) for line in response.text.splitlines()]
+        assert [line["done"] for line in lines] == [False] * 5 + [True]
+        assert lines[-1]["eval_count"] == 5 and lines[-1]["model"] == "llama3:latest"
+
+        response = await client.post("/api/generate", json={
+            "model": "llama3", "prompt": "hi", "stream": False, "options": {"num_predict": 3},
+        })
+        data = response.json()
+        assert data["done"] and data["eval_count"] == 3
+        assert data["response"] == "".join(line["response"] for line in lines[:3])
+
+        response = await client.post("/api/generate", json={"model": "missing", "prompt": "hi"})
+        assert response.status_code == 404
+
+async def test_load_delay_and_token_rate():
+    """
+    测试第一个请求承担模型加载耗时，加载后 /api/ps 列出模型，生成耗时符合 tokens_per_second。
+    """
+    async with mock_client(load_delay=0.05, tokens_per_second=200, output_tokens=10) as client:
+        start = time.monotonic()
+        first = (await client.post("/api/generate", json={"model": "llama3", "prompt": "a", "stream": False})).json()
+        elapsed = time.monotonic() - start
+        assert first["load_duration"] >= 0.04e9
+        assert 0.09 < elapsed < 0.5
+
+        second = (await client.post("/api/generate", json={"model": "llama3", "prompt": "a", "stream": False})).json()
+        assert second["load_duration"] < 0.01e9
+
+        ps = (await client.get("/api/ps")).json()
+        assert [m["name"] for m in ps["models"]] == ["llama3:latest"]
+
+async def test_parallel_slots_queue_and_reject():
+    """
+    测试每个模型的并行槽位：超出的请求排队，队列满时返回 503。
+    """
+    async with mock_client(tokens_per_second=100, output_tokens=5, num_parallel=1, max_queue=1) as client:
+        payload = {"model": "llama3", "prompt": "a", "stream": False}
+        responses = await asyncio.gather(*(client.post("/api/generate", json=payload) for _ in range(3)))
+        assert sorted(r.status_code for r in responses) == [200, 200, 503]
+
+        stats = (await client.get("/mock/stats")).json()
+        assert stats["peak_active"] == 1 and stats["rejected_busy"] == 1
+
+async def test_stream_slot_released_when_body_never_sent():
+    """
+    测试客户端在第一次写入之前断开时，流式请求占用的并行槽位和 active 计数也会归还。
+    """
+    app = create_app(MockSettings(output_tokens=3, num_parallel=1))
+    body = json.dumps({"model": "llama3", "prompt": "a"}).encode()
+    scope = {
+        "type": "http", "asgi": {"version": "3.0", "spec_version": "2.3"}, "http_version": "1.1",
+        "method": "POST", "scheme": "http", "path": "/api/generate", "raw_path": b"/api/generate",
+        "query_string": b"", "root_path": "", "headers": [(b"content-type", b"application/json")],
+        "client": ("test", 1), "server": ("mock", 80),
+    }
+    messages = [{"type": "http.request", "body": body, "more_body": False}]
+
+    async def receive():
+        if messages:
+            return messages.pop(0)
+        await asyncio.Event().wait()
+
+    async def send(message):
+        raise OSError("client disconnected")
+
+    with pytest.raises(OSError):
+        await app(scope, receive, send)
+    stats = app.state.mock.stats
+    assert stats.active == 0 and stats.cancelled == 1
+
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://mock") as client:
+        response = await asyncio.wait_for(client.post("/api/generate", json={"model": "llama3", "prompt": "b"}), 1)
+    assert response.status_code == 200
+    assert stats.active == 0 and stats.completed == 1
+
+async def test_error_injection_and_admin_endpoints():
+    """
+    测试错误注入，以及 /api/version、/api/tags 和 /api/delete。
+    """
+    async with mock_client(error_rate=1.0, error_status=502) as client:
+        response = await client.post("/api/generate", json={"model": "llama3", "prompt": "a"})
+        assert response.status_code == 502
+        assert (await client.get("/api/version")).json()["version"].endswith("mock")
+        assert len((await client.get("/api/tags")).json()["models"]) == 2
+        assert (await client.request("DELETE", "/api/delete", json={"name": "qwen2:7b"})).status_code == 200
+        assert (await client.request("DELETE", "/api/delete", json={"name": "qwen2:7b"})).status_code == 404
+
+async def test_proxy_against_mock_upstream(mocker):
+    """
+    测试通过 transport_factory 把代理的上游连接池接到模拟服务。
+    """
+    import main
+
+    app = create_app(MockSettings(output_tokens=4))
+    pool = UpstreamPool(10, 5, 5.0, 1.0, {}, transport_factory=lambda url: httpx.ASGITransport(app=app))
+    mocker.patch("main.upstream_pool", pool)
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://proxy") as client:
+        response = await client.post("/api/generate", json={"model": "llama3", "prompt": "mock proxy", "stream": False})
+    assert response.status_code == 200
+    assert response.json()["eval_count"] == 4
+    assert app.state.mock.stats.completed == 1
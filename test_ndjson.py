@@ -0,0 +1,49 @@
+import json
+
+import pytest
+
+from ndjson import available_decoders, iter_ndjson_lines, make_decoder
+
+pytestmark = pytest.mark.asyncio
+
+async def split_bytes(data: bytes, size: int):
+    for i in range(0, len(data), size):
+        yield data[i:i + size]
+
+async def test_lines_survive_arbitrary_chunk_boundaries():
+    """
+    测试任意切分的字节块（包括切在多字节字符中间）都能还原为完整的行，
+    并跳过空行、处理 CRLF 和没有换行结尾的最后一行。
+    """
+    frames = [{"response": "你好", "done": False}, {"response": "世界", "done": False}, {"response": "", "done": True}]
+    data = (
+        json.dumps(frames[0], ensure_ascii=False) + "\r\n\n"
+        + json.dumps(frames[1], ensure_ascii=False) + "\n  \n"
+        + json.dumps(frames[2])
+    ).encode("utf-8")
+
+    for size in (1, 2, 3, 7, len(data)):
+        lines = [line async for line in iter_ndjson_lines(split_bytes(data, size))]
+        assert [json.loads(line) for line in lines] == frames
+
+@pytest.mark.parametrize("name", available_decoders())
+async def test_decoders_extract_text_and_final_frame(name):
+    """
+    测试各解码器只在最后一帧返回完整内容，无法解析的行抛出 ValueError。
+    """
+    decoder = make_decoder(name)
+    assert decoder.name == name
+    assert decoder.decode('{"response":"你","done":false,"context":[1,2]}'.encode("utf-8")) == ("你", False, None)
+
+    text, done, final = decoder.decode(b'{"model":"m","response":"","done":true,"eval_count":3}')
+    assert (text, done) == ("", True)
+    assert final["eval_count"] == 3 and final["model"] == "m"
+
+    with pytest.raises(ValueError):
+        decoder.decode(b"{not json")
+
+async def test_unknown_decoder_falls_back_to_json():
+    """
+    测试未知的解码器名称回退到标准库 json。
+    """
+    assert make_decoder("simdjson").name == "json"
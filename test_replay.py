@@ -0,0 +1,47 @@
+import httpx
+import pytest
+
+from mock_ollama import MockSettings, create_app
+from replay import build_payload, load_records, replay, synthetic_prompt
+from upstream import UpstreamPool
+
+pytestmark = pytest.mark.asyncio
+
+async def test_payload_from_hashed_record_is_deterministic():
+    """
+    测试只有 prompt 哈希的记录每次生成相同的占位 prompt，并按需还原输出长度和优先级。
+    """
+    record = {"ts": 1.0, "model": "llama3", "stream": True, "prompt_sha256": "ab" * 32, "prompt_chars": 40,
+              "options": {"temperature": 0.2}, "eval_count": 7, "priority": "batch"}
+    first = build_payload(record, match_output=True)
+    assert first == build_payload(record, match_output=True)
+    assert len(first["prompt"]) == 40
+    assert first["options"] == {"temperature": 0.2, "num_predict": 7}
+    assert first["priority"] == "batch"
+    assert "stream_format" not in build_payload(dict(record, stream_format="sse"))
+    assert build_payload(dict(record, prompt="原文"), model="other")["prompt"] == "原文"
+    assert synthetic_prompt({"prompt_chars": 5}) == synthetic_prompt({"prompt_chars": 5})
+
+async def test_replay_scales_original_timing(tmp_path, mocker):
+    """
+    测试按原始到达间隔除以 speed 重放，并跳过原来失败的请求。
+    """
+    import main
+
+    path = tmp_path / "traffic.jsonl"
+    path.write_text(
+        '{"ts": 100.4, "model": "llama3", "stream": false, "prompt_chars": 3, "outcome": "ok"}\n'
+        '{"ts": 100.0, "model": "llama3", "stream": true, "prompt_chars": 3, "outcome": "ok"}\n'
+        '{"ts": 100.1, "model": "llama3", "stream": false, "prompt_chars": 3, "outcome": "error"}\n',
+        encoding="utf-8",
+    )
+    records = load_records(str(path), only_ok=True)
+    assert [r["ts"] for r in records] == [100.0, 100.4]
+
+    upstream = create_app(MockSettings(output_tokens=2))
+    pool = UpstreamPool(10, 5, 5.0, 1.0, {}, transport_factory=lambda url: httpx.ASGITransport(app=upstream))
+    mocker.patch("main.upstream_pool", pool)
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=main.app), base_url="http://proxy") as client:
+        summary = await replay(client, records, speed=2)
+    assert summary["succeeded"] == 2
+    assert 0.19 < summary["wall_time_s"] < 1.0
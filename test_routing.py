@@ -0,0 +1,147 @@
+import pytest
+
+from routing import (
+    BackendRegistry,
+    LeastOutstandingRequestsPolicy,
+    LeastOutstandingTokensPolicy,
+    RoundRobinPolicy,
+    Router,
+    make_policy,
+)
+from scheduler import AdmissionController
+
+pytestmark = pytest.mark.asyncio
+
+def make_router(policy, backends=(("http://a", 1.0), ("http://b", 1.0))) -> Router:
+    return Router(BackendRegistry(list(backends)), policy)
+
+async def test_round_robin_respects_weights():
+    """
+    测试平滑加权轮询按权重分配请求，且不会连续打到同一个后端。
+    """
+    router = make_router(RoundRobinPolicy(), (("http://a", 2.0), ("http://b", 1.0)))
+    picks = [router.choose("m").url for _ in range(6)]
+    assert picks.count("http://a") == 4
+    assert picks.count("http://b") == 2
+    assert picks[:3] == ["http://a", "http://b", "http://a"]
+
+async def test_least_requests_prefers_idle_backend():
+    """
+    测试最少未完成请求策略会避开正在处理请求的后端。
+    """
+    router = make_router(LeastOutstandingRequestsPolicy())
+    admission_controller = AdmissionController(router, 0, 0, 8, 1)
+    first = await admission_controller.acquire("m")
+    second = await admission_controller.acquire("m")
+    assert first.backend is not second.backend
+    first.release()
+    second.release()
+    assert all(b.outstanding_requests == 0 for b in router.registry.all())
+
+async def test_least_tokens_uses_token_estimate():
+    """
+    测试最少未完成 token 策略按 token 估算量选择后端。
+    """
+    router = make_router(LeastOutstandingTokensPolicy())
+    admission_controller = AdmissionController(router, 0, 0, 8, 1)
+    busy = await admission_controller.acquire("m", tokens=1000)
+    other = await admission_controller.acquire("m", tokens=10)
+    third = await admission_controller.acquire("m", tokens=10)
+    assert other.backend is not busy.backend
+    assert third.backend is other.backend
+    for admission in (busy, other, third):
+        admission.release()
+    assert all(b.outstanding_tokens == 0 for b in router.registry.all())
+
+async def test_unknown_policy():
+    """
+    测试未知的路由策略名称抛出 ValueError。
+    """
+    with pytest.raises(ValueError):
+        make_policy("random")
+
+async def test_model_affinity_prefers_loaded_then_available():
+    """
+    测试模型亲和：优先已加载的后端，其次是磁盘上有模型且负载最低的后端。
+    """
+    registry = BackendRegistry([("http://a", 1.0), ("http://b", 1.0), ("http://c", 1.0)])
+    a, b, c = registry.all()
+    a.available_models = {"llama3:latest"}
+    b.loaded_models = {"qwen:7b"}
+    c.available_models = {"llama3:latest", "qwen:7b"}
+    router = Router(registry, RoundRobinPolicy())
+
+    assert router.choose("qwen:7b") is b
+    a.outstanding_requests = 2
+    # 请求中未带标签的模型名按 ':latest' 匹配，并选择负载更低的 c
+    assert router.choose("llama3") is c
+    # c 已被乐观地记为加载了 llama3，之后的请求都会命中它
+    assert router.choose("llama3") is c
+    assert router.affinity_hits == {"loaded": 2, "available": 1, "fallback": 0}
+
+    registry.forget_model("llama3", "http://c")
+    assert not c.has_available("llama3:latest")
+    assert a.has_available("llama3:latest")
+    registry.forget_model("llama3")
+    assert not a.has_available("llama3:latest")
+
+async def test_model_affinity_spills_when_saturated():
+    """
+    测试已加载模型的后端饱和时，请求会溢出到磁盘上有该模型的后端。
+    """
+    registry = BackendRegistry([("http://a", 1.0), ("http://b", 1.0)])
+    a, b = registry.all()
+    a.loaded_models = {"m:latest"}
+    b.available_models = {"m:latest"}
+    router = Router(registry, RoundRobinPolicy(), affinity_max_outstanding=2)
+    a.outstanding_requests = 2
+    assert router.choose("m") is b
+
+async def test_model_state_poller_refresh():
+    """
+    测试后台拉取会根据 /api/ps 和 /api/tags 更新模型状态，失败的后端保留原状态。
+    """
+    import httpx
+    from routing import ModelStatePoller
+    from upstream import UpstreamPool
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        if request.url.host == "b":
+            raise httpx.ConnectError("down", request=request)
+        if request.url.path == "/api/ps":
+            return httpx.Response(200, json={"models": [{"name": "qwen:7b"}]})
+        return httpx.Response(200, json={"models": [{"name": "qwen:7b"}, {"name": "llama3"}]})
+
+    pool = UpstreamPool(10, 5, 5.0, 1.0, {}, transport_factory=lambda url: httpx.MockTransport(handler))
+    registry = BackendRegistry([("http://a", 1.0), ("http://b", 1.0)])
+    registry.get("http://b").loaded_models = {"old:latest"}
+    await ModelStatePoller(registry, pool, interval=60).refresh_once()
+
+    a = registry.get("http://a")
+    assert a.loaded_models == {"qwen:7b"}
+    assert a.available_models == {"qwen:7b", "llama3:latest"}
+    assert registry.get("http://b").loaded_models == {"old:latest"}
+    await pool.aclose()
+
+async def test_least_tokens_routing_uses_num_predict(mocker):
+    """
+    测试准入和最少 token 路由按请求的 num_predict 估算输出长度。
+    """
+    import main
+
+    registry = BackendRegistry([("http://a", 1.0), ("http://b", 1.0)])
+    router = Router(registry, LeastOutstandingTokensPolicy(), model_affinity=False)
+    mocker.patch("main.admission_controller", AdmissionController(router, 0, 0, 8, 1))
+
+    def request(num_predict):
+        return main.OllamaRequest(model="m", prompt="p", options={"num_predict": num_predict})
+
+    long = await main.acquire_admission(request(4096))
+    short = await main.acquire_admission(request(8))
+    assert long.tokens > 4096 and short.tokens < 16
+    assert long.backend is not short.backend
+    # 另一个长请求应发往只有短请求的后端
+    following = await main.acquire_admission(request(4096))
+    assert following.backend is short.backend
+    for admission in (long, short, following):
+        admission.release()
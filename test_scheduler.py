@@ -0,0 +1,186 @@
+import asyncio
+
+import pytest
+
+from routing import BackendRegistry, LeastOutstandingRequestsPolicy, Router
+from scheduler import AdmissionController, AdmissionRejected
+
+pytestmark = pytest.mark.asyncio
+
+def make_controller(backends=1, max_per_backend=1, max_per_model=0, max_queue=2, queue_timeout=1.0) -> AdmissionController:
+    registry = BackendRegistry([(f"http://b{i}", 1.0) for i in range(backends)])
+    router = Router(registry, LeastOutstandingRequestsPolicy(), model_affinity=False)
+    return AdmissionController(router, max_per_backend, max_per_model, max_queue, queue_timeout)
+
+async def test_queue_then_admit_in_order():
+    """
+    测试后端已满时请求排队，名额释放后按先后顺序准入并记录排队时间。
+    """
+    controller = make_controller()
+    first = await controller.acquire("m")
+    assert first.queue_wait == 0.0
+
+    second = asyncio.ensure_future(controller.acquire("m"))
+    third = asyncio.ensure_future(controller.acquire("m"))
+    await asyncio.sleep(0)
+    assert len(controller.queue) == 2
+
+    first.release()
+    first.release()  # 重复释放不应多归还名额
+    admission = await second
+    assert admission.backend.outstanding_requests == 1
+    assert not third.done()
+
+    admission.release()
+    (await third).release()
+    stats = controller.stats()
+    assert stats["admitted"] == 3 and stats["queued"] == 2
+    assert stats["queue_wait_ms"]["max"] >= 0
+    assert controller.router.registry.primary.outstanding_requests == 0
+
+async def test_queue_full_and_timeout_are_rejected():
+    """
+    测试队列已满返回 429，排队超时返回 503，且都带 Retry-After。
+    """
+    controller = make_controller(max_queue=1, queue_timeout=0.05)
+    held = await controller.acquire("m")
+    waiting = asyncio.ensure_future(controller.acquire("m"))
+    await asyncio.sleep(0)
+
+    with pytest.raises(AdmissionRejected) as full:
+        await controller.acquire("m")
+    assert full.value.status_code == 429 and full.value.retry_after >= 1
+
+    with pytest.raises(AdmissionRejected) as timeout:
+        await waiting
+    assert timeout.value.status_code == 503
+    assert len(controller.queue) == 0
+    held.release()
+
+async def test_per_model_limit_does_not_block_other_models():
+    """
+    测试模型并发上限只限制该模型，其他模型的请求不受队首阻塞影响。
+    """
+    controller = make_controller(backends=2, max_per_backend=0, max_per_model=1)
+    a = await controller.acquire("a")
+    blocked = asyncio.ensure_future(controller.acquire("a"))
+    await asyncio.sleep(0)
+    b = await asyncio.wait_for(controller.acquire("b"), 0.5)
+    assert not blocked.done()
+    a.release()
+    (await blocked).release()
+    b.release()
+    assert controller.model_in_flight == {}
+
+async def test_cancelled_waiter_leaves_queue():
+    """
+    测试排队中的请求被取消时移出队列，不占用名额。
+    """
+    controller = make_controller()
+    held = await controller.acquire("m")
+    waiting = asyncio.ensure_future(controller.acquire("m"))
+    await asyncio.sleep(0)
+    waiting.cancel()
+    await asyncio.gather(waiting, return_exceptions=True)
+    assert len(controller.queue) == 0
+    held.release()
+    assert controller.router.registry.primary.outstanding_requests == 0
+
+async def test_high_priority_jumps_queue_and_low_ages():
+    """
+    测试高优先级请求先于排在前面的低优先级请求准入，
+    而等待足够久的低优先级请求会被提升，不会饿死。
+    """
+    controller = make_controller(max_queue=10)
+    held = await controller.acquire("m")
+    low = asyncio.ensure_future(controller.acquire("m", priority="low"))
+    await asyncio.sleep(0)
+    high = asyncio.ensure_future(controller.acquire("m", priority="high"))
+    await asyncio.sleep(0)
+
+    held.release()
+    first = await high
+    assert not low.done()
+    first.release()
+    (await low).release()
+
+    # 人为让低优先级请求“等待”超过两个老化周期
+    controller.queue.aging_interval = 0.01
+    held = await controller.acquire("m")
+    low = asyncio.ensure_future(controller.acquire("m", priority="low"))
+    await asyncio.sleep(0.03)
+    high = asyncio.ensure_future(controller.acquire("m", priority="high"))
+    await asyncio.sleep(0)
+    held.release()
+    first = await low
+    assert not high.done()
+    first.release()
+    (await high).release()
+
+    stats = controller.stats()["priorities"]
+    assert stats["high"]["latency_ms"]["count"] == 2
+    assert stats["low"]["queue_wait_ms"]["count"] == 2
+
+async def test_weighted_fair_queue_shares_by_tenant_weight():
+    """
+    测试争用时按租户权重分配名额：权重 3:1 的两个租户各自大量排队，
+    前 8 个准入中 heavy 占 6 个；且单个租户排队数受限。
+    """
+    registry = BackendRegistry([("http://b0", 1.0)])
+    router = Router(registry, LeastOutstandingRequestsPolicy(), model_affinity=False)
+    controller = AdmissionController(
+        router, max_per_backend=1, max_per_model=0, max_queue=100, queue_timeout=5,
+        tenant_weights={"heavy": 3.0, "light": 1.0}, max_queue_per_tenant=20,
+    )
+    held = await controller.acquire("m")
+    order = []
+
+    async def request(tenant):
+        admission = await controller.acquire("m", tokens=10, tenant=tenant)
+        order.append(tenant)
+        await asyncio.sleep(0)
+        admission.release()
+
+    # light 先把队列塞满，heavy 随后到达
+    tasks = [asyncio.ensure_future(request("light")) for _ in range(10)]
+    await asyncio.sleep(0)
+    tasks += [asyncio.ensure_future(request("heavy")) for _ in range(10)]
+    await asyncio.sleep(0)
+    held.release()
+    await asyncio.gather(*tasks)
+
+    assert order[:8].count("heavy") == 6
+    assert controller.stats()["tenants"]["heavy"]["admitted"] == 10
+
+    controller.max_queue_per_tenant = 1
+    held = await controller.acquire("m")
+    waiting = asyncio.ensure_future(controller.acquire("m", tenant="light"))
+    await asyncio.sleep(0)
+    with pytest.raises(AdmissionRejected):
+        await controller.acquire("m", tenant="light")
+    # 其他租户不受 light 排队上限的影响
+    other = asyncio.ensure_future(controller.acquire("m", tenant="heavy"))
+    await asyncio.sleep(0)
+    assert len(controller.queue) == 2
+    held.release()
+    for next_admission in asyncio.as_completed([waiting, other]):
+        (await next_admission).release()
+
+async def test_idle_tenants_are_pruned(monkeypatch):
+    """
+    测试空闲超过 tenant_idle_ttl 的租户从统计和公平队列中移除，进行中的租户保留。
+    """
+    controller = make_controller(max_per_backend=2)
+    controller.tenant_idle_ttl = 60
+    now = 1000.0
+    monkeypatch.setattr("scheduler.time.monotonic", lambda: now)
+    controller._tenants_pruned_at = now
+    (await controller.acquire("m", tenant="idle")).release()
+    busy = await controller.acquire("m", tenant="busy")
+    assert set(controller.stats()["tenants"]) == {"idle", "busy"}
+
+    now += 61
+    (await controller.acquire("m", tenant="fresh")).release()
+    assert set(controller.stats()["tenants"]) == {"busy", "fresh"}
+    assert "idle" not in controller.queue._last_finish
+    busy.release()
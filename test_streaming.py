@@ -0,0 +1,115 @@
+import asyncio
+import json
+import time
+
+import pytest
+
+from streaming import RawFormat, coalesce_tokens, make_format
+
+pytestmark = pytest.mark.asyncio
+
+RAW = RawFormat()
+
+async def tokens(parts, delay: float = 0.0):
+    for part in parts:
+        if delay:
+            await asyncio.sleep(delay)
+        else:
+            await asyncio.sleep(0)
+        yield part
+
+async def test_fast_tokens_are_batched_after_first():
+    """
+    测试连续到达的 token 被合并为少量写入，第一个 token 立即单独输出。
+    """
+    parts = [f"t{i} " for i in range(50)]
+    writes = [chunk async for chunk in coalesce_tokens(tokens(parts), RAW, max_bytes=1024, max_delay=0.05)]
+
+    assert b"".join(writes).decode("utf-8") == "".join(parts)
+    assert writes[0] == b"t0 "
+    assert len(writes) <= 3
+
+async def test_byte_threshold_flushes_before_time_budget():
+    """
+    测试缓冲达到字节阈值时立即输出，不等待时间预算。
+    """
+    start = time.monotonic()
+    writes = [chunk async for chunk in coalesce_tokens(tokens(["ab"] * 10), RAW, max_bytes=4, max_delay=10)]
+
+    assert time.monotonic() - start < 1
+    assert b"".join(writes) == b"ab" * 10
+    assert all(len(chunk) <= 4 for chunk in writes[1:])
+
+async def test_slow_tokens_flush_within_time_budget():
+    """
+    测试 token 间隔大于时间预算时，每个 token 在预算内输出，而不是等下一个 token。
+    """
+    arrivals = []
+    async for chunk in coalesce_tokens(tokens(["a", "b", "c"], delay=0.1), RAW, max_bytes=1024, max_delay=0.02):
+        arrivals.append((chunk, time.monotonic()))
+
+    assert [chunk for chunk, _ in arrivals] == [b"a", b"b", b"c"]
+    gaps = [b - a for (_, a), (_, b) in zip(arrivals, arrivals[1:])]
+    assert all(0.05 < gap < 0.2 for gap in gaps)
+
+async def test_errors_propagate_after_buffered_output():
+    """
+    测试上游出错时先写出已缓冲的输出，再抛出异常。
+    """
+    async def failing():
+        yield "ok"
+        yield "more"
+        raise RuntimeError("upstream broke")
+
+    received = []
+    with pytest.raises(RuntimeError, match="upstream broke"):
+        async for chunk in coalesce_tokens(failing(), RAW, max_bytes=1024, max_delay=0.01):
+            received.append(chunk)
+    assert b"".join(received) == b"okmore"
+
+async def test_closing_output_cancels_source():
+    """
+    测试客户端离开（输出生成器被关闭）时上游读取被取消。
+    """
+    closed = asyncio.Event()
+
+    async def endless():
+        try:
+            while True:
+                await asyncio.sleep(0.001)
+                yield "x"
+        finally:
+            closed.set()
+
+    stream = coalesce_tokens(endless(), RAW, max_bytes=8, max_delay=0.01)
+    assert await stream.__anext__() == b"x"
+    await stream.aclose()
+    assert closed.is_set()
+
+async def test_zero_budget_passes_chunks_through():
+    """
+    测试时间预算为 0 时每个 token 单独写出。
+    """
+    writes = [chunk async for chunk in coalesce_tokens(tokens(["你", "好"]), RAW, max_bytes=1024, max_delay=0)]
+    assert writes == ["你".encode("utf-8"), "好".encode("utf-8")]
+
+async def test_formats_frame_tokens_and_terminal_events():
+    """
+    测试三种输出格式对 token、结束事件和错误事件的编码，文本中的换行和引号不会破坏帧。
+    """
+    items = ['说"你\n好', {"done": True, "eval_count": 2}]
+
+    ndjson = b"".join(make_format("ndjson").encode(item) for item in items).decode("utf-8")
+    lines = [json.loads(line) for line in ndjson.splitlines()]
+    assert lines == [{"response": '说"你\n好', "done": False}, {"done": True, "eval_count": 2}]
+    assert json.loads(make_format("ndjson").encode({"error": "x"})) == {"error": "x", "done": True}
+
+    sse = make_format("sse")
+    events = b"".join(sse.encode(item) for item in items).decode("utf-8").split("\n\n")
+    assert json.loads(events[0][len("data: "):]) == {"response": '说"你\n好'}
+    assert events[1].startswith("event: done\ndata: ")
+    assert sse.encode({"error": "x"}).startswith(b"event: error\ndata: ")
+    assert sse.media_type.startswith("text/event-stream")
+
+    assert make_format("raw").encode(items[1]) == b""
+    assert make_format("raw", include_metadata=True).encode(items[1]).startswith(b"data: ")
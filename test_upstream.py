@@ -0,0 +1,107 @@
+import asyncio
+import pytest
+import httpx
+
+from upstream import StreamDeadlines, StreamTimeout, UpstreamPool
+
+pytestmark = pytest.mark.asyncio
+
+def make_pool(handler) -> UpstreamPool:
+    """
+    创建一个使用 MockTransport 的连接池。
+    """
+    return UpstreamPool(
+        max_connections=10,
+        max_keepalive_connections=5,
+        keepalive_expiry=5.0,
+        connect_timeout=1.0,
+        timeouts={"generate": 2.0},
+        transport_factory=lambda base_url: httpx.MockTransport(handler),
+    )
+
+async def test_client_is_shared_per_backend():
+    """
+    测试同一后端复用同一个客户端，不同后端使用不同客户端。
+    """
+    pool = make_pool(lambda request: httpx.Response(200, json={}))
+    assert pool.client("http://a:11434") is pool.client("http://a:11434")
+    assert pool.client("http://a:11434") is not pool.client("http://b:11434")
+    await pool.aclose()
+
+async def test_request_stats_and_timeout():
+    """
+    测试请求计数、超时配置和错误统计。
+    """
+    seen = {}
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        seen["timeout"] = request.extensions["timeout"]
+        if request.url.path == "/api/fail":
+            raise httpx.ConnectError("boom", request=request)
+        return httpx.Response(200, json={"ok": True})
+
+    pool = make_pool(handler)
+    response = await pool.post("http://a:11434", "/api/generate", kind="generate", json={})
+    assert response.json() == {"ok": True}
+    assert seen["timeout"]["read"] == 2.0
+    assert seen["timeout"]["connect"] == 1.0
+
+    with pytest.raises(httpx.ConnectError):
+        await pool.get("http://a:11434", "/api/fail", kind="health")
+
+    stats = pool.stats()["backends"]["http://a:11434"]
+    assert stats["requests"] == 2
+    assert stats["errors"] == 1
+    assert stats["in_flight"] == 0
+    await pool.aclose()
+
+async def test_stream_tracks_in_flight():
+    """
+    测试流式请求期间 in_flight 计数正确。
+    """
+    pool = make_pool(lambda request: httpx.Response(200, content=b'{"response":"hi"}\n'))
+    async with pool.stream("POST", "http://a:11434", "/api/generate", kind="stream", json={}) as response:
+        assert pool.stats_for("http://a:11434").in_flight == 1
+        body = await response.aread()
+    assert body == b'{"response":"hi"}\n'
+    assert pool.stats_for("http://a:11434").in_flight == 0
+    await pool.aclose()
+
+async def tokens_with_gaps(gaps, deadlines, consume_delay: float = 0.0):
+    """按给定间隔产生 token，每个 token 交给下游后等待 consume_delay 秒"""
+    async with deadlines:
+        for gap in gaps:
+            await asyncio.sleep(gap)
+            deadlines.suspend()
+            await asyncio.sleep(consume_delay)
+            deadlines.resume()
+
+async def test_stream_deadlines_by_phase():
+    """
+    测试首 token、token 间隔和总耗时分别超限时抛出对应阶段的 StreamTimeout。
+    """
+    await tokens_with_gaps([0.05, 0.01, 0.01], StreamDeadlines(0.1, 0.03, 1))
+
+    with pytest.raises(StreamTimeout) as e:
+        await tokens_with_gaps([0.1], StreamDeadlines(0.03, 1, 1))
+    assert e.value.phase == "first_token"
+
+    # 首 token 等待时间较长，之后的间隔截止时间更短，需要提前触发
+    with pytest.raises(StreamTimeout) as e:
+        await tokens_with_gaps([0.05, 0.2], StreamDeadlines(1, 0.03, 1))
+    assert e.value.phase == "inter_token"
+
+    with pytest.raises(StreamTimeout) as e:
+        await tokens_with_gaps([0.02] * 10, StreamDeadlines(1, 1, 0.1))
+    assert e.value.phase == "total"
+
+async def test_stream_deadlines_ignore_downstream_time():
+    """
+    测试下游消费 token 的时间不计入 token 间隔，但超过总耗时时在 resume() 抛出。
+    """
+    await tokens_with_gaps([0.01, 0.01], StreamDeadlines(1, 0.03, 1), consume_delay=0.1)
+
+    with pytest.raises(StreamTimeout) as e:
+        await tokens_with_gaps([0.01, 0.01], StreamDeadlines(1, 1, 0.05), consume_delay=0.1)
+    assert e.value.phase == "total"
+    assert not asyncio.current_task().cancelling()
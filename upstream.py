@@ -0,0 +1,280 @@
+"""
+上游 Ollama 连接池。
+
+每个 Ollama 后端（基础地址）对应一个长期存活的 httpx.AsyncClient，
+由应用的 lifespan 负责创建和关闭，所有处理函数共享这些连接，
+避免每个请求都重新建立 TCP 连接和连接池。
+
+StreamDeadlines 为流式生成分别限制首 token、token 间隔和总耗时。
+"""
+import asyncio
+import math
+from contextlib import asynccontextmanager
+from dataclasses import dataclass
+from typing import Any, AsyncIterator, Callable, Dict, Optional
+
+import httpx
+
+
+@dataclass
+class BackendPoolStats:
+    """单个后端的连接池统计"""
+    requests: int = 0
+    errors: int = 0
+    in_flight: int = 0
+    new_connections: int = 0
+
+    def to_dict(self) -> Dict[str, Any]:
+        reused = max(self.requests - self.new_connections, 0)
+        return {
+            "requests": self.requests,
+            "errors": self.errors,
+            "in_flight": self.in_flight,
+            "new_connections": self.new_connections,
+            "reused_connections": reused,
+            "reuse_ratio": round(reused / self.requests, 4) if self.requests else None,
+        }
+
+
+class UpstreamPool:
+    """
+    按后端地址管理共享的 httpx.AsyncClient。
+
+    客户端在第一次使用时创建（因此在没有运行 lifespan 的测试环境中也能工作），
+    在 aclose() 时统一关闭。
+    """
+
+    def __init__(
+        self,
+        max_connections: int,
+        max_keepalive_connections: int,
+        keepalive_expiry: float,
+        connect_timeout: float,
+        timeouts: Dict[str, float],
+        transport_factory: Optional[Callable[[str], httpx.AsyncBaseTransport]] = None,
+    ):
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry,
+        )
+        self.connect_timeout = connect_timeout
+        self.timeouts = dict(timeouts)
+        # 可选：为每个后端指定自定义传输层（测试和基准测试中用于接入模拟服务）
+        self.transport_factory = transport_factory
+        self._clients: Dict[str, httpx.AsyncClient] = {}
+        self._stats: Dict[str, BackendPoolStats] = {}
+
+    def timeout(self, kind: str) -> httpx.Timeout:
+        """返回指定调用类型的超时配置"""
+        return httpx.Timeout(self.timeouts.get(kind, 60.0) or None, connect=self.connect_timeout)
+
+    def client(self, base_url: str) -> httpx.AsyncClient:
+        """获取（必要时创建）指定后端的共享客户端"""
+        client = self._clients.get(base_url)
+        if client is None or client.is_closed:
+            transport = self.transport_factory(base_url) if self.transport_factory else None
+            client = httpx.AsyncClient(base_url=base_url, limits=self.limits, transport=transport)
+            self._clients[base_url] = client
+            self._stats.setdefault(base_url, BackendPoolStats())
+        return client
+
+    def stats_for(self, base_url: str) -> BackendPoolStats:
+        return self._stats.setdefault(base_url, BackendPoolStats())
+
+    def _trace(self, stats: BackendPoolStats):
+        # httpcore 只有在建立新连接时才会触发 connect_tcp 事件，借此统计连接复用率
+        async def trace(event_name: str, info: Dict[str, Any]) -> None:
+            if event_name == "connection.connect_tcp.complete":
+                stats.new_connections += 1
+        return trace
+
+    async def request(
+        self,
+        method: str,
+        base_url: str,
+        path: str,
+        *,
+        kind: str,
+        timeout: Optional[httpx.Timeout] = None,
+        **kwargs: Any,
+    ) -> httpx.Response:
+        """向指定后端发送请求并记录连接池统计"""
+        client = self.client(base_url)
+        stats = self.stats_for(base_url)
+        stats.requests += 1
+        stats.in_flight += 1
+        try:
+            return await client.request(
+                method,
+                path,
+                timeout=timeout or self.timeout(kind),
+                extensions={"trace": self._trace(stats)},
+                **kwargs,
+            )
+        except httpx.RequestError:
+            stats.errors += 1
+            raise
+        finally:
+            stats.in_flight -= 1
+
+    async def get(self, base_url: str, path: str, *, kind: str, **kwargs: Any) -> httpx.Response:
+        return await self.request("GET", base_url, path, kind=kind, **kwargs)
+
+    async def post(self, base_url: str, path: str, *, kind: str, **kwargs: Any) -> httpx.Response:
+        return await self.request("POST", base_url, path, kind=kind, **kwargs)
+
+    async def delete(self, base_url: str, path: str, *, kind: str, **kwargs: Any) -> httpx.Response:
+        return await self.request("DELETE", base_url, path, kind=kind, **kwargs)
+
+    @asynccontextmanager
+    async def stream(
+        self,
+        method: str,
+        base_url: str,
+        path: str,
+        *,
+        kind: str,
+        timeout: Optional[httpx.Timeout] = None,
+        **kwargs: Any,
+    ) -> AsyncIterator[httpx.Response]:
+        """以流式方式向指定后端发送请求"""
+        client = self.client(base_url)
+        stats = self.stats_for(base_url)
+        stats.requests += 1
+        stats.in_flight += 1
+        try:
+            async with client.stream(
+                method,
+                path,
+                timeout=timeout or self.timeout(kind),
+                extensions={"trace": self._trace(stats)},
+                **kwargs,
+            ) as response:
+                yield response
+        except httpx.RequestError:
+            stats.errors += 1
+            raise
+        finally:
+            stats.in_flight -= 1
+
+    def stats(self) -> Dict[str, Any]:
+        """返回连接池配置和每个后端的统计信息"""
+        return {
+            "limits": {
+                "max_connections": self.limits.max_connections,
+                "max_keepalive_connections": self.limits.max_keepalive_connections,
+                "keepalive_expiry": self.limits.keepalive_expiry,
+            },
+            "timeouts": dict(self.timeouts),
+            "backends": {url: s.to_dict() for url, s in self._stats.items()},
+        }
+
+    async def aclose(self) -> None:
+        """关闭所有共享客户端"""
+        clients = list(self._clients.values())
+        self._clients.clear()
+        for client in clients:
+            await client.aclose()
+
+
+class StreamTimeout(Exception):
+    """流式生成超过了某个阶段的截止时间"""
+
+    def __init__(self, phase: str, limit: float):
+        self.phase = phase
+        self.limit = limit
+        super().__init__(f"{phase} 超过 {limit} 秒")
+
+
+class StreamTruncated(Exception):
+    """上游流在结束帧（done）之前关闭"""
+
+    def __init__(self):
+        super().__init__("上游流在完成前结束")
+
+
+class StreamDeadlines:
+    """
+    流式生成的分阶段截止时间：首 token、相邻 token 间隔和总耗时，0 表示不限制。
+
+        async with StreamDeadlines(first_token, inter_token, total) as deadlines:
+            async for token in upstream:
+                deadlines.suspend()
+                yield token
+                deadlines.resume()
+
+    超时时取消进入上下文的 task，退出上下文时转换为 StreamTimeout。整个生成只用一个
+    定时器：到期回调发现截止时间已被推后时重新安排，不会为每个 token 创建定时器。
+    suspend() 和 resume() 之间是下游消费 token 的时间，不计入 token 间隔；
+    此期间到达总耗时上限时由 resume() 直接抛出。
+    """
+
+    def __init__(self, first_token: float, inter_token: float, total: float):
+        self.first_token = first_token
+        self.inter_token = inter_token
+        self.total = total
+        self.phase = "first_token"
+        self.expired: Optional[str] = None
+        self._suspended = False
+        self._token_at = math.inf
+        self._total_at = math.inf
+        self._timer: Optional[asyncio.TimerHandle] = None
+        self._timer_at = math.inf
+
+    async def __aenter__(self) -> "StreamDeadlines":
+        self._loop = asyncio.get_running_loop()
+        self._task = asyncio.current_task()
+        now = self._loop.time()
+        self._token_at = now + self.first_token if self.first_token > 0 else math.inf
+        self._total_at = now + self.total if self.total > 0 else math.inf
+        self._schedule()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb) -> bool:
+        if self._timer is not None:
+            self._timer.cancel()
+        if self.expired is not None and exc_type is asyncio.CancelledError:
+            if hasattr(self._task, "uncancel"):
+                self._task.uncancel()
+            raise StreamTimeout(self.expired, self._limit(self.expired)) from None
+        return False
+
+    def _limit(self, phase: str) -> float:
+        return {"first_token": self.first_token, "inter_token": self.inter_token, "total": self.total}[phase]
+
+    def _schedule(self) -> None:
+        self._timer_at = min(self._token_at, self._total_at)
+        self._timer = self._loop.call_at(self._timer_at, self._check) if self._timer_at != math.inf else None
+
+    def _check(self) -> None:
+        now = self._loop.time()
+        if now >= self._total_at:
+            self.expired = "total"
+        elif now >= self._token_at:
+            self.expired = self.phase
+        else:
+            self._schedule()
+            return
+        self._timer = None
+        if not self._suspended:
+            self._task.cancel()
+
+    def suspend(self) -> None:
+        """收到一个 token，交给下游之前调用"""
+        self.phase = "inter_token"
+        self._suspended = True
+        self._token_at = math.inf
+
+    def resume(self) -> None:
+        """下游已取走 token，继续等待上游之前调用"""
+        self._suspended = False
+        if self.expired is not None:
+            raise StreamTimeout(self.expired, self._limit(self.expired))
+        if self.inter_token > 0:
+            self._token_at = self._loop.time() + self.inter_token
+            # 首 token 之后的截止时间可能早于当前定时器
+            if self._token_at < self._timer_at:
+                if self._timer is not None:
+                    self._timer.cancel()
+                self._schedule()